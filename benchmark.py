@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+FANBOX-downloaderの性能をオフラインで計測するためのベンチマークです。
+
+api.fanbox.ccの代わりになるモックサーバーをローカルに立て、
+架空のクリエイターの投稿データとファイルを一通りダウンロードさせて、
+所要時間・スループット・最大メモリ使用量・リクエスト数を報告します。
+"""
+from time import sleep, perf_counter
+from typing import Any
+import os
+import sys
+import json
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import collections
+import http.server
+import urllib.parse
+
+try:
+    import resource
+except ImportError: # Windowsにはresourceモジュールが無い
+    resource = None
+
+import fanbox
+
+
+class MockFanboxServer:
+    """
+    api.fanbox.ccとファイル配信用のサーバーの代わりをするHTTPサーバーです。
+
+    creator.get、post.paginateCreator、post.listCreator、post.infoと、
+    投稿に含まれる画像・ファイルの配信に対応しています。
+    ファイルの中身はファイル名から決まるダミーのバイト列で、Rangeリクエストにも対応しています。
+    """
+    def __init__(self, creators:int=1, posts:int=50, per_page:int=10, images:int=3, image_size:int=200_000,
+                 files:int=0, file_size:int=5_000_000, latency:float=0.0, error_rate:float=0.0, seed:int=0):
+        """
+        Params
+        -------
+        creators:
+            クリエイターの数。IDは`creator0`、`creator1`…になります。
+        posts:
+            1人あたりの投稿数。
+        per_page:
+            post.listCreatorの1ページあたりの投稿数。
+        images:
+            1投稿あたりの画像の数。サムネイル画像は画像の1/10のサイズです。
+        image_size:
+            画像1枚のバイト数。
+        files:
+            1投稿あたりの添付ファイルの数。
+        file_size:
+            添付ファイル1つのバイト数。
+        latency:
+            全てのリクエストで応答を返す前に待つ秒数。
+        error_rate:
+            503エラーを返す確率。
+        """
+        self.creators = ["creator%d" % i for i in range(creators)]
+        self.posts = posts
+        self.per_page = per_page
+        self.images = images
+        self.image_size = image_size
+        self.files = files
+        self.file_size = file_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counts: collections.Counter = collections.Counter()
+        self.not_modified = 0 # 304を返した回数
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self) -> str:
+        return "http://127.0.0.1:%d/" % self._server.server_port
+
+    def start(self) -> None:
+        """別のスレッドでサーバーを起動する。"""
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                mock._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """サーバーを停止する。"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def post_id(self, creator:str, i:int) -> str:
+        """i番目（0が一番古い）の投稿のIDを返す。"""
+        return str((self.creators.index(creator) + 1) * 1_000_000 + i)
+
+    def post(self, creator:str, i:int) -> dict:
+        """i番目の投稿のpost.infoの中身を返す。"""
+        id = self.post_id(creator, i)
+        date = "2022-01-01T00:00:00+09:00"
+        url = self.base_url + "files/%s/%s/" % (creator, id)
+        images = [{"id": "%s_%d" % (id, j),
+                   "originalUrl": url + "image_%d.jpeg" % j,
+                   "thumbnailUrl": url + "thumb_%d.jpeg" % j} for j in range(self.images)]
+        files = [{"id": "%s_f%d" % (id, j), "name": "file_%d" % j, "extension": "zip",
+                  "size": self.file_size, "url": url + "file_%d.zip" % j} for j in range(self.files)]
+        return {
+            "id": id, "title": "post %d" % i, "type": "file" if self.files else "image",
+            "creatorId": creator, "feeRequired": 0 if i % 2 else 500, "hasAdultContent": i % 5 == 0,
+            "publishedDatetime": date, "updatedDatetime": date,
+            "coverImageUrl": url + "cover.jpeg",
+            "body": {"text": "", "images": images, "files": files},
+        }
+
+    def file_size_of(self, name:str) -> int:
+        if name.startswith("thumb_"): return max(1, self.image_size // 10)
+        if name.startswith("file_"): return self.file_size
+        return self.image_size
+
+    def _handle(self, h:http.server.BaseHTTPRequestHandler) -> None:
+        url = urllib.parse.urlparse(h.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.strip("/")
+        endpoint = "files" if path.startswith("files/") else path
+        with self._lock:
+            self.counts[endpoint] += 1
+            failed = self.random.random() < self.error_rate
+        if self.latency: sleep(self.latency)
+        if failed:
+            return self._send_json(h, {"error": "service unavailable"}, status=503, headers={"retry-after": "1"})
+
+        if endpoint == "creator.get":
+            creator = query.get("creatorId")
+            if creator not in self.creators: return self._send_json(h, {"error": "not found"}, status=404)
+            return self._send_json(h, {"body": {
+                "user": {"userId": creator, "name": creator,
+                         "iconUrl": self.base_url + "files/%s/profile/icon.jpeg" % creator},
+                "creatorId": creator, "coverImageUrl": self.base_url + "files/%s/profile/cover.jpeg" % creator,
+                "profileItems": [],
+            }})
+        if endpoint == "post.paginateCreator":
+            creator = query.get("creatorId")
+            if creator not in self.creators: return self._send_json(h, {"error": "not found"}, status=404)
+            pages = []
+            for start in range(self.posts - 1, -1, -self.per_page):
+                pages.append(self.base_url + "post.listCreator?" + urllib.parse.urlencode({
+                    "creatorId": creator, "maxPublishedDatetime": "2022-01-01 00:00:00",
+                    "maxId": self.post_id(creator, start), "limit": self.per_page}))
+            return self._send_json(h, {"body": pages})
+        if endpoint == "post.listCreator":
+            creator = query.get("creatorId")
+            start = int(query["maxId"]) % 1_000_000
+            items = []
+            for i in range(start, max(-1, start - int(query.get("limit", self.per_page))), -1):
+                post = self.post(creator, i)
+                del post["body"]
+                items.append(post)
+            return self._send_json(h, {"body": {"items": items, "nextUrl": None}})
+        if endpoint == "post.info":
+            id = int(query["postId"])
+            creator = self.creators[id // 1_000_000 - 1]
+            return self._send_json(h, {"body": self.post(creator, id % 1_000_000)})
+        if endpoint == "files":
+            return self._send_file(h, path)
+        self._send_json(h, {"error": "not found"}, status=404)
+
+    def _send_not_modified(self, h, etag:str) -> None:
+        h.send_response(304)
+        h.send_header("etag", etag)
+        h.end_headers()
+        with self._lock:
+            self.not_modified += 1
+
+    def _send_json(self, h, data:Any, status:int=200, headers:dict={}) -> None:
+        body = json.dumps(data).encode("utf-8")
+        if status == 200:
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:16]
+            if h.headers.get("if-none-match") == etag:
+                return self._send_not_modified(h, etag)
+            headers = {**headers, "etag": etag}
+        h.send_response(status)
+        h.send_header("content-type", "application/json")
+        h.send_header("content-length", str(len(body)))
+        for k, v in headers.items():
+            h.send_header(k, v)
+        h.end_headers()
+        h.wfile.write(body)
+        with self._lock:
+            self.bytes_sent += len(body)
+
+    def _send_file(self, h, path:str) -> None:
+        size = self.file_size_of(os.path.basename(path))
+        block = hashlib.sha256(path.encode("utf-8")).digest() * 2048 # 64KiBのダミーデータ
+        start = 0
+        range_ = h.headers.get("range")
+        etag = '"%s"' % hashlib.sha256(("%s:%d" % (path, size)).encode("utf-8")).hexdigest()[:16]
+        if h.headers.get("if-none-match") == etag:
+            return self._send_not_modified(h, etag)
+        if range_ and h.headers.get("if-range", etag) == etag:
+            start = int(range_.split("=")[1].split("-")[0])
+            if start >= size:
+                h.send_response(416)
+                h.send_header("content-range", "bytes */%d" % size)
+                h.send_header("content-length", "0")
+                h.end_headers()
+                return
+            h.send_response(206)
+            h.send_header("content-range", "bytes %d-%d/%d" % (start, size - 1, size))
+        else:
+            h.send_response(200)
+        h.send_header("content-type", "application/zip" if path.endswith(".zip") else "image/jpeg")
+        h.send_header("content-length", str(size - start))
+        h.send_header("etag", etag)
+        h.end_headers()
+        # 検証（--verify）で壊れたファイルと判定されないよう、先頭と末尾は本物のファイルに合わせる
+        header, trailer = (b"PK\x03\x04", b"") if path.endswith(".zip") else (b"\xff\xd8\xff\xe0", b"\xff\xd9")
+        position = start
+        while position < size:
+            offset = position % len(block)
+            chunk = block[offset:offset + min(len(block) - offset, size - position)]
+            if position < len(header):
+                chunk = header[position:position + len(chunk)] + chunk[len(header) - position:]
+            if position + len(chunk) > size - len(trailer):
+                cut = max(0, size - len(trailer) - position)
+                chunk = chunk[:cut] + trailer[len(trailer) - (len(chunk) - cut):]
+            h.wfile.write(chunk)
+            position += len(chunk)
+        with self._lock:
+            self.bytes_sent += size - start
+
+
+def peak_rss_kb() -> int|None:
+    """このプロセスの最大メモリ使用量（KiB）を返す。調べられない環境ではNoneを返す。"""
+    if resource is None: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss # macOSだけバイト単位
+
+def run_benchmark(server:MockFanboxServer, args:argparse.Namespace) -> dict:
+    """
+    モックサーバーを相手にダウンロードを一通り実行し、結果を返します。
+
+    modeが`phases`のときは投稿データ一覧・投稿データ・ファイルのダウンロードを順番に実行して
+    それぞれの所要時間を測り、`orchestrator`のときはmain.pyと同じOrchestratorで全体を実行します。
+    """
+    fanbox.BASE_URL = server.base_url
+    limiter = fanbox.RateLimiter(rate=args.rate, burst=1)
+    options = argparse.Namespace(update_posts=False, force_update=False, workers=args.workers,
+                                 host_limit=args.host_limit, writer_threads=args.writer_threads,
+                                 no_fsync=args.no_fsync)
+    phases = collections.OrderedDict()
+    started = perf_counter()
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            if args.mode == "orchestrator":
+                orchestrator = fanbox.Orchestrator(args=options, parallel=args.parallel_creators,
+                                                   workers=args.workers, host_limit=args.host_limit,
+                                                   limiter=limiter,
+                                                   writer=fanbox.DiskWriter(threads=args.writer_threads,
+                                                                            durable=not args.no_fsync))
+                orchestrator.run(server.creators)
+                orchestrator.close()
+                phases["orchestrator"] = perf_counter() - started
+            else:
+                engine = fanbox.DownloadEngine(workers=args.workers, host_limit=args.host_limit)
+                index = fanbox.Index()
+                session = fanbox.create_http_session(pool_size=engine.workers)
+                kwargs = dict(args=options, limiter=limiter, engine=engine, index=index, session=session)
+                for phase in ("download_postlist", "download_postdata_all", "download_files_all"):
+                    phases[phase] = 0.0
+                for cid in server.creators:
+                    post = fanbox.Post(creator_id=cid, **kwargs)
+                    t = perf_counter()
+                    postlist = post.download_postlist(post.get_paginateCreator())
+                    post.save_postlist(postlist)
+                    phases["download_postlist"] += perf_counter() - t
+                    t = perf_counter()
+                    post.download_postdata_all(postlist)
+                    phases["download_postdata_all"] += perf_counter() - t
+                    t = perf_counter()
+                    fanbox.File(creator_id=cid, **kwargs).download_files_all()
+                    phases["download_files_all"] += perf_counter() - t
+                engine.shutdown()
+                index.close()
+        finally:
+            os.chdir(cwd)
+    total = perf_counter() - started
+    requests_total = sum(server.counts.values())
+    return {
+        "scenario": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "phases": phases,
+        "total_seconds": total,
+        "requests": dict(server.counts),
+        "requests_total": requests_total,
+        "not_modified": server.not_modified,
+        "bytes": server.bytes_sent,
+        "requests_per_second": requests_total / total,
+        "bytes_per_second": server.bytes_sent / total,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+def compare(result:dict, baseline:dict) -> list[str]:
+    """結果をベースラインと比べた行を返す。"""
+    def line(name:str, now:float|None, before:float|None) -> str:
+        if not now or not before: return "%-28s %12s" % (name, now)
+        return "%-28s %12.3f  (ベースライン %.3f, %+.1f%%)" % (name, now, before, (now / before - 1) * 100)
+
+    lines = [line("total_seconds", result["total_seconds"], baseline.get("total_seconds"))]
+    for phase, seconds in result["phases"].items():
+        lines.append(line(phase, seconds, baseline.get("phases", {}).get(phase)))
+    for key in ("requests_total", "bytes_per_second", "peak_rss_kb"):
+        lines.append(line(key, result[key], baseline.get(key)))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--creators", type=int, default=1, help="クリエイターの数。（デフォルト: %(default)s）")
+    parser.add_argument("--posts", type=int, default=50, help="1人あたりの投稿数。（デフォルト: %(default)s）")
+    parser.add_argument("--per-page", type=int, default=10, help="投稿データ一覧の1ページあたりの投稿数。（デフォルト: %(default)s）")
+    parser.add_argument("--images", type=int, default=3, help="1投稿あたりの画像の数。（デフォルト: %(default)s）")
+    parser.add_argument("--image-size", type=int, default=200_000, help="画像1枚のバイト数。（デフォルト: %(default)s）")
+    parser.add_argument("--files", type=int, default=0, help="1投稿あたりの添付ファイルの数。（デフォルト: %(default)s）")
+    parser.add_argument("--file-size", type=int, default=5_000_000, help="添付ファイル1つのバイト数。（デフォルト: %(default)s）")
+    parser.add_argument("--latency", type=float, default=0.05, help="モックサーバーが応答を返すまでの秒数。（デフォルト: %(default)s）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="モックサーバーが503エラーを返す確率。（デフォルト: %(default)s）")
+    parser.add_argument("--seed", type=int, default=0, help="エラーを発生させる乱数のシード。（デフォルト: %(default)s）")
+    parser.add_argument("--rate", type=float, default=1/fanbox.WAIT_TIME, help="1秒あたりのリクエスト数の上限。（デフォルト: %(default)s）")
+    parser.add_argument("-w", "--workers", type=int, default=fanbox.WORKERS, help="同時に行う通信の最大数。（デフォルト: %(default)s）")
+    parser.add_argument("--host-limit", type=int, default=fanbox.HOST_CONCURRENCY, help="1つのホストに対して同時に行う通信の最大数。（デフォルト: %(default)s）")
+    parser.add_argument("--writer-threads", type=int, default=fanbox.WRITER_THREADS, help="ファイルを書き込むスレッドの数。0なら受信したスレッドで書き込みます。（デフォルト: %(default)s）")
+    parser.add_argument("--no-fsync", action="store_true", help="保存したファイルをfsyncしません。")
+    parser.add_argument("-j", "--parallel-creators", type=int, default=1, help="orchestratorモードで同時に処理するクリエイターの数。（デフォルト: %(default)s）")
+    parser.add_argument("--mode", choices=["phases", "orchestrator"], default="phases", help="phasesは処理ごとの所要時間を測り、orchestratorはmain.pyと同じ流れで全体を測ります。（デフォルト: %(default)s）")
+    parser.add_argument("-o", "--output", type=str, help="結果をJSONで保存するファイル。")
+    parser.add_argument("-b", "--baseline", type=str, help="以前に--outputで保存した結果。指定すると比較を表示します。")
+    args = parser.parse_args()
+
+    server = MockFanboxServer(creators=args.creators, posts=args.posts, per_page=args.per_page,
+                              images=args.images, image_size=args.image_size, files=args.files,
+                              file_size=args.file_size, latency=args.latency, error_rate=args.error_rate,
+                              seed=args.seed)
+    server.start()
+    try:
+        result = run_benchmark(server, args)
+    finally:
+        server.stop()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output is not None:
+        with open(args.output, mode="wt", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, mode="rt", encoding="utf-8") as f:
+            print("\n".join(compare(result, json.load(f))))
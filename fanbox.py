@@ -1,60 +1,1298 @@
 #!/usr/bin/env python3
-from time import sleep
-from typing import Any, AnyStr
+from time import sleep, monotonic, perf_counter
+from typing import Any, AnyStr, Callable, Iterable, Iterator, NamedTuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 import os
+import asyncio
 import json
+import multiprocessing
+import queue
+import random
 import argparse
 import datetime
+import email.utils
+import gzip
+import hashlib
 import re
+import shutil
+import sqlite3
+import sys
+import threading
 import urllib.parse
 
 import requests
 
+try:
+    import orjson # 入っていれば標準のjsonより速く読み書きできる
+except ImportError:
+    orjson = None
+try:
+    from PIL import Image # 入っていれば画像が壊れていないかをより正確に確認できる
+except ImportError:
+    Image = None
+
 
 BASE_URL = "https://api.fanbox.cc/"
 BASE_LOCAL_DIR = "./posts/"
 BASE_LOCAL_PROFILE_DIR = "./profile/"
+BASE_LOCAL_BLOB_DIR = "./blobs/" # --blob-storeのときにファイルの実体を置く場所
+INDEX_FILENAME = "index.sqlite3" # BASE_LOCAL_DIRの直下に作られるインデックスのファイル名
+JSON_FORMATS = ("json", "ndjson", "gzip") # 投稿データなどを保存する形式。jsonは字下げ付きの従来の形式
+JSON_EXTENSION = r"\.(?:nd)?json(?:\.gz)?$" # どの形式で保存したファイルにも合う拡張子のパターン
+SNAPSHOT_PATTERN = r"^\d{14}" + JSON_EXTENSION
+
+
+def save_json(data:Any, dir:str, compact:bool=False, writer:"DiskWriter|None"=None, wait:bool=False):
+    """
+    変数の中身をjsonファイルに保存します。
+
+    拡張子が`.ndjson`のときはリストの要素を1行に1つずつ書き込み、
+    `.gz`で終わるときはgzipで圧縮します。
+    compactがTrueのときと上の2つの場合は、改行や字下げを入れずに書き込みます。
+
+    `<dir>.part`に書き込んでから置き換えるため、途中で止まっても書きかけのファイルは残りません。
+    writerを渡すと、ディレクトリの作成とfsyncをそちらに任せます。
+    waitがTrueのときは、fsyncを後回しにせずに済ませてから返します（DiskWriter.commitを参照）。
+    """
+    if writer is None: writer = DiskWriter(threads=0, durable=False)
+    writer.makedirs(os.path.dirname(dir))
+    temppath = dir + ".part"
+    try:
+        if not (compact or is_ndjson(dir) or dir.endswith(".gz")):
+            with open(temppath, mode="wt", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        else:
+            with open_json(temppath, mode="wt", compress=dir.endswith(".gz")) as f:
+                if is_ndjson(dir):
+                    for item in data:
+                        f.write(dumps_json(item) + "\n")
+                else:
+                    f.write(dumps_json(data))
+    except BaseException:
+        if os.path.isfile(temppath): os.remove(temppath)
+        raise
+    writer.commit(temppath, dir, wait=wait)
+
+def load_json(path:str) -> Any:
+    """
+    save_jsonで保存したjsonファイルを読み込みます。
+
+    `.ndjson`はリストとして返します。字下げされた従来の形式のファイルもそのまま読み込めます。
+    """
+    with open_json(path) as f:
+        if is_ndjson(path):
+            return [loads_json(line) for line in f if line.strip()]
+        return loads_json(f.read())
+
+def iter_json_items(path:str, chunk_size:int=64*1024) -> Iterator[Any]:
+    """
+    リストを保存したjsonファイルから、要素を1つずつ読み込んで返します。
+
+    ファイル全体を一度に読み込まないため、大きな投稿データ一覧でも使用メモリは要素1つ分程度で済みます。
+    `.ndjson`は1行ずつ、字下げされた従来の形式はchunk_size文字ずつ読み進めます。
+    """
+    with open_json(path) as f:
+        if is_ndjson(path):
+            for line in f:
+                if line.strip(): yield loads_json(line)
+            return
+        decoder = json.JSONDecoder()
+        buffer, pos, started, eof = "", 0, False, False
+        while not eof:
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            while True:
+                # 要素の間の空白とカンマ、最初の[を読み飛ばす
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","
+                                             or (not started and buffer[pos] == "[")):
+                    started = started or buffer[pos] == "["
+                    pos += 1
+                if pos == len(buffer): break
+                if not started:
+                    raise ValueError("リストが保存されたjsonファイルではありません。: %s" % path)
+                if buffer[pos] == "]": return
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof: raise
+                    break # 要素の途中で途切れているので続きを読み込む
+                if end < len(buffer) and not (buffer[end].isspace() or buffer[end] in ",]"):
+                    # `1.5`の`1`だけを読み込んだ場合など、要素の途中で途切れている
+                    if not eof: break
+                    raise json.JSONDecodeError("要素の後に余分な文字があります", buffer, end)
+                if end == len(buffer) and not eof: break # 数値などが途切れている可能性がある
+                yield item
+                pos = end
+
+def is_ndjson(path:str) -> bool:
+    """1行に1つずつ要素を書き込む形式のファイル名かどうかを返す。"""
+    return path.endswith(".ndjson") or path.endswith(".ndjson.gz")
+
+def json_filename(filename:str, data:Any, format:str="json") -> str:
+    """
+    `.json`で終わるファイル名の拡張子を、保存形式に合わせて付け替えます。
+
+    ndjsonとgzipではリストを`.ndjson`に、それ以外を改行無しの`.json`にし、
+    gzipのときはさらに`.gz`を付けます。
+    """
+    if format == "json": return filename
+    name = filename[:-len(".json")] + (".ndjson" if isinstance(data, list) else ".json")
+    return name + ".gz" if format == "gzip" else name
+
+def open_json(path:str, mode:str="rt", compress:bool|None=None):
+    """jsonファイルを開く。拡張子が`.gz`ならgzipとして開きます。compressを指定した場合は拡張子に関わらずそれに従います。"""
+    if compress is None: compress = path.endswith(".gz")
+    if compress:
+        return gzip.open(path, mode=mode, compresslevel=6, encoding="utf-8")
+    return open(path, mode=mode, encoding="utf-8")
+
+def dumps_json(data:Any) -> str:
+    """改行や字下げを入れずにjsonの文字列にする。"""
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+def loads_json(text:str) -> Any:
+    """jsonの文字列を読み込む。"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def blob_path(sha256:str) -> str:
+    """SHA-256に対応するファイルの実体の置き場所を返す。"""
+    return os.path.join(BASE_LOCAL_BLOB_DIR, sha256[:2], sha256)
+
+def link_file(src:str, dst:str) -> None:
+    """
+    dstにsrcへのリンクを作る。
 
+    ハードリンクを作れない場合（別のドライブなど）はシンボリックリンクを、
+    それもできない場合はコピーを作ります。dstに既にファイルがあれば置き換えます。
+    """
+    if os.path.lexists(dst): os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
-def save_json(data:Any, dir:str):
-    """変数の中身をjsonファイルに保存します。"""
-    os.makedirs(os.path.dirname(dir), exist_ok=True)
-    with open(dir, mode="wt", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+def listdir(path:str) -> list[str]:
+    """ディレクトリの中身を返す。ディレクトリが存在しなければ空のリストを返す。"""
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+def json_sha256(data:Any) -> str:
+    """変数の中身を、キーの順番や空白の違いに左右されない形でSHA-256にして返す。"""
+    text = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def load_json_or_none(path:str) -> Any:
+    """jsonファイルを読み込む。読み込めなければNoneを返す。"""
+    try:
+        return load_json(path)
+    except (OSError, ValueError):
+        return None
 
 def time_now(utc_add=9) -> int:
     """現在時刻を表す数値を返す"""
     now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=utc_add)))
     return int(now.strftime('%Y%m%d%H%M%S'))
 
+_PRINT_LOCK = threading.Lock() # 複数のスレッドから出力したログが混ざらないようにする
+
 def print_with_timestamp(value:str, utc_add=9) -> None:
-    """頭に時刻表記を追加した上でprintする。"""
+    """
+    頭に時刻表記を追加した上でprintする。
+
+    複数のスレッドから同時に呼ばれても行が混ざらないよう、全体を組み立ててから1回で書き出します。
+    """
     now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=utc_add)))
     timestamp = now.strftime('[%Y/%m/%d %H:%M:%S] ')
     text = value.splitlines()
     if len(text) > 1:
         # 2行目以降は日付ではなく空白を入れる
         text = [text[0], *[' '*22 + t for t in text[1:]]]
-    print(timestamp+"\n".join(text))
+    line = timestamp + "\n".join(text) + "\n"
+    with _PRINT_LOCK:
+        sys.stdout.write(line)
+
+def is_strong_etag(etag:str|None) -> bool:
+    """If-Rangeに使える（弱いETagではない）ETagかどうかを返す。"""
+    return bool(etag) and not etag.startswith("W/")
+
+def content_range(value:str|None) -> tuple[int, int|None] | None:
+    """
+    Content-Rangeヘッダーから開始位置と全体のサイズを取り出す。
+
+    `bytes 100-199/200`なら`(100, 200)`、全体のサイズが不明（`*`）なら`(100, None)`を返す。
+    解釈できない場合はNoneを返す。
+    """
+    m = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", (value or "").strip())
+    if m is None: return None
+    return int(m[1]), None if m[2] == "*" else int(m[2])
 
 WAIT_TIME = 0.2
+CHUNK_SIZE = 1024*1024 # ファイルをダウンロードするときに一度に読み込むバイト数
+def hash_file(path:str) -> "hashlib._Hash":
+    """ファイルの中身からSHA-256のハッシュオブジェクトを作って返す。"""
+    digest = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest
+
+WORKERS = 4            # 同時に行う通信の最大数
+HOST_CONCURRENCY = 2   # 1つのホストに対して同時に行う通信の最大数
+QUEUE_SIZE = 256       # パイプラインでダウンロードを待たせておけるファイルの最大数
+RETRY_LIMIT = 5        # 通信に失敗したときに再試行する最大回数
+BACKOFF_BASE = 1.0     # 再試行するまでの待ち時間の基準（秒）。失敗するたびに倍になる
+BACKOFF_MAX = 60.0     # 再試行するまでの待ち時間の上限（秒）
+RETRY_STATUS = (429, 500, 502, 503, 504) # 再試行するHTTPステータスコード
+PLAN_PARALLEL_THRESHOLD = 200 # 投稿数がこれ以上のとき、ファイルの一覧を複数のプロセスで作る
+VERIFY_PARALLEL_THRESHOLD = 16 # 確認するファイルがこれ以上のとき、複数のプロセスでハッシュを計算する
+WATCH_INTERVAL = 3600.0 # --watchで同じクリエイターを同期し直す間隔の既定値（秒）
+WATCH_JITTER = 0.1      # 同期の間隔をずらす割合。0.1なら間隔の±10%
+ESTIMATED_BANDWIDTH = 5*1024*1024 # 残り時間の見積もりに使う回線速度（バイト/秒）。実測値があればそちらを使う
+WRITER_THREADS = 1     # 受信したデータをファイルに書き込むスレッドの数。0なら受信したスレッドでそのまま書き込む
+WRITE_QUEUE_SIZE = 16  # 書き込みを待たせておけるチャンクの最大数（書き込みスレッドごと）
+FSYNC_BATCH = 64       # この数のファイルが溜まったらまとめてfsyncする
+FSYNC_INTERVAL = 1.0   # fsyncを待たせておく最大の時間（秒）
+
+def backoff_delay(attempt:int, retry_after:float|None=None) -> float:
+    """
+    attempt回目（0から数える）の再試行の前に待つ秒数を返す。
+
+    指数バックオフにジッターを加えたもので、retry_afterが指定されていればそれより短くはしません。
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after) if retry_after is not None else delay
+
+def parse_retry_after(value:str|None) -> float|None:
+    """Retry-Afterヘッダーの値（秒数か日時）を、待つべき秒数にして返す。解釈できなければNoneを返す。"""
+    if not value: return None
+    value = value.strip()
+    if value.isdigit(): return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+class RateLimiter:
+    """
+    トークンバケット方式でリクエストの頻度を制限するクラスです。
+
+    複数のスレッドから共有でき、全体で1秒あたり`rate`回までしかリクエストを通しません。
+    同時に通信する数を増やしてもサーバーへの負荷は変わりません。
+
+    サーバーから混雑していると返されたら（429や503）slow_down()で頻度を半分に下げ、
+    成功するたびにspeed_up()で少しずつ元の頻度に戻します（AIMD）。
+    """
+    INCREASE_STEP = 0.01 # 成功1回あたりに戻す頻度（元の頻度に対する割合）
+
+    def __init__(self, rate:float=1/WAIT_TIME, burst:int=1, min_rate:float|None=None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._slowed = 0.0
+        self._lock = threading.Lock()
+
+    def slow_down(self) -> None:
+        """頻度を半分に下げる。同時に何件も失敗したときに下げすぎないよう、1秒に1回までしか下げない。"""
+        with self._lock:
+            now = monotonic()
+            if now - self._slowed < 1.0: return
+            self._slowed = now
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self) -> None:
+        """頻度を少しだけ元に戻す。"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * self.INCREASE_STEP)
+
+    def acquire(self) -> float:
+        """リクエストを1回送れるようになるまで待つ。待った秒数を返す。"""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 先に順番を確保してから待つことで、待っている間に割り込まれないようにする
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0: sleep(wait)
+        return wait
+
+RATE_LIMITER = RateLimiter() # 特に指定しなければ全てのSessionでこれを共有する
+
+def parse_size(value:str) -> int:
+    """`500K`や`2.5M`、`1G`のようなバイト数の表記を数値にして返す。単位は1024倍ずつです。"""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", str(value), flags=re.IGNORECASE)
+    if m is None: raise ValueError("バイト数として解釈できません: %s" % value)
+    return int(float(m[1]) * 1024 ** " KMGT".index(m[2].upper() or " "))
+
+class BandwidthLimiter:
+    """
+    トークンバケット方式で1秒あたりの受信バイト数を制限するクラスです。
+
+    RateLimiterのバイト数版で、複数のスレッドから共有すると全体で1秒あたり`rate`バイトまでに抑えます。
+    受信したバイト数をreserve()で差し引き、返された秒数だけ待つと上限の速さになります。
+    """
+    def __init__(self, rate:float, burst:float|None=None):
+        """
+        Params
+        -------
+        rate:
+            1秒あたりに受信してよいバイト数。
+        burst:
+            続けて受信してよいバイト数。省略した場合は1秒分です。
+        """
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else self.rate
+        self._tokens = self.burst
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes:int) -> float:
+        """nbytes分を差し引き、上限の速さに収めるために待つべき秒数を返す。待つのは呼び出し側です。"""
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+class Budget:
+    """
+    1回の実行で受信してよいバイト数と、かけてよい時間の上限です。
+
+    上限に達すると、受信中のファイルは`.part`を残して中断し、まだ始めていない投稿データやファイルは
+    再試行の記録に回します。次回の実行はその続きから再開します。
+    複数のスレッドやクリエイターで共有でき、時間は作った時点から数えます。
+    """
+    def __init__(self, max_bytes:int|None=None, max_seconds:float|None=None):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.received = 0
+        self.started = monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, nbytes:int) -> None:
+        """受信したバイト数を記録する。"""
+        with self._lock:
+            self.received += nbytes
+
+    def exceeded(self) -> str|None:
+        """上限に達していればその理由を、達していなければNoneを返す。"""
+        if self.max_bytes is not None and self.received >= self.max_bytes:
+            return "受信量が上限（%.1fMB）に達しました" % (self.max_bytes / 1024**2)
+        if self.max_seconds is not None and monotonic() - self.started >= self.max_seconds:
+            return "実行時間が上限（%d秒）に達しました" % self.max_seconds
+        return None
+
+class DownloadEngine:
+    """
+    複数の通信を並行して行うためのワーカープールです。
+
+    PostとFileで共有することで、全体の同時通信数をworkersまでに抑えます。
+    さらに1つのホストへの同時通信数はhost_limitまでに制限します。
+    """
+    def __init__(self, workers:int=WORKERS, host_limit:int=HOST_CONCURRENCY):
+        self.workers = max(1, workers)
+        self.host_limit = max(1, host_limit)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._hosts: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def host_slot(self, url:str) -> Iterator[None]:
+        """URLのホストへの同時通信数に空きができるまで待ち、通信が終わるまで枠を確保する。"""
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.host_limit)
+            semaphore = self._hosts[host]
+        with semaphore:
+            yield
+
+    def map(self, func:Callable[[Any], Any], items:Iterable[Any]) -> list[Any]:
+        """itemsの各要素についてfuncを並行して実行し、結果を元の順番で返す。"""
+        futures = [self.executor.submit(func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def shutdown(self) -> None:
+        """ワーカーを終了させる。"""
+        self.executor.shutdown(wait=True)
+
+class Index:
+    """
+    ダウンロード済みの投稿データやファイルを記録しておくSQLiteのインデックスです。
+
+    保存済みかどうかの判定をディレクトリの走査ではなくインデックスの検索で行うために使います。
+    複数のスレッドから共有でき、記録はダウンロードが終わるごとにトランザクションで反映されます。
+    まだインデックスが作られていないクリエイターは、最初に使われた時点で保存済みのファイルから作り直します。
+    """
+    VERSION = 3 # テーブルの構成を変えたら増やす。古いインデックスは使われた時点で作り直される。
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS creators (
+            creator_id TEXT PRIMARY KEY,
+            indexed_at INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            creator_id TEXT NOT NULL,
+            post_id    TEXT NOT NULL,
+            filename   TEXT NOT NULL,
+            PRIMARY KEY (creator_id, post_id, filename)
+        );
+        CREATE TABLE IF NOT EXISTS posts (
+            creator_id       TEXT NOT NULL,
+            post_id          TEXT NOT NULL,
+            updated_datetime TEXT,
+            PRIMARY KEY (creator_id, post_id)
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            key        TEXT PRIMARY KEY,
+            creator_id TEXT NOT NULL,
+            sha256     TEXT NOT NULL,
+            filename   TEXT NOT NULL,
+            checked_at INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path          TEXT PRIMARY KEY,
+            creator_id    TEXT NOT NULL,
+            post_id       TEXT,
+            filetype      TEXT NOT NULL,
+            url           TEXT,
+            size          INTEGER NOT NULL,
+            sha256        TEXT,
+            downloaded_at INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS retries (
+            kind       TEXT NOT NULL,
+            key        TEXT NOT NULL,
+            creator_id TEXT NOT NULL,
+            url        TEXT,
+            path       TEXT,
+            post_id    TEXT,
+            filetype   TEXT,
+            attempts   INTEGER NOT NULL,
+            last_error TEXT,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        );
+        CREATE TABLE IF NOT EXISTS validators (
+            url           TEXT PRIMARY KEY,
+            etag          TEXT,
+            last_modified TEXT,
+            checked_at    INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS verifications (
+            path        TEXT PRIMARY KEY,
+            size        INTEGER NOT NULL,
+            mtime_ns    INTEGER NOT NULL,
+            sha256      TEXT NOT NULL,
+            verified_at INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS post_jobs (
+            creator_id TEXT NOT NULL,
+            post_id    TEXT NOT NULL,
+            filename   TEXT NOT NULL,
+            jobs       TEXT NOT NULL,
+            PRIMARY KEY (creator_id, post_id)
+        );
+        CREATE INDEX IF NOT EXISTS files_creator ON files (creator_id);
+        CREATE INDEX IF NOT EXISTS files_url ON files (url);
+    """
+
+    def __init__(self, path:str|None=None):
+        """
+        Params
+        -------
+        path:
+            インデックスのファイルの場所。省略した場合はBASE_LOCAL_DIRの直下に作ります。
+        """
+        if path is None: path = os.path.join(BASE_LOCAL_DIR, INDEX_FILENAME)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < self.VERSION:
+                self._conn.execute("DELETE FROM creators")
+                self._conn.execute("PRAGMA user_version = %d" % self.VERSION)
+
+    @staticmethod
+    def key(path:str) -> str:
+        """ファイルのパスをインデックスのキーとして使える形にそろえる。"""
+        return os.path.normpath(path)
+
+    def _query(self, sql:str, params:tuple=()) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _execute(self, sql:str, params:tuple=()) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    def is_indexed(self, creator_id:str) -> bool:
+        """クリエイターのインデックスが作られているかどうかを返す。"""
+        return bool(self._query("SELECT 1 FROM creators WHERE creator_id = ?", (creator_id,)))
+
+    def latest_snapshot(self, creator_id:str, post_id:str) -> str|None:
+        """最新の投稿データのファイル名を返す。保存されていなければNoneを返す。"""
+        rows = self._query("SELECT MAX(filename) FROM snapshots WHERE creator_id = ? AND post_id = ?",
+                           (creator_id, post_id))
+        return rows[0][0]
+
+    def add_snapshot(self, creator_id:str, post_id:str, filename:str, updated_datetime:str|None=None) -> None:
+        """保存した投稿データを、その投稿データの更新日時（updatedDatetime）と一緒に記録する。"""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)", (creator_id, post_id, filename))
+            self._conn.execute("INSERT OR REPLACE INTO posts VALUES (?, ?, ?)", (creator_id, post_id, updated_datetime))
+
+    def remove_snapshot(self, creator_id:str, post_id:str, filename:str) -> None:
+        """
+        読み込めなかった投稿データの記録を消す。
+
+        内容のSHA-256と更新日時の記録も消すため、次に取得したときは変わっていなくても保存し直されます。
+        """
+        key = self.key(os.path.join(BASE_LOCAL_DIR, creator_id, post_id, "post", "*.json"))
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM snapshots WHERE creator_id = ? AND post_id = ? AND filename = ?",
+                               (creator_id, post_id, filename))
+            self._conn.execute("DELETE FROM post_jobs WHERE creator_id = ? AND post_id = ?", (creator_id, post_id))
+            self._conn.execute("DELETE FROM posts WHERE creator_id = ? AND post_id = ?", (creator_id, post_id))
+            self._conn.execute("DELETE FROM documents WHERE key = ?", (key,))
+
+    def post_jobs(self, creator_id:str, post_id:str, filename:str) -> list[dict]|None:
+        """
+        投稿データfilenameから作ったファイルの一覧を返す。
+
+        記録されていないか、記録したときから投稿データが変わっている場合はNoneを返す。
+        """
+        rows = self._query("SELECT jobs FROM post_jobs WHERE creator_id = ? AND post_id = ? AND filename = ?",
+                           (creator_id, post_id, filename))
+        return loads_json(rows[0][0]) if rows else None
+
+    def set_post_jobs(self, creator_id:str, post_id:str, filename:str, jobs:list[dict]) -> None:
+        """投稿データfilenameから作ったファイルの一覧を記録する。次からは投稿データを読み込まずに済む。"""
+        self._execute("INSERT OR REPLACE INTO post_jobs VALUES (?, ?, ?, ?)",
+                      (creator_id, post_id, filename, dumps_json(jobs)))
+
+    def post_updated_datetime(self, creator_id:str, post_id:str) -> str|None:
+        """保存済みの投稿データの更新日時（updatedDatetime）を返す。分からなければNoneを返す。"""
+        rows = self._query("SELECT updated_datetime FROM posts WHERE creator_id = ? AND post_id = ?",
+                           (creator_id, post_id))
+        return rows[0][0] if rows else None
+
+    def document_sha256(self, key:str) -> str|None:
+        """
+        最後に保存したjsonの内容のSHA-256を返す。保存されていなければNoneを返す。
+
+        keyは保存先のファイル名の時刻の部分を`*`にしたもの（例: `posts/<クリエイターID>_*.json`）です。
+        """
+        rows = self._query("SELECT sha256 FROM documents WHERE key = ?", (self.key(key),))
+        return rows[0][0] if rows else None
+
+    def set_document(self, creator_id:str, key:str, sha256:str, filename:str) -> None:
+        """保存したjsonの内容のSHA-256を記録する。"""
+        self._execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                      (self.key(key), creator_id, sha256, filename, time_now()))
+
+    def touch_document(self, key:str) -> None:
+        """jsonの内容を確認したが変わっていなかったことを記録する。"""
+        self._execute("UPDATE documents SET checked_at = ? WHERE key = ?", (time_now(), self.key(key)))
+
+    def average_size(self, filetype:str) -> float|None:
+        """保存済みのファイルの、種類ごとの平均サイズを返す。1つも無ければNoneを返す。"""
+        rows = self._query("SELECT AVG(size) FROM files WHERE filetype = ? AND size IS NOT NULL", (filetype,))
+        return rows[0][0]
+
+    def has_file(self, path:str) -> bool:
+        """ファイルが保存済みとして記録されているかどうかを返す。"""
+        return bool(self._query("SELECT 1 FROM files WHERE path = ?", (self.key(path),)))
+
+    def url_sha256(self, url:str) -> str|None:
+        """以前そのURLからダウンロードしたファイルのSHA-256を返す。分からなければNoneを返す。"""
+        rows = self._query("SELECT sha256 FROM files WHERE url = ? AND sha256 IS NOT NULL LIMIT 1", (url,))
+        return rows[0][0] if rows else None
+
+    def add_file(self, path:str, creator_id:str, post_id:str|None, filetype:str,
+                 url:str|None=None, size:int|None=None, sha256:str|None=None) -> None:
+        """保存したファイルを記録する。sizeを省略した場合は実際のファイルから調べる。"""
+        if size is None: size = os.path.getsize(path)
+        self._execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                      (self.key(path), creator_id, post_id, filetype, url, size, sha256, time_now()))
+
+    def validator(self, url:str) -> tuple[str|None, str|None] | None:
+        """URLの前回のETagとLast-Modifiedを返す。記録されていなければNoneを返す。"""
+        rows = self._query("SELECT etag, last_modified FROM validators WHERE url = ?", (url,))
+        return rows[0] if rows else None
+
+    def set_validator(self, url:str, etag:str|None, last_modified:str|None) -> None:
+        """URLのETagとLast-Modifiedを記録する。どちらも無ければ記録を消す。"""
+        if etag is None and last_modified is None:
+            self.remove_validator(url)
+            return
+        self._execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?)",
+                      (url, etag, last_modified, time_now()))
+
+    def remove_validator(self, url:str) -> None:
+        """URLのETagとLast-Modifiedの記録を消す。"""
+        self._execute("DELETE FROM validators WHERE url = ?", (url,))
+
+    def files(self, creator_id:str) -> list[dict]:
+        """クリエイターの保存済みのファイルの記録を全て返す。"""
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM files WHERE creator_id = ? ORDER BY path", (creator_id,))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def remove_file(self, path:str) -> None:
+        """ファイルを保存済みの記録から消す。次回の実行でダウンロードし直されます。"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM files WHERE path = ?", (self.key(path),))
+            self._conn.execute("DELETE FROM verifications WHERE path = ?", (self.key(path),))
+
+    def is_verified(self, path:str, size:int, mtime_ns:int) -> bool:
+        """前回確認した時からファイルのサイズと更新日時が変わっていないかどうかを返す。"""
+        return bool(self._query("SELECT 1 FROM verifications WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                (self.key(path), size, mtime_ns)))
+
+    def set_verified(self, path:str, size:int, mtime_ns:int, sha256:str) -> None:
+        """ファイルを確認して問題が無かったことを、その時点のサイズ・更新日時・SHA-256と一緒に記録する。"""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO verifications VALUES (?, ?, ?, ?, ?)",
+                               (self.key(path), size, mtime_ns, sha256, time_now()))
+            self._conn.execute("UPDATE files SET sha256 = ? WHERE path = ? AND sha256 IS NULL",
+                               (sha256, self.key(path)))
+
+    def add_retry(self, kind:str, key:str, creator_id:str, url:str|None=None, path:str|None=None,
+                  post_id:str|None=None, filetype:str|None=None, error:str|None=None) -> None:
+        """
+        取得に失敗したものを、次回の実行で最初に再試行するよう記録する。
+
+        kindは`post`（投稿データ）か`file`（ファイル）で、keyは投稿IDかファイルの保存先のパスです。
+        """
+        if kind == "file": key = self.key(key)
+        self._execute("""
+            INSERT INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT (kind, key) DO UPDATE SET
+                attempts = attempts + 1, last_error = excluded.last_error, updated_at = excluded.updated_at
+        """, (kind, key, creator_id, url, path, post_id, filetype, error, time_now()))
+
+    def remove_retry(self, kind:str, key:str) -> None:
+        """取得に成功したものを再試行の記録から消す。"""
+        if kind == "file": key = self.key(key)
+        self._execute("DELETE FROM retries WHERE kind = ? AND key = ?", (kind, key))
+
+    def retries(self, creator_id:str, kind:str) -> list[dict]:
+        """再試行するよう記録されているものを古い順に返す。"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM retries WHERE creator_id = ? AND kind = ? ORDER BY updated_at", (creator_id, kind))
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def reindex(self, creator_id:str) -> None:
+        """
+        保存済みのファイルを走査して、クリエイターのインデックスを作り直します。
+
+        `BASE_LOCAL_DIR/<クリエイターID>/`以下の投稿データとファイル、
+        `BASE_LOCAL_PROFILE_DIR/<クリエイターID>/`以下のファイルが対象です。
+        ダウンロード途中のファイル（`.part`）は含めません。
+        """
+        snapshots, posts, documents, files = [], [], [], []
+        now = time_now()
+
+        def add_document(dir:str, filename:str, pattern:str) -> Any:
+            """dirの中でpatternに合う最新のjsonを読み込み、内容のSHA-256を記録する。"""
+            latest = max((f for f in listdir(dir) if re.match(pattern, f)), default=None)
+            if latest is None: return None
+            data = load_json_or_none(os.path.join(dir, latest))
+            if data is None: return None
+            args = (creator_id,) if "%s" in filename else ()
+            documents.append((self.key(os.path.join(dir, filename.replace("%d", "*") % args)),
+                              creator_id, json_sha256(data), latest, now))
+            return data
+
+        add_document(BASE_LOCAL_DIR, "%s_%d.json", "^" + re.escape(creator_id) + r"_\d{14}" + JSON_EXTENSION)
+        add_document(BASE_LOCAL_PROFILE_DIR, "%s_profile_%d.json",
+                     "^" + re.escape(creator_id) + r"_profile_\d{14}" + JSON_EXTENSION)
+        postsdir = os.path.join(BASE_LOCAL_DIR, creator_id)
+        pattern = re.compile(SNAPSHOT_PATTERN)
+        for post_id in listdir(postsdir):
+            data = add_document(os.path.join(postsdir, post_id, "post"), "%d.json", SNAPSHOT_PATTERN)
+            if data is not None:
+                try:
+                    updated = data["body"]["updatedDatetime"]
+                except (KeyError, TypeError):
+                    updated = None
+                posts.append((creator_id, post_id, updated))
+            for filetype in listdir(os.path.join(postsdir, post_id)):
+                dir = os.path.join(postsdir, post_id, filetype)
+                for f in listdir(dir):
+                    if not os.path.isfile(os.path.join(dir, f)): continue
+                    if filetype == "post":
+                        if pattern.match(f): snapshots.append((creator_id, post_id, f))
+                    elif not (f.endswith(".part") or f.endswith(".part.json")):
+                        files.append((os.path.join(dir, f), post_id, filetype))
+        profiledir = os.path.join(BASE_LOCAL_PROFILE_DIR, creator_id)
+        for filetype in listdir(profiledir):
+            dir = os.path.join(profiledir, filetype)
+            files += [(os.path.join(dir, f), None, filetype) for f in listdir(dir)
+                      if os.path.isfile(os.path.join(dir, f))
+                      and not (f.endswith(".part") or f.endswith(".part.json"))]
+
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM snapshots WHERE creator_id = ?", (creator_id,))
+            self._conn.execute("DELETE FROM posts WHERE creator_id = ?", (creator_id,))
+            self._conn.execute("DELETE FROM documents WHERE creator_id = ?", (creator_id,))
+            self._conn.execute("DELETE FROM files WHERE creator_id = ?", (creator_id,))
+            self._conn.executemany("INSERT INTO snapshots VALUES (?, ?, ?)", snapshots)
+            self._conn.executemany("INSERT INTO posts VALUES (?, ?, ?)", posts)
+            self._conn.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?)", documents)
+            self._conn.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, NULL, ?, NULL, ?)",
+                [(self.key(path), creator_id, post_id, filetype, os.path.getsize(path), now)
+                 for path, post_id, filetype in files])
+            self._conn.execute("INSERT OR REPLACE INTO creators VALUES (?, ?)", (creator_id, now))
+
+    def ensure_indexed(self, creator_id:str) -> None:
+        """クリエイターのインデックスがまだ無ければ作る。"""
+        with self._lock:
+            if not self.is_indexed(creator_id):
+                self.reindex(creator_id)
+
+    def close(self) -> None:
+        """インデックスを閉じる。"""
+        with self._lock:
+            self._conn.close()
+
+class Metrics:
+    """
+    実行中にどこで時間がかかっているかを記録するクラスです。複数のスレッドから共有できます。
+
+    - APIのエンドポイントごとの応答時間のヒストグラム
+    - ファイルの種類ごとの受信バイト数と受信にかかった時間
+    - リクエストの頻度の制限による待ち時間、通信、ディスクへの書き込みにかかった時間
+    - スキップした数やダウンロードした数などの件数
+
+    を集計し、実行の最後にJSON Lines形式かPrometheusのtextfile形式で書き出せます。
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf")) # 応答時間のヒストグラムの区切り（秒）
+
+    def __init__(self):
+        self.started = monotonic()
+        self._lock = threading.Lock()
+        self.requests: dict[str, list[int]] = {}   # エンドポイント → 区切りごとの件数
+        self.request_sums: dict[str, float] = {}   # エンドポイント → 応答時間の合計
+        self.transfers: dict[str, list[float]] = {} # ファイルの種類 → [バイト数, 秒数]
+        self.phases: dict[str, float] = {}         # rate_limit / network / disk → 秒数
+        self.events: dict[str, int] = {}           # 件数
+
+    def observe_request(self, endpoint:str, seconds:float) -> None:
+        """1回のリクエストの応答時間を記録する。"""
+        with self._lock:
+            buckets = self.requests.setdefault(endpoint, [0] * len(self.BUCKETS))
+            for i, le in enumerate(self.BUCKETS):
+                if seconds <= le: buckets[i] += 1
+            self.request_sums[endpoint] = self.request_sums.get(endpoint, 0.0) + seconds
+
+    def add_transfer(self, filetype:str, nbytes:int, seconds:float) -> None:
+        """ファイルを受信したバイト数とかかった時間を記録する。"""
+        with self._lock:
+            total = self.transfers.setdefault(filetype, [0, 0.0])
+            total[0] += nbytes
+            total[1] += seconds
+
+    def add_time(self, phase:str, seconds:float) -> None:
+        """rate_limit（頻度の制限による待ち）・network（通信）・disk（書き込み）にかかった時間を記録する。"""
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, event:str, n:int=1) -> None:
+        """スキップした数などの件数を記録する。"""
+        with self._lock:
+            self.events[event] = self.events.get(event, 0) + n
+
+    def merge(self, other:"Metrics") -> None:
+        """別のMetricsの集計結果をこちらに足し合わせる。"""
+        with other._lock:
+            requests = {k: list(v) for k, v in other.requests.items()}
+            request_sums = dict(other.request_sums)
+            transfers = {k: list(v) for k, v in other.transfers.items()}
+            phases, events = dict(other.phases), dict(other.events)
+        with self._lock:
+            for endpoint, buckets in requests.items():
+                mine = self.requests.setdefault(endpoint, [0] * len(self.BUCKETS))
+                self.requests[endpoint] = [a + b for a, b in zip(mine, buckets)]
+                self.request_sums[endpoint] = self.request_sums.get(endpoint, 0.0) + request_sums[endpoint]
+            for filetype, (nbytes, seconds) in transfers.items():
+                total = self.transfers.setdefault(filetype, [0, 0.0])
+                total[0] += nbytes
+                total[1] += seconds
+            for phase, seconds in phases.items():
+                self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+            for event, n in events.items():
+                self.events[event] = self.events.get(event, 0) + n
+
+    def to_json_lines(self) -> str:
+        """集計結果をJSON Lines形式の文字列にして返す。"""
+        with self._lock:
+            lines = [{"metric": "run", "timestamp": time_now(), "seconds": monotonic() - self.started}]
+            for endpoint, buckets in self.requests.items():
+                lines.append({"metric": "request_seconds", "endpoint": endpoint,
+                              "count": buckets[-1], "sum": self.request_sums[endpoint],
+                              "buckets": {str(le): n for le, n in zip(self.BUCKETS, buckets)}})
+            for filetype, (nbytes, seconds) in self.transfers.items():
+                lines.append({"metric": "transfer", "filetype": filetype, "bytes": nbytes, "seconds": seconds,
+                              "bytes_per_second": nbytes / seconds if seconds else None})
+            for phase, seconds in self.phases.items():
+                lines.append({"metric": "phase_seconds", "phase": phase, "seconds": seconds})
+            for event, n in self.events.items():
+                lines.append({"metric": "events", "event": event, "count": n})
+            for kind in ("posts", "files"):
+                skipped = self.events.get(kind + "_skipped", 0)
+                total = skipped + self.events.get(kind + "_downloaded", 0)
+                if total:
+                    lines.append({"metric": "skip_ratio", "kind": kind, "ratio": skipped / total})
+        return "".join(json.dumps(line, ensure_ascii=False) + "\n" for line in lines)
+
+    def to_prometheus(self) -> str:
+        """集計結果をPrometheusのtextfile形式の文字列にして返す。"""
+        def le(value:float) -> str:
+            return "+Inf" if value == float("inf") else str(value)
+
+        with self._lock:
+            lines = ["# TYPE fanbox_run_seconds gauge",
+                     "fanbox_run_seconds %f" % (monotonic() - self.started),
+                     "# TYPE fanbox_request_seconds histogram"]
+            for endpoint, buckets in self.requests.items():
+                lines += ['fanbox_request_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, le(b), n)
+                          for b, n in zip(self.BUCKETS, buckets)]
+                lines.append('fanbox_request_seconds_sum{endpoint="%s"} %f' % (endpoint, self.request_sums[endpoint]))
+                lines.append('fanbox_request_seconds_count{endpoint="%s"} %d' % (endpoint, buckets[-1]))
+            lines.append("# TYPE fanbox_transfer_bytes_total counter")
+            lines += ['fanbox_transfer_bytes_total{filetype="%s"} %d' % (k, v[0]) for k, v in self.transfers.items()]
+            lines.append("# TYPE fanbox_transfer_seconds_total counter")
+            lines += ['fanbox_transfer_seconds_total{filetype="%s"} %f' % (k, v[1]) for k, v in self.transfers.items()]
+            lines.append("# TYPE fanbox_phase_seconds_total counter")
+            lines += ['fanbox_phase_seconds_total{phase="%s"} %f' % (k, v) for k, v in self.phases.items()]
+            lines.append("# TYPE fanbox_events_total counter")
+            lines += ['fanbox_events_total{event="%s"} %d' % (k, v) for k, v in self.events.items()]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path:str, format:str="jsonl") -> None:
+        """
+        集計結果をファイルに書き出す。
+
+        formatが`jsonl`ならJSON Lines形式でファイルの末尾に追記し、
+        `prometheus`ならPrometheusのtextfile形式で丸ごと置き換えます。
+        """
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        if format == "prometheus":
+            # node_exporterが書きかけのファイルを読まないよう、別名で書いてから置き換える
+            with open(path + ".tmp", mode="wt", encoding="utf-8") as f:
+                f.write(self.to_prometheus())
+            os.replace(path + ".tmp", path)
+        else:
+            with open(path, mode="at", encoding="utf-8") as f:
+                f.write(self.to_json_lines())
+
+class Pipeline:
+    """
+    投稿データの取得とファイルのダウンロードを同時に進めるためのキューです。
+
+    put()で入れた処理を、バックグラウンドのスレッドが順番に実行します。
+    キューが一杯のときは空きができるまでput()が待つため、
+    投稿データの取得だけが先に進みすぎてメモリを使いすぎることはありません。
+    """
+    def __init__(self, workers:int=WORKERS, maxsize:int=QUEUE_SIZE):
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.errors: list[BaseException] = []
+        self.threads = [threading.Thread(target=self.__worker, daemon=True) for _ in range(max(1, workers))]
+        for t in self.threads:
+            t.start()
+
+    def __worker(self) -> None:
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None: return
+                func, args = task
+                func(*args)
+            except BaseException as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def put(self, func:Callable[..., Any], *args:Any) -> None:
+        """func(*args)の実行をキューに入れる。"""
+        self.queue.put((func, args))
+
+    def join(self) -> None:
+        """キューに入れた処理が全て終わるまで待ち、スレッドを終了させる。処理中に起きた例外は最初のものを投げ直す。"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+
+def fsync_path(path:str) -> None:
+    """ファイルまたはディレクトリの内容をディスクへ確実に書き込む。"""
+    fd = os.open(path, os.O_RDONLY if os.path.isdir(path) else os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DiskWriter:
+    """
+    ファイルの書き込みと、fsyncによるディスクへの反映を受け持つクラスです。
+
+    threadsが1以上のときは、stream()で受信したデータの書き込みを専用のスレッドで行うため、
+    ディスクが遅くても通信は待たされません（待つのはキューが一杯になったときだけ）。
+    書き終わったファイルはcommit()ですぐに本来の名前へ置き換え、fsyncはFSYNC_BATCH件かFSYNC_INTERVAL秒ごとに
+    まとめて行います。ディレクトリのfsyncも1回の中で1つにつき1度だけです。
+    after_sync()に渡した処理はそれまでのファイルのfsyncが済んでから呼ぶので、
+    インデックスにはディスクへ確実に書かれたファイルだけが記録されます。
+    処理し終える前に止まっても、インデックスに無いファイルは次回の実行でダウンロードし直されます。
+
+    threadsが0のときは全て呼び出したスレッドで行い、一時ファイルをfsyncしてから置き換えます。
+    commit()にwait=Trueを渡した場合も同じです。
+    durableがFalseのときはfsyncを行いません。
+    """
+    def __init__(self, threads:int=WRITER_THREADS, durable:bool=True, queue_size:int=WRITE_QUEUE_SIZE):
+        self.threads = max(0, threads)
+        self.durable = durable
+        self.queue_size = queue_size
+        self._queues: list[queue.Queue] = []
+        self._dirs: set[str] = set() # 作成済みのディレクトリ
+        self._pending: list[tuple[str|None, Callable[[], Any]|None]] = [] # fsync待ちのパスと、その後に呼ぶ処理
+        self._registered = 0 # _pendingに入れた数
+        self._synced = 0     # そのうち処理し終えた数
+        self._flushing = 0   # flush()で待っているスレッドの数
+        self._errors: list[BaseException] = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._started = False
+
+    def __start(self) -> None:
+        """書き込みとfsyncのスレッドを、初めて必要になった時点で起動する。"""
+        with self._lock:
+            if self._started: return
+            self._started = True
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.threads)]
+            for q in self._queues:
+                threading.Thread(target=self.__writer, args=(q,), daemon=True).start()
+            if self.durable:
+                threading.Thread(target=self.__syncer, daemon=True).start()
+
+    def makedirs(self, path:str) -> None:
+        """ディレクトリを作る。一度作ったディレクトリはファイルシステムに問い合わせ直さない。"""
+        key = os.path.abspath(path)
+        if key in self._dirs: return
+        os.makedirs(key, exist_ok=True)
+        with self._lock:
+            self._dirs.add(key)
+
+    @contextmanager
+    def stream(self, path:str, mode:str="wb") -> Iterator[Callable[[bytes], Any]]:
+        """
+        pathを開き、データを書き込む関数を返す。withを抜けるときに全て書き込み終わるまで待つ。
+
+        書き込みスレッドで起きた例外は、次の書き込みかwithを抜けるときに送出します。
+        同じパスへの書き込みは常に同じスレッドが順番に行います。
+        """
+        if not self.threads:
+            with open(path, mode=mode) as f:
+                yield f.write
+            return
+        self.__start()
+        q = self._queues[hash(path) % self.threads]
+        files, errors = [], []
+        done = threading.Event()
+
+        def run(func:Callable[[], Any]) -> Callable[[], None]:
+            def task() -> None:
+                if errors: return
+                try:
+                    func()
+                except BaseException as e:
+                    errors.append(e)
+            return task
+
+        def write(chunk:bytes) -> None:
+            if errors: raise errors[0]
+            q.put(run(lambda: files[0].write(chunk)))
+
+        def close() -> None:
+            try:
+                for f in files: f.close()
+            except BaseException as e:
+                errors.append(e)
+            done.set()
+
+        q.put(run(lambda: files.append(open(path, mode=mode))))
+        try:
+            yield write
+        finally:
+            q.put(close)
+            done.wait()
+        if errors: raise errors[0]
+
+    def commit(self, temppath:str, path:str, wait:bool=False) -> None:
+        """
+        書き終わった一時ファイルをpathへ置き換え、fsyncの予定に入れる。
+
+        waitがTrueのときは、一時ファイルをfsyncしてから置き換えるまでをこの場で行います。
+        after_sync()を待たずにすぐインデックスへ記録するファイル（投稿データなど）に使います。
+        """
+        if self.durable and (wait or not self.threads):
+            fsync_path(temppath)
+            os.replace(temppath, path)
+            self.__fsync_dirs([path])
+            return
+        os.replace(temppath, path)
+        self.sync(path)
+
+    def sync(self, path:str) -> None:
+        """既に書き終わっているファイルをfsyncの予定に入れる。"""
+        if not self.durable: return
+        if not self.threads:
+            fsync_path(path)
+            self.__fsync_dirs([path])
+            return
+        self.__push(path, None)
+
+    def after_sync(self, func:Callable[[], Any]) -> None:
+        """それまでにcommit()・sync()したファイルが全てディスクへ書かれてからfuncを呼ぶ。"""
+        if not (self.durable and self.threads):
+            func()
+            return
+        self.__push(None, func)
+
+    def __push(self, path:str|None, func:Callable[[], Any]|None) -> None:
+        self.__start()
+        with self._cond:
+            self._pending.append((path, func))
+            self._registered += 1
+            self._cond.notify_all()
+
+    def flush(self) -> None:
+        """予定に入っている全てのfsyncとafter_sync()の処理が終わるまで待つ。その間に起きた例外は最初のものを送出する。"""
+        with self._cond:
+            target = self._registered
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                self._cond.wait_for(lambda: self._synced >= target)
+            finally:
+                self._flushing -= 1
+            errors, self._errors = self._errors, []
+        if errors: raise errors[0]
+
+    def __writer(self, q:queue.Queue) -> None:
+        while True:
+            q.get()()
+
+    def __syncer(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._flushing or len(self._pending) >= FSYNC_BATCH,
+                                    timeout=FSYNC_INTERVAL)
+                batch, self._pending = self._pending, []
+            paths = [path for path, _ in batch if path is not None]
+            errors = []
+            for path in paths:
+                try:
+                    fsync_path(path)
+                except FileNotFoundError:
+                    pass # 既に別の場所へ移されている（移した先は別にsync()される）
+                except OSError as e:
+                    errors.append(e)
+            self.__fsync_dirs(paths)
+            for _, func in batch:
+                # fsyncに失敗したファイルがあれば記録しない（次回の実行でダウンロードし直される）
+                if func is None or errors: continue
+                try:
+                    func()
+                except Exception as e:
+                    errors.append(e)
+            with self._cond:
+                self._errors += errors
+                self._synced += len(batch)
+                self._cond.notify_all()
+
+    def __fsync_dirs(self, paths:list[str]) -> None:
+        """ファイルの名前の変更を確定させるため、親ディレクトリをfsyncする。"""
+        for dir in dict.fromkeys(os.path.dirname(os.path.abspath(p)) for p in paths):
+            try:
+                fsync_path(dir)
+            except OSError:
+                pass # ディレクトリをfsyncできない環境（Windowsや一部のネットワークファイルシステム）では諦める
+
+class FileJob(NamedTuple):
+    """ダウンロードするファイル1つ分の情報"""
+    url: str
+    path: str|None # 保存先のパス。外部サービスの埋め込み（embeds）はダウンロードしないためNone
+    name: str      # ログに表示する名前
+    post_id: str|None
+    filetype: str
+    size: int|None = None # 投稿データから分かる場合のファイルサイズ
+    published: str|None = None   # 投稿の公開日時（publishedDatetime）
+    fee_required: int|None = None # 投稿を見るのに必要な支援額。無料の投稿は0
+    adult: bool|None = None       # 成人向けの投稿かどうか
+
+class Scheduler:
+    """
+    ダウンロードするファイルの一覧を、方針に従って並べ替えたり絞り込んだりするクラスです。
+
+    ORDERSの方針で並べ替え、種類や投稿の条件で除外したファイルは一度も通信せずに飛ばします。
+    """
+    ORDERS = ("posts", "newest", "oldest", "smallest") # postsは投稿データ一覧の順（並べ替えない）
+
+    def __init__(self, order:str="posts", skip_types:Iterable[str]=(), ignore_free:bool=False,
+                 ignore_adult:bool=False, sizes:Callable[[str], float|None]|None=None):
+        """
+        Params
+        -------
+        order:
+            ORDERSのいずれか。newest・oldestは投稿の公開日時の順、smallestはファイルサイズの小さい順です。
+        skip_types:
+            ダウンロードしないファイルの種類（thumbnailsなど）。
+        ignore_free:
+            Trueなら無料の投稿のファイルをダウンロードしません。
+        ignore_adult:
+            Trueなら成人向けの投稿のファイルをダウンロードしません。
+        sizes:
+            サイズの分からないファイルの大きさを種類ごとに見積もる関数。smallestのときに使います。
+        """
+        if order not in self.ORDERS:
+            raise ValueError("並べ替えの方針が正しくありません。: %s" % order)
+        self.order = order
+        self.skip_types = set(skip_types)
+        self.ignore_free = ignore_free
+        self.ignore_adult = ignore_adult
+        self.sizes = sizes
+
+    def accepts(self, job:FileJob) -> bool:
+        """ファイルをダウンロードの対象にするかどうかを返す。投稿の情報が分からない場合は対象にします。"""
+        if job.filetype in self.skip_types: return False
+        if self.ignore_free and job.fee_required == 0: return False
+        if self.ignore_adult and job.adult: return False
+        return True
+
+    def schedule(self, jobs:list[FileJob]) -> list[FileJob]:
+        """対象外のファイルを除き、方針に従って並べ替えた一覧を返す。元の一覧は変更しません。"""
+        jobs = [job for job in jobs if self.accepts(job)]
+        if self.order == "newest":
+            # 公開日時の分からないもの（プロフィールなど）は最後に回す
+            return sorted(jobs, key=lambda job: job.published or "", reverse=True)
+        if self.order == "oldest":
+            return sorted(jobs, key=lambda job: (job.published is None, job.published or ""))
+        if self.order == "smallest":
+            estimates: dict[str, float] = {}
+            def size(job:FileJob) -> float:
+                if job.size is not None: return job.size
+                if job.filetype not in estimates:
+                    estimate = self.sizes(job.filetype) if self.sizes is not None else None
+                    estimates[job.filetype] = estimate if estimate is not None else float("inf")
+                return estimates[job.filetype]
+            return sorted(jobs, key=size)
+        return jobs
+
+def create_http_session(pool_size:int=WORKERS) -> requests.Session:
+    """
+    APIやファイルの取得に使うHTTPセッションを作ります。
+
+    複数のクリエイターや複数のスレッドで共有できるよう、
+    ホストごとにpool_size本までの接続を使い回せるようにしてあります。
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers = {
+        "accept"         : "application/json, text/plain, */*",
+        "accept-encoding": "gzip, deflate, br",
+        "accept-language": "ja,en-US;q=0.9,en;q=0.8",
+        "origin"         : "https://www.fanbox.cc",
+        "referer"        : "https://www.fanbox.cc/",
+        "user-agent"     : "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36"
+    }
+    return session
 
 class Session:
-    def __init__(self, creator_id:str, args:argparse.Namespace={}, FANBOXSESSID:str="", log_to_stdout:bool=False):
-        """APIと通信するための基本的な枠組みを提供する基底クラスです。"""
+    def __init__(self, creator_id:str, args:argparse.Namespace={}, FANBOXSESSID:str="", log_to_stdout:bool=False,
+                 limiter:RateLimiter|None=None, engine:DownloadEngine|None=None, index:Index|None=None,
+                 session:requests.Session|None=None, metrics:Metrics|None=None, writer:DiskWriter|None=None,
+                 bandwidth:list[BandwidthLimiter]|None=None, budget:Budget|None=None):
+        """
+        APIと通信するための基本的な枠組みを提供する基底クラスです。
+
+        Params
+        -------
+        limiter:
+            リクエストの頻度を制限するオブジェクト。省略した場合はRATE_LIMITERを共有します。
+        engine:
+            並行して通信するためのワーカープール。PostとFileで同じものを渡すと共有されます。
+        index:
+            ダウンロード済みのデータを記録するインデックス。省略した場合はBASE_LOCAL_DIRの直下のものを開きます。
+        session:
+            通信に使うHTTPセッション。複数のクリエイターで同じものを渡すと接続が使い回されます。
+            省略した場合はcreate_http_sessionで新しく作ります。
+        metrics:
+            所要時間などを記録するオブジェクト。複数のSessionで同じものを渡すとまとめて集計されます。
+        writer:
+            ファイルを書き込むオブジェクト。省略した場合は`--writer-threads`と`--no-fsync`に従って作ります。
+        bandwidth:
+            受信の速さを制限するオブジェクトのリスト。全て同時に満たすように待ちます。
+            省略した場合は`--limit-rate`と`--limit-rate-per-creator`に従って作ります。
+        budget:
+            受信量と実行時間の上限。複数のSessionで同じものを渡すと合計で数えます。
+            省略した場合は`--max-bytes`と`--max-duration`に従って作ります。
+        """
         self.creator_id = creator_id
         self.args = args
-        self.session = requests.Session()
-        if FANBOXSESSID: self.sessid = FANBOXSESSID
-        else: self.sessid = ""
-        self.session.headers = {
-            "accept"         : "application/json, text/plain, */*",
-            "accept-encoding": "gzip, deflate, br",
-            "accept-language": "ja,en-US;q=0.9,en;q=0.8",
-            "origin"         : "https://www.fanbox.cc",
-            "referer"        : "https://www.fanbox.cc/",
-            "user-agent"     : "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.102 Safari/537.36"
-        }
+        self.index = index if index is not None else Index()
+        self.index.ensure_indexed(creator_id)
+        self.limiter = limiter if limiter is not None else RATE_LIMITER
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.engine = engine if engine is not None else DownloadEngine(
+            workers=self._option("workers", WORKERS),
+            host_limit=self._option("host_limit", HOST_CONCURRENCY))
+        self.writer = writer if writer is not None else DiskWriter(
+            threads=self._option("writer_threads", WRITER_THREADS), durable=not self._option("no_fsync", False))
+        if bandwidth is None:
+            bandwidth = [BandwidthLimiter(rate) for rate in (self._option("limit_rate"),
+                                                              self._option("limit_rate_per_creator")) if rate]
+        self.bandwidth = bandwidth
+        self.budget = budget if budget is not None else Budget(
+            max_bytes=self._option("max_bytes"), max_seconds=self._option("max_duration"))
+        if session is not None:
+            self.session = session
+            if FANBOXSESSID: self.sessid = FANBOXSESSID
+        else:
+            self.session = create_http_session(pool_size=self.engine.workers)
+            self.sessid = FANBOXSESSID if FANBOXSESSID else ""
         self.is_print_log = log_to_stdout
 
     @property
@@ -67,6 +1305,184 @@ class Session:
         """FANBOXSESSID"""
         self.session.cookies.set("FANBOXSESSID", value, domain='.fanbox.cc')
     
+    def _option(self, name:str, default:Any=None) -> Any:
+        """コマンドライン引数の値を返す。指定されていなければdefaultを返す。"""
+        value = getattr(self.args, name, None)
+        return default if value is None else value
+
+    def _throttle(self, nbytes:int) -> float:
+        """
+        受信したバイト数を予算に記録し、bandwidthの上限を超えないよう待ちます。待った秒数を返します。
+
+        全てのBandwidthLimiterから差し引いた上で、その中で一番長い時間だけ待ちます。
+        """
+        self.budget.add(nbytes)
+        wait = max((limiter.reserve(nbytes) for limiter in self.bandwidth), default=0.0)
+        if wait > 0:
+            sleep(wait)
+            self.metrics.add_time("throttle", wait)
+        return wait
+
+    def _over_budget(self) -> bool:
+        """予算の上限に達しているかどうかを返す。初めて達したときはその旨をログに出す。"""
+        reason = self.budget.exceeded()
+        if reason is None: return False
+        if not self.metrics.events.get("budget_exceeded"):
+            self.metrics.count("budget_exceeded")
+            self._log("%s。残りは次回の実行で続きから取得します。" % reason)
+        return True
+
+    def _request(self, url:str, **kwargs) -> requests.Response:
+        """
+        GETリクエストを送ります。APIとの通信は全てここを通ります。
+
+        通信が切れた、タイムアウトした、429や5xxが返ってきたといった一時的な失敗の場合は、
+        指数バックオフで待ってから最大RETRY_LIMIT回まで再試行します。
+        Retry-Afterヘッダーがあればその時間は必ず待ちます。
+        429と503のときは全体のリクエストの頻度も下げ（RateLimiter.slow_down）、成功すると少しずつ戻します。
+
+        ホストごとの同時通信数の枠はここでは確保しないので、呼び出し側でengine.host_slot()を使ってください。
+
+        Return
+        -------
+        最後に受け取ったレスポンス。再試行しても成功しなかった場合はエラーのレスポンスを返すか、
+        最後に起きた例外を投げ直します。
+        """
+        endpoint = url[len(BASE_URL):] if url.startswith(BASE_URL) else "file"
+        kwargs.setdefault("timeout", (6.0, 12.0))
+        for attempt in range(RETRY_LIMIT + 1):
+            self.metrics.add_time("rate_limit", self.limiter.acquire())
+            started = perf_counter()
+            try:
+                r = self.session.get(url, **kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                self.metrics.add_time("network", perf_counter() - started)
+                if attempt == RETRY_LIMIT: raise
+                retry_after, reason = None, "例外: %s" % e
+            else:
+                elapsed = perf_counter() - started
+                self.metrics.observe_request(endpoint, elapsed)
+                if not kwargs.get("stream"): self.metrics.add_time("network", elapsed)
+                if r.status_code not in RETRY_STATUS:
+                    self.limiter.speed_up()
+                    return r
+                if r.status_code in (429, 503):
+                    self.limiter.slow_down()
+                if attempt == RETRY_LIMIT: return r
+                retry_after, reason = parse_retry_after(r.headers.get("retry-after")), "ステータスコード: %d" % r.status_code
+                r.close()
+            delay = backoff_delay(attempt, retry_after)
+            self._log("通信に失敗したため、%.1f秒後に再試行します。(%d/%d回目)"
+                      "　URL: %s　%s" % (delay, attempt+1, RETRY_LIMIT, url, reason))
+            self.metrics.count("retries")
+            self.metrics.add_time("backoff", delay)
+            sleep(delay)
+
+    def _conditional_headers(self, url:str, path:str|None=None) -> dict:
+        """
+        前回記録したETagとLast-Modifiedから、条件付きリクエストのヘッダーを作ります。
+
+        記録が無い場合は、pathのファイルの更新日時をIf-Modified-Sinceに使います。
+        どちらも無ければ空の辞書を返します。
+        """
+        headers = {}
+        validator = self.index.validator(url)
+        if validator is not None:
+            etag, last_modified = validator
+            if etag: headers["if-none-match"] = etag
+            if last_modified: headers["if-modified-since"] = last_modified
+        elif path is not None and os.path.isfile(path):
+            headers["if-modified-since"] = email.utils.formatdate(os.path.getmtime(path), usegmt=True)
+        return headers
+
+    def _search_latest_filename(self, path:str=BASE_LOCAL_DIR, pattern:str="") -> str:
+        """
+        指定したパターンに合致するファイルの中で一番新しいものを返します。
+
+        Params
+        --------
+        path:
+            検索するファイルが存在するディレクトリ。
+        pattern:
+            検索パターン。
+        """
+        def isfile(basedir, file) -> bool:
+            """パスがファイルかどうかを判別する"""
+            return os.path.isfile(os.path.join(basedir, file))
+        
+        files = os.listdir(path=path)
+        patten = re.compile(pattern)
+        files = [f for f in files if isfile(path, f) and bool(patten.match(f))]
+        if files:
+            return sorted(files, reverse=True)[0]
+        else:
+            raise FileNotFoundError(
+                "保存済みのファイルが見つかりませんでした。\n"
+                "　検索場所：%s\n"
+                "　検索パターン：%s"
+                % (path, pattern)
+            )
+
+    def get_postlist(self) -> list:
+        """最新の投稿一覧のデータを読み込み、そのデータを返します。"""
+        return load_json(self.__latest_postlist_path())
+
+    def get_profile(self) -> dict:
+        """最新のプロフィールデータを読み込み、そのデータを返します。"""
+        pattern = "^" + re.escape(self.creator_id) + r"_profile_\d{14}" + JSON_EXTENSION
+        filedir = os.path.join(BASE_LOCAL_PROFILE_DIR,
+                               self._search_latest_filename(path=BASE_LOCAL_PROFILE_DIR, pattern=pattern))
+        return load_json(filedir)
+
+    def iter_postlist(self) -> Iterator[dict]:
+        """
+        最新の投稿一覧のデータを、投稿1件ずつ読み込みながら返します。
+
+        get_postlistと違って一覧全体をメモリに載せないため、投稿数の多いクリエイターに向いています。
+        """
+        return iter_json_items(self.__latest_postlist_path())
+
+    def __latest_postlist_path(self) -> str:
+        pattern = "^" + re.escape(self.creator_id) + r"_\d{14}" + JSON_EXTENSION
+        return os.path.join(BASE_LOCAL_DIR, self._search_latest_filename(pattern=pattern))
+
+    def _save_snapshot(self, data:Any, parentdir:str, filename:str) -> str|None:
+        """
+        内容が前回保存したものから変わっている場合だけ、jsonを時刻入りのファイル名で保存します。
+
+        変わっていなかった場合は保存せず、確認した時刻だけをインデックスに記録します。
+
+        Params
+        -------
+        data:
+            保存するデータ。
+        parentdir:
+            保存先のディレクトリ。
+        filename:
+            保存するときのファイル名。`%s`はクリエイターID、`%d`は現在時刻に置き換えられます。
+            `.json`で終わる名前を渡すと、`--json-format`に合わせて拡張子が付け替えられます。
+
+        Return
+        -------
+        保存したファイル名。内容が変わっていなかった場合はNone。
+        """
+        args = (self.creator_id,) if "%s" in filename else ()
+        key = os.path.join(parentdir, filename.replace("%d", "*") % args)
+        sha256 = json_sha256(data)
+        if self.index.document_sha256(key) == sha256:
+            self.index.touch_document(key)
+            self.metrics.count("snapshots_unchanged")
+            return None
+        format = self._option("json_format", "json")
+        name = json_filename(filename % (*args, time_now()), data, format)
+        started = perf_counter()
+        # すぐにインデックスへ記録するので、記録する前にディスクへ書き終えておく
+        save_json(data, os.path.join(parentdir, name), compact=format != "json", writer=self.writer, wait=True)
+        self.metrics.add_time("disk", perf_counter() - started)
+        self.index.set_document(self.creator_id, key, sha256, name)
+        self.metrics.count("snapshots_written")
+        return name
+
     def _log(self, value:str, utc_add=9):
         """タイムスタンプをつけてログを出力する。"""
         if self.is_print_log:
@@ -75,18 +1491,64 @@ class Session:
 class Post(Session):
     """FANBOXの投稿の内、ファイル以外の要素（文章やページを構成するデータ）を取得するクラスです。"""
 
-    def download(self, page_limit:int|None = None) -> None:
-        "投稿データのダウンロードから保存までを全部自動でやってくれるありがたい関数。"
+    def download(self, page_limit:int|None = None,
+                 on_profile:Callable[[dict], None]|None = None,
+                 on_post:Callable[[str, dict|None], None]|None = None) -> None:
+        """
+        投稿データのダウンロードから保存までを全部自動でやってくれるありがたい関数。
+
+        Params
+        -------
+        on_profile:
+            プロフィール情報を取得した直後に呼ばれる関数。
+        on_post:
+            投稿データを1件処理するたびに、投稿IDと投稿データを渡して呼ばれる関数。
+            保存済みでダウンロードをスキップした投稿の場合、投稿データはNoneになります。
+            前回取得に失敗した投稿を再試行した場合も含め、1回の実行で同じ投稿について呼ばれるのは1回だけです。
+        """
+        if on_post is not None: on_post = self.__once_per_post(on_post)
+        # 前回取得に失敗した投稿データの再試行
+        self.retry_failed_posts(on_post=on_post)
         # クリエイター情報の取得
         data = self.get_creator_get()
-        self.save_postlist(data, parentdir=BASE_LOCAL_PROFILE_DIR, filename="%s_profile_%d.json")
+        if data:
+            self.save_postlist(data, parentdir=BASE_LOCAL_PROFILE_DIR, filename="%s_profile_%d.json")
+            if on_profile is not None: on_profile(data)
+        else:
+            self._log("プロフィール情報を取得できなかったため、保存をスキップしました。")
         # 投稿データ一覧の取得
         if page_limit is int:
             if page_limit == 0: return
-        data = self.download_postlist(self.get_paginateCreator(),limit=page_limit)
+        if self._over_budget(): return
+        paginate = self.get_paginateCreator()
+        if not paginate:
+            self._log("投稿データ一覧のページを取得できなかったため、投稿データの取得を中止します。")
+            self.metrics.count("postlist_failed")
+            return
+        if self._option("incremental", False):
+            data = self.download_postlist_incremental(paginate, limit=page_limit)
+        else:
+            data = self.download_postlist(paginate, limit=page_limit)
         self.save_postlist(data)
         # 投稿データのダウンロード＆保存
-        self.download_postdata_all(postlist=data)
+        self.download_postdata_all(postlist=data, on_post=on_post)
+
+    @staticmethod
+    def __once_per_post(on_post:Callable[[str, dict|None], None]) -> Callable[[str, dict|None], None]:
+        """
+        on_postを、同じ投稿IDでは1回しか呼ばないようにしたものを返す。
+
+        再試行で取得した投稿は、その後の投稿データ一覧の処理では保存済みとしてもう一度出てくるため、
+        そのまま呼ぶと同じファイルを2回ダウンロードしてしまいます。
+        """
+        done: set[str] = set()
+        lock = threading.Lock()
+        def call(id:str, data:dict|None) -> None:
+            with lock:
+                if id in done: return
+                done.add(id)
+            on_post(id, data)
+        return call
 
     def get_paginateCreator(self) -> dict:
         """post.paginateCreatorを叩いて全ページのURLを取得する。"""
@@ -106,94 +1568,187 @@ class Post(Session):
         self._log("プロフィール情報をダウンロード中...")
         url = BASE_URL+"creator.get"
         payload = {"creatorId": self.creator_id}
-        return self.__download_json(url, params=payload)
+        def cached() -> dict|None:
+            try:
+                return self.get_profile()
+            except (OSError, ValueError):
+                return None
+        return self.__download_json(url, cached=cached, params=payload)
 
     def __query_parse(self, url:str) -> dict[AnyStr]:
         """URLについているパラメータを返す"""
-        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
-        for k in query:
-            query[k] = query[k][0]
-        return query
-
-    def __download_json(self, url, **kwargs) -> dict:
-        """指定されたURLからJSONをダウンロードする。"""
-        r = self.session.get(url, **kwargs)
-        try:
-            r.raise_for_status()
-        except requests.RequestException as e:
-            print("Error: HTTP Status Code: " + str(r.status_code))
-            return {}
-        return r.json()
-
-    def __search_latest_filename(self, path:str=BASE_LOCAL_DIR, pattern:str="") -> str:
-        """
-        指定したパターンに合致するファイルの中で一番新しいものを返します。
-
-        Params
-        --------
-        path:
-            検索するファイルが存在するディレクトリ。
-        pattern:
-            検索パターン。
-        """
-        def isfile(basedir, file) -> bool:
-            """パスがファイルかどうかを判別する"""
-            return os.path.isfile(os.path.join(basedir, file))
-        
-        files = os.listdir(path=path)
-        patten = re.compile(pattern)
-        files = [f for f in files if isfile(path, f) and bool(patten.match(f))]
-        if files:
-            return sorted(files, reverse=True)[0]
-        else:
-            raise FileNotFoundError(
-                "保存済みのファイルが見つかりませんでした。\n"
-                "　検索場所：%s\n"
-                "　検索パターン：%s"
-                % (path, pattern)
-            )
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        for k in query:
+            query[k] = query[k][0]
+        return query
+
+    def __download_json(self, url, cached:Callable[[], dict|None]|None=None, **kwargs) -> dict:
+        """
+        指定されたURLからJSONをダウンロードする。再試行しても取得できなかった場合は空の辞書を返す。
+
+        cachedを渡すと、前回のETagやLast-Modifiedを使って条件付きリクエストを送ります。
+        304（変更無し）が返ってきた場合は、cachedが返す保存済みのデータをそのまま返します。
+        """
+        key = requests.Request("GET", url, params=kwargs.get("params")).prepare().url
+        headers = self._conditional_headers(key) if cached is not None else {}
+        try:
+            with self.engine.host_slot(url):
+                r = self._request(url, headers=headers, **kwargs)
+            if r.status_code == 304:
+                data = cached()
+                if data is not None:
+                    self.metrics.count("not_modified")
+                    return data
+                # 保存済みのデータを読み込めなかったので、条件を付けずに取り直す
+                self.index.remove_validator(key)
+                return self.__download_json(url, cached=cached, **kwargs)
+            r.raise_for_status()
+            self._throttle(len(r.content))
+            data = r.json()
+            if cached is not None:
+                self.index.set_validator(key, r.headers.get("etag"), r.headers.get("last-modified"))
+            return data
+        except (requests.RequestException, ValueError) as e:
+            self._log("Error: データの取得に失敗しました。"
+                      f"　URL: {url}"
+                      f"　例外: {e}")
+            return {}
 
     def download_postlist(self, paginate:dict, limit=None) -> list:
         """投稿データ一覧を全てダウンロードして返します。"""
+        def download_page(i:int) -> list:
+            self._log( "投稿データ一覧を取得中...(%d/%d件)" % (i+1, limit) )
+            param = self.__query_parse(paginate["body"][i])
+            return self.__page_items(self.get_listCreator(**param))
+
+        posts = []
+        if limit is None: limit = len(paginate["body"])
+        for items in self.engine.map(download_page, range(limit)):
+            posts += items
+        return posts
+
+    def download_postlist_incremental(self, paginate:dict, limit=None) -> list:
+        """
+        前回から追加・更新された投稿だけを取得し、前回の投稿データ一覧と合わせて返します。
+
+        新しい投稿のページから順にたどり、保存済みで更新日時も変わっていない投稿が
+        含まれるページまで来たところで取得をやめます。
+        それより古い投稿は、最後に保存した投稿データ一覧のものを使います。
+        """
         posts = []
         if limit is None: limit = len(paginate["body"])
         for i in range(limit):
             self._log( "投稿データ一覧を取得中...(%d/%d件)" % (i+1, limit) )
             param = self.__query_parse(paginate["body"][i])
-            posts += self.get_listCreator(**param)["body"]["items"]
-            sleep(WAIT_TIME/3)
-        return posts
+            items = self.__page_items(self.get_listCreator(**param))
+            posts += items
+            if any(self.__is_unchanged(item) for item in items):
+                self._log("保存済みの投稿まで取得したため、投稿データ一覧の取得を終了します。")
+                break
+        ids = {d["id"] for d in posts}
+        try:
+            previous = [d for d in self.iter_postlist() if d["id"] not in ids]
+        except FileNotFoundError:
+            previous = []
+        return posts + previous
 
-    def download_postdata_all(self, postlist:list) -> None:
-        """投稿データ一覧を元に投稿データを取得して保存します。"""
-        ids = [d["id"] for d in postlist]
-        for i, id in enumerate(ids):
-            filename = str(time_now()) + ".json"
-            filedir = os.path.join(BASE_LOCAL_DIR, self.creator_id, id, "post")
-            filepath = os.path.join(filedir, filename)
-            try:
-                self.__search_latest_filename(path=filedir, pattern="^\d{14}\.json$")
-            except FileNotFoundError:
-                pass
+    def __page_items(self, data:dict) -> list:
+        """post.listCreatorの結果から投稿の一覧を取り出す。取得に失敗していた場合は空のリストを返す。"""
+        if not data:
+            self._log("投稿データ一覧のページを取得できなかったため、このページは飛ばします。")
+            return []
+        return data["body"]["items"]
+
+    def __is_unchanged(self, item:dict) -> bool:
+        """投稿データ一覧の1件分を見て、その投稿が保存済みかつ前回から更新されていないかどうかを返す。"""
+        updated = self.index.post_updated_datetime(self.creator_id, item["id"])
+        return (updated is not None and updated == item.get("updatedDatetime")
+                and self.index.latest_snapshot(self.creator_id, item["id"]) is not None)
+
+    def download_postdata_all(self, postlist:list, on_post:Callable[[str, dict|None], None]|None = None) -> None:
+        """
+        投稿データ一覧を元に投稿データを取得して保存します。
+
+        on_postを渡すと、1件処理するたびに投稿IDと投稿データ（スキップした場合はNone）を渡して呼び出します。
+        """
+        def download(item:tuple[int, dict]) -> None:
+            i, post = item
+            id = post["id"]
+            if self._option("incremental", False):
+                # 更新日時が変わった投稿だけ取得し直す
+                skip = self.__is_unchanged(post)
             else:
-                if not self.args.update_posts:
-                    self._log("投稿データのダウンロードをスキップ(%d/%d件)" % (i+1, len(ids)))
-                    continue
+                skip = (self.index.latest_snapshot(self.creator_id, id) is not None
+                        and not self._option("update_posts", False))
+            if skip:
+                self.metrics.count("posts_skipped")
+                self._log("投稿データのダウンロードをスキップ(%d/%d件)" % (i+1, len(postlist)))
+                if on_post is not None: on_post(id, None)
+                return
+            if self._over_budget():
+                # 次回の実行で最初に取得する（--incrementalでも取りこぼさない）
+                self.metrics.count("posts_deferred")
+                self.index.add_retry("post", id, self.creator_id, post_id=id, error="予算の上限に達したため中断")
+                return
             
-            self._log("投稿データをダウンロード中...(%d/%d件)" % (i+1, len(ids)))
-            data = self.download_postdata(id)
-            save_json(data, filepath)
-            sleep(WAIT_TIME/3)
+            self._log("投稿データをダウンロード中...(%d/%d件)" % (i+1, len(postlist)))
+            data = self.__download_and_save_postdata(id)
+            if data is not None and on_post is not None: on_post(id, data)
+
+        self.engine.map(download, enumerate(postlist))
+
+    def retry_failed_posts(self, on_post:Callable[[str, dict|None], None]|None = None) -> None:
+        """
+        前回までの実行で取得に失敗した投稿データを、もう一度ダウンロードします。
+
+        on_postはdownload_postdata_allと同じく、取得できた投稿ごとに呼び出されます。
+        """
+        retries = self.index.retries(self.creator_id, "post")
+        def download(item:tuple[int, dict]) -> None:
+            i, retry = item
+            if self._over_budget(): return # 記録は残っているので次回の実行で再試行される
+            self._log("前回取得できなかった投稿データを再試行中...(%d/%d件)" % (i+1, len(retries)))
+            data = self.__download_and_save_postdata(retry["post_id"])
+            if data is not None and on_post is not None: on_post(retry["post_id"], data)
+
+        self.engine.map(download, enumerate(retries))
+
+    def __download_and_save_postdata(self, id:str) -> dict|None:
+        """
+        投稿データを取得して保存し、その投稿データを返します。
+
+        取得できなかった場合は次回の実行で再試行するよう記録してNoneを返します。
+        """
+        data = self.download_postdata(id)
+        if not data:
+            self.metrics.count("posts_failed")
+            self.index.add_retry("post", id, self.creator_id, post_id=id, error="post.infoの取得に失敗")
+            return None
+        self.metrics.count("posts_downloaded")
+        filedir = os.path.join(BASE_LOCAL_DIR, self.creator_id, id, "post")
+        filename = self._save_snapshot(data, filedir, "%d.json")
+        if filename is None:
+            self._log("投稿データに変更が無いため保存をスキップ(投稿ID: %s)" % id)
+            filename = self.index.latest_snapshot(self.creator_id, id)
+        self.index.add_snapshot(self.creator_id, id, filename, data["body"].get("updatedDatetime"))
+        self.index.remove_retry("post", id)
+        return data
 
     def download_postdata(self, id:list) -> dict:
         """投稿IDを元に投稿データを取得して返します。"""
         url = BASE_URL+"post.info"
         payload = {"postId":id}
-        return self.__download_json(url, params=payload)
+        def cached() -> dict|None:
+            filename = self.index.latest_snapshot(self.creator_id, id)
+            if filename is None: return None
+            return load_json_or_none(os.path.join(BASE_LOCAL_DIR, self.creator_id, id, "post", filename))
+        return self.__download_json(url, cached=cached, params=payload)
     
     def save_postlist(self, data:list, parentdir:str=BASE_LOCAL_DIR, filename="%s_%d.json") -> None:
         """
         ダウンロードした投稿データ一覧をローカルに保存します。
+
+        前回保存したものから内容が変わっていない場合は保存しません。
         
         Params
         -------
@@ -202,111 +1757,381 @@ class Post(Session):
         filename:
             保存するときのファイル名。
         """
-        filedir = os.path.join(parentdir, filename % (self.creator_id, time_now()))
-        save_json(data, filedir)
+        if self._save_snapshot(data, parentdir, filename) is None:
+            self._log("前回から変更が無いため保存をスキップしました。")
+
+EMBED_URLS = {
+    # 埋め込みのserviceProvider → 元のページのURL
+    "youtube"     : "https://www.youtube.com/watch?v=%s",
+    "vimeo"       : "https://vimeo.com/%s",
+    "soundcloud"  : "https://soundcloud.com/%s",
+    "twitter"     : "https://twitter.com/i/status/%s",
+    "google_forms": "https://docs.google.com/forms/d/e/%s/viewform",
+    "fanbox"      : "https://www.fanbox.cc/%s",
+}
+
+def embed_url(provider:str, content_id:str) -> str:
+    """動画や埋め込みのserviceProviderとIDから、元のページのURLを作る。知らないサービスは`<サービス名>:<ID>`を返す。"""
+    if provider in EMBED_URLS:
+        return EMBED_URLS[provider] % content_id
+    return "%s:%s" % (provider, content_id)
+
+def extract_post_urls(data:dict) -> dict:
+    """
+    投稿データからダウンロード可能なURL（主に画像やファイルのもの）を返します。
+
+    画像・ファイル・ブログ（article）タイプの画像とファイルに加えて、
+    ブログの埋め込み（embedMap・urlEmbedMap）、動画・音楽タイプの動画、
+    古い形式（entry）の本文中の画像にも対応しています。テキストタイプは本文しか無いため何も返しません。
+    埋め込みと動画は外部サービスのページのURLを`embed`として返すだけで、ダウンロードはしません。
+
+    Return
+    -------
+    ```json
+    {
+        "id"   :<post_id>,
+        "image":[<URL>],
+        "cover":[<URL>],
+        "thumb":[<URL>],
+        "file" :[<URL>],
+        "embed":[<URL>],
+        "size" :{<URL>:<バイト数>},
+        "published"   :<公開日時>,
+        "fee_required":<支援額>,
+        "adult"       :<成人向けかどうか>
+    }
+    ```
+    """
+    d = data["body"]
+    body = d["body"]
+    image, cover, thumb, file, embed = [], [], [], [], [] # 空であろうと必ずリスト型を保つ。
+    size = {}
+    if d.get("coverImageUrl") is not None:
+        cover += [d["coverImageUrl"]]
+    if body is not None: # bodyの中身が空の場合は何もしない。
+        if "files" in body:
+            file = [u["url"] for u in body["files"] if "url" in u]
+            size.update({u["url"]: u["size"] for u in body["files"] if "url" in u and "size" in u})
+        if "images" in body:
+            image = [u["originalUrl"] for u in body["images"] if "originalUrl" in u]
+            thumb = [u["thumbnailUrl"] for u in body["images"] if "thumbnailUrl" in u]
+        if "imageMap" in body:
+            image = [u["originalUrl"] for u in body["imageMap"].values() if "originalUrl" in u]
+            thumb = [u["thumbnailUrl"] for u in body["imageMap"].values() if "thumbnailUrl" in u]
+        if "fileMap" in body:
+            file = [u["url"] for u in body["fileMap"].values() if "url" in u]
+            size.update({u["url"]: u["size"] for u in body["fileMap"].values() if "url" in u and "size" in u})
+        if "embedMap" in body:
+            embed += [embed_url(u["serviceProvider"], u["contentId"]) for u in body["embedMap"].values()
+                      if "serviceProvider" in u and "contentId" in u]
+        if "urlEmbedMap" in body:
+            for u in body["urlEmbedMap"].values():
+                if "url" in u:
+                    embed.append(u["url"])
+                elif "html" in u:
+                    embed += re.findall(r'<iframe[^>]+src="([^"]+)"', u["html"])
+                elif u.get("type") == "fanbox.post" and "postInfo" in u:
+                    info = u["postInfo"]
+                    embed.append(embed_url("fanbox", "@%s/posts/%s" % (info.get("creatorId"), info.get("id"))))
+        if body.get("video"):
+            video = body["video"]
+            embed.append(embed_url(video.get("serviceProvider"), video.get("videoId")))
+        if "html" in body:
+            image += [u for u in re.findall(r'<img[^>]+src="([^"]+)"', body["html"]) if u not in image]
+    return {"id":d["id"], "image":image, "cover":cover, "thumb":thumb, "file":file, "embed":embed, "size":size,
+            "published":d.get("publishedDatetime"), "fee_required":d.get("feeRequired"),
+            "adult":d.get("hasAdultContent")}
+
+def plan_post(path:str) -> dict|None:
+    """
+    保存済みの投稿データを読み込み、extract_post_urlsの結果を返す。読み込めなければNoneを返す。
+
+    File.planが別のプロセスで呼び出すため、モジュールの関数にしてあります。
+    """
+    try:
+        return extract_post_urls(load_json(path))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+MAGIC_NUMBERS = {
+    # 拡張子 → ファイルの先頭のバイト列
+    ".jpeg": (b"\xff\xd8\xff",), ".jpg": (b"\xff\xd8\xff",),
+    ".png" : (b"\x89PNG\r\n\x1a\n",),
+    ".gif" : (b"GIF87a", b"GIF89a"),
+    ".webp": (b"RIFF",),
+    ".zip" : (b"PK\x03\x04", b"PK\x05\x06"),
+    ".pdf" : (b"%PDF",),
+    ".psd" : (b"8BPS",),
+}
+IMAGE_TRAILERS = {
+    # 拡張子 → 最後まで保存された画像の末尾にあるバイト列
+    ".jpeg": b"\xff\xd9", ".jpg": b"\xff\xd9", ".png": b"IEND\xaeB`\x82", ".gif": b";",
+}
+
+def verify_file(path:str, size:int|None=None, sha256:str|None=None) -> tuple[str|None, str|None]:
+    """
+    保存済みのファイルが壊れていないかを確認します。
+
+    サイズ、拡張子と中身の種類が合っているか、エラーページ（HTMLやJSON）が保存されていないか、
+    画像が最後まで保存されているか（Pillowがあれば読み込めるか）を確認し、SHA-256を計算します。
+    sizeやsha256を渡すと、それと一致するかも確認します。
+    File.verifyが別のプロセスで呼び出すため、モジュールの関数にしてあります。
+
+    Return
+    -------
+    (SHA-256, 問題の説明)。問題が無ければ説明はNone、ファイルが無ければSHA-256はNone。
+    """
+    try:
+        actual = os.path.getsize(path)
+    except OSError:
+        return None, "ファイルがありません"
+    digest = hash_file(path).hexdigest()
+    if actual == 0:
+        return digest, "空のファイルです"
+    if size is not None and actual != size:
+        return digest, "サイズが違います（%d/%dバイト）" % (actual, size)
+    if sha256 is not None and digest != sha256:
+        return digest, "SHA-256がダウンロードした時と違います"
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, mode="rb") as f:
+        head = f.read(64)
+        f.seek(max(0, actual - 64))
+        tail = f.read()
+    if ext in MAGIC_NUMBERS and not head.startswith(MAGIC_NUMBERS[ext]):
+        if head.lstrip()[:1] in (b"<", b"{"):
+            return digest, "エラーページ（HTMLやJSON）が保存されています"
+        return digest, "中身が拡張子（%s）と合いません" % ext
+    if ext in IMAGE_TRAILERS:
+        if Image is not None:
+            try:
+                with Image.open(path) as image:
+                    image.verify()
+            except Exception as e: # Pillowは壊れ方によって様々な例外を投げる
+                return digest, "画像として読み込めません（%s）" % e
+        elif IMAGE_TRAILERS[ext] not in tail.rstrip(b"\x00"):
+            return digest, "画像が最後まで保存されていません"
+    return digest, None
+
+def verify_task(task:tuple[str, int|None, str|None]) -> tuple[str|None, str|None]:
+    """verify_fileをexecutor.mapで呼び出すためのもの。"""
+    return verify_file(*task)
 
 class File(Session):
     """FANBOXの投稿の内、ファイルや画像を取得するクラスです。"""
+    NOT_MODIFIED = object() # __download_fileで、保存済みのファイルから変わっていなかったときに返す値
+    DEFERRED = object()     # __download_fileで、予算の上限に達したため受信を途中でやめたときに返す値
 
     def download(self):
         "添付ファイルのダウンロードから保存までを全部自動でやってくれるありがたい関数。"
-        data = self.get_profile()
-        self.download_files_on_profile(profiledata=data)
-        # data = self.get_postlist()
-        self.download_files_all()
+        self.retry_failed_files()
+        self.__download_jobs(self.plan())
     
-    def __search_latest_filename(self, path:str=BASE_LOCAL_DIR, pattern:str="") -> str:
-        """
-        指定したパターンに合致するファイルの中で一番新しいものを返します。
-
-        Params
-        --------
-        path:
-            検索するファイルが存在するディレクトリ。
-        pattern:
-            検索パターン。
-        """
-        def isfile(basedir, file) -> bool:
-            """パスがファイルかどうかを判別する"""
-            return os.path.isfile(os.path.join(basedir, file))
-        
-        files = os.listdir(path=path)
-        patten = re.compile(pattern)
-        files = [f for f in files if isfile(path, f) and bool(patten.match(f))]
-        if files:
-            return sorted(files, reverse=True)[0]
-        else:
-            raise FileNotFoundError(
-                "保存済みのファイルが見つかりませんでした。\n"
-                "　検索場所：%s\n"
-                "　検索パターン：%s"
-                % (path, pattern)
-            )
-        
     def get_postdata(self, postid:str) -> dict:
         """最新の投稿データを読み込み、そのデータを返します。"""
-        pattern = "^\d{14}\.json$"
+        return load_json(self.__postdata_path(postid))
+
+    def __postdata_path(self, postid:str) -> str:
+        """最新の投稿データのパスを返す。保存されていなければFileNotFoundErrorを送出する。"""
         parentdir = os.path.join(BASE_LOCAL_DIR, self.creator_id, postid, "post")
-        filename = self.__search_latest_filename(path=parentdir, pattern=pattern)
-        filedir = os.path.join(parentdir, filename)
-        with open(filedir, mode="rt", encoding="utf-8") as f:
-            return json.load(f)
-    
-    def get_postlist(self) -> dict:
-        """最新の投稿一覧のデータを読み込み、そのデータを返します。"""
-        pattern = "^" + re.escape(self.creator_id) + "_\d{14}\.json$"
-        filedir = os.path.join(BASE_LOCAL_DIR,
-                               self.__search_latest_filename(pattern=pattern))
-        with open(filedir, mode="rt", encoding="utf-8") as f:
-            return json.load(f)
+        filename = self.index.latest_snapshot(self.creator_id, postid)
+        if filename is None:
+            filename = self._search_latest_filename(path=parentdir, pattern=SNAPSHOT_PATTERN)
+        return os.path.join(parentdir, filename)
 
-    def get_profile(self) -> list:
-        """最新のプロフィールデータを読み込み、そのデータを返します。"""
-        pattern = "^" + re.escape(self.creator_id) + "_profile_\d{14}\.json$"
-        filedir = os.path.join(BASE_LOCAL_PROFILE_DIR,
-                               self.__search_latest_filename(path=BASE_LOCAL_PROFILE_DIR, pattern=pattern))
-        with open(filedir, mode="rt", encoding="utf-8") as f:
-            return json.load(f)
-    
-    def __extract_file_url(self, data:list) -> dict[str, list[str]]:
+    def plan(self) -> list[FileJob]:
         """
-        投稿データからダウンロード可能なURL（主に画像やファイルのもの）を返します。
-        
-        なお、ブログタイプの投稿に含まれるファイル・埋め込み、
-        テキストタイプ、動画・音楽タイプの投稿に含まれるファイルは未確認のため対応していません。
+        保存済みのプロフィールと投稿データを全て読み込み、ダウンロードするファイルの一覧（マニフェスト）を作ります。
+
+        通信は一切行いません。投稿ごとの一覧はインデックスに記録しておき、
+        最新の投稿データが前回から変わっていない投稿は、投稿データを読み込まずにその一覧を使います。
+        読み込む投稿データがPLAN_PARALLEL_THRESHOLD件以上のときは、
+        投稿データの読み込みとURLの抽出を複数のプロセスで並行して行います。
+        作った一覧は`BASE_LOCAL_DIR/<クリエイターID>_manifest.ndjson`にも保存します。
+        """
+        jobs = []
+        try:
+            jobs += self.__profile_file_jobs(self.get_profile())
+        except FileNotFoundError:
+            self._log("保存済みのプロフィールが見つからないため、プロフィールのファイルは一覧に含めません。")
+        posts: list[list[FileJob]|str] = [] # 投稿データ一覧の順に、投稿ごとのファイルの一覧か、読み込む投稿データのパス
+        post_ids: dict[str, str] = {} # 読み込む投稿データのパス → 投稿ID
+        for item in self.iter_postlist():
+            filename = self.index.latest_snapshot(self.creator_id, item["id"])
+            rows = self.index.post_jobs(self.creator_id, item["id"], filename) if filename is not None else None
+            if rows is not None:
+                posts.append([FileJob(**row) for row in rows])
+                continue
+            try:
+                posts.append(self.__postdata_path(item["id"]))
+                post_ids[posts[-1]] = item["id"]
+            except FileNotFoundError:
+                self._log("投稿(%s)の投稿データが保存されていないため、一覧に含めません。" % item["id"])
+        paths = [post for post in posts if isinstance(post, str)]
+        self._log("%d件の投稿データからファイルの一覧を作成中...（前回から変わっていない%d件はインデックスの一覧を使います）"
+                  % (len(paths), len(posts) - len(paths)))
+        results = dict(zip(paths, self.__process_map(plan_post, paths, PLAN_PARALLEL_THRESHOLD, chunksize=32)))
+        for post in posts:
+            if not isinstance(post, str):
+                jobs += post
+                continue
+            urls = results[post]
+            if urls is None:
+                self.__discard_snapshot(post_ids[post], post)
+                continue
+            post_jobs = self.__jobs_from_urls(urls)
+            self.index.set_post_jobs(self.creator_id, post_ids[post], os.path.basename(post),
+                                     [job._asdict() for job in post_jobs])
+            jobs += post_jobs
+        self.save_manifest(jobs)
+        return jobs
+
+    def __process_map(self, func:Callable[[Any], Any], items:list, threshold:int, chunksize:int=1) -> list:
+        """
+        itemsの数がthreshold以上なら複数のプロセスで、そうでなければこのプロセスでfuncを順番に呼び出します。
+
+        子プロセスを起動できなかった場合もこのプロセスで処理します。
+        """
+        if len(items) >= threshold:
+            try:
+                # fork後のスレッドの状態に左右されないよう、spawnで新しいプロセスを立ち上げる
+                with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as executor:
+                    return list(executor.map(func, items, chunksize=chunksize))
+            except (BrokenProcessPool, OSError) as e:
+                self._log("子プロセスを起動できなかったため、1つのプロセスで処理します。　例外: %s" % e)
+        return [func(item) for item in items]
+
+    def verify(self, full:bool=False) -> dict:
+        """
+        保存済みのファイルが壊れていないかを確認し、壊れていたものをダウンロードし直すよう記録します。
+
+        `BASE_LOCAL_DIR`と`BASE_LOCAL_PROFILE_DIR`以下のこのクリエイターのファイルが対象です。
+        前回確認した時からサイズと更新日時が変わっていないファイルは、fullがTrueでない限り確認しません。
+        確認はverify_fileで行い、ファイルの数がVERIFY_PARALLEL_THRESHOLD以上なら複数のプロセスで並行して行います。
+
+        壊れていたファイルは削除してインデックスからも消し、URLが分かるものは次回の実行で最初にダウンロードし直します。
 
         Return
         -------
         ```json
         {
-            "id"   :[<post_id>],
-            "image":[<URL>],
-            "cover":[<URL>],
-            "thumb":[<URL>],
-            "file" :[<URL>]
+            "checked" :<確認したファイルの数>,
+            "skipped" :<前回から変わっていないため確認しなかったファイルの数>,
+            "corrupt" :{<パス>:<問題の説明>}
         }
         ```
         """
+        try:
+            jobs = {Index.key(job.path): job for job in self.plan() if job.path is not None}
+        except FileNotFoundError:
+            jobs = {} # 投稿データ一覧が無くても、インデックスにあるファイルは確認する
+        tasks, rows, stats, skipped = [], [], [], 0
+        for row in self.index.files(self.creator_id):
+            path = row["path"]
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            if stat is not None and not full and self.index.is_verified(path, stat.st_size, stat.st_mtime_ns):
+                skipped += 1
+                continue
+            job = jobs.get(path)
+            tasks.append((path, job.size if job is not None else None, row["sha256"]))
+            rows.append(row)
+            stats.append(stat)
+        self._log("%d件のファイルを確認中...（前回から変わっていない%d件は確認しません）" % (len(tasks), skipped))
+        results = self.__process_map(verify_task, tasks, VERIFY_PARALLEL_THRESHOLD, chunksize=8)
+        corrupt = {}
+        for row, stat, (sha256, problem) in zip(rows, stats, results):
+            path = row["path"]
+            self.metrics.count("files_verified")
+            if problem is None:
+                self.index.set_verified(path, stat.st_size, stat.st_mtime_ns, sha256)
+                continue
+            self.metrics.count("files_corrupt")
+            self._log("壊れたファイルが見つかりました。: %s（%s）" % (path, problem))
+            corrupt[path] = problem
+            self.__discard_file(path, row["sha256"])
+            job = jobs.get(path)
+            url = job.url if job is not None else row["url"]
+            if url is not None:
+                # URLが分からないものも、インデックスから消したので次に一覧を作った時にダウンロードされる
+                self.index.add_retry("file", path, self.creator_id, url=url, path=path,
+                                     post_id=row["post_id"], filetype=row["filetype"], error=problem)
+        return {"checked": len(tasks), "skipped": skipped, "corrupt": corrupt}
+
+    def __discard_snapshot(self, postid:str, path:str) -> None:
+        """
+        読み込めない投稿データ（書き込みの途中で止まったものなど）を削除してインデックスから消し、
+        次回の実行で最初に取得し直すよう記録する。
+        """
+        self._log("投稿データを読み込めなかったため、次回の実行で取得し直します。: %s" % path)
+        self.index.remove_snapshot(self.creator_id, postid, os.path.basename(path))
+        self.index.add_retry("post", postid, self.creator_id, post_id=postid, error="保存済みの投稿データを読み込めない")
+        if os.path.isfile(path): os.remove(path)
+
+    def __discard_file(self, path:str, sha256:str|None) -> None:
+        """壊れたファイルを削除してインデックスから消す。`--blob-store`の実体も同じものなら削除する。"""
+        self.index.remove_file(path)
+        if not os.path.lexists(path): return
+        if sha256 is not None:
+            blob = blob_path(sha256)
+            if os.path.isfile(blob) and os.path.samefile(blob, path):
+                os.remove(blob)
+        os.remove(path)
+
+    def save_manifest(self, jobs:list[FileJob]) -> None:
+        """ファイルの一覧を`BASE_LOCAL_DIR/<クリエイターID>_manifest.ndjson`に保存します。"""
+        save_json([job._asdict() for job in jobs], self.__manifest_path(), writer=self.writer)
+
+    def __manifest_path(self) -> str:
+        return os.path.join(BASE_LOCAL_DIR, "%s_manifest.ndjson" % self.creator_id)
+
+    def summarize_plan(self, jobs:list[FileJob]) -> dict:
+        """
+        ファイルの一覧から、残りのダウンロード量と所要時間の目安を計算します。
 
-        d = data["body"]
-        body = d["body"]
-        image, cover, thumb, file = [], [], [], [] # 空であろうと必ずリスト型を保つ。
-        if d["coverImageUrl"] is not None:
-            cover += [d["coverImageUrl"]]
-        if body is not None: # bodyの中身が空の場合は何もしない。
-            if "files" in body:
-                file = [u["url"] for u in body["files"] if "url" in u]
-            if "images" in body:
-                image = [u["originalUrl"] for u in body["images"] if "originalUrl" in u]
-                thumb = [u["thumbnailUrl"] for u in body["images"] if "thumbnailUrl" in u]
-            if "imageMap" in body:
-                image = [u["originalUrl"] for u in body["imageMap"].values() if "originalUrl" in u]
-                thumb = [u["thumbnailUrl"] for u in body["imageMap"].values() if "thumbnailUrl" in u]
-            if "fileMap" in body:
-                file = [u["url"] for u in body["fileMap"].values() if "url" in u]
-            # if "embedMap" in body:
-            # if "urlEmbedMap" in body:
-        return {"id":d["id"], "image":image, "cover":cover, "thumb":thumb, "file":file}
+        サイズが分からないファイルは保存済みの同じ種類のファイルの平均サイズで見積もります。
+        所要時間はリクエストの頻度の制限と回線速度（この実行で計測したもの、無ければESTIMATED_BANDWIDTH）から求めます。
+
+        Return
+        -------
+        ```json
+        {
+            "files"          :<ファイルの数>,
+            "embeds"         :<外部サービスの埋め込みの数>,
+            "pending"        :<未保存のファイルの数>,
+            "requests"       :<必要なリクエストの数（同じURLは1回）>,
+            "known_bytes"    :<サイズが分かっている未保存のファイルの合計バイト数>,
+            "estimated_bytes":<未保存のファイルの合計バイト数の見積もり>,
+            "eta_seconds"    :<所要時間の目安（秒）>
+        }
+        ```
+        """
+        files = [job for job in jobs if job.path is not None]
+        pending = [job for job in files if not self.index.has_file(job.path)]
+        urls = {job.url: job for job in pending}
+        averages: dict[str, float] = {}
+        known, estimated = 0, 0.0
+        for job in urls.values():
+            if job.size is not None:
+                known += job.size
+                estimated += job.size
+            else:
+                if job.filetype not in averages:
+                    averages[job.filetype] = self.index.average_size(job.filetype) or 0.0
+                estimated += averages[job.filetype]
+        nbytes = sum(b for b, _ in self.metrics.transfers.values())
+        seconds = sum(s for _, s in self.metrics.transfers.values())
+        bandwidth = nbytes / seconds if nbytes and seconds else ESTIMATED_BANDWIDTH
+        return {
+            "files"          : len(files),
+            "embeds"         : len(jobs) - len(files),
+            "pending"        : len(pending),
+            "requests"       : len(urls),
+            "known_bytes"    : known,
+            "estimated_bytes": int(estimated),
+            "eta_seconds"    : len(urls) / self.limiter.max_rate + estimated / bandwidth
+        }
     
     def __extract_profile_url(self, data:list) -> dict[str, list[str]]:
         """
@@ -333,29 +2158,260 @@ class File(Session):
         thumb = [u["thumbnailUrl"] for u in body["profileItems"] if "thumbnailUrl" in u]
         return {"image":image, "cover":cover, "thumb":thumb, "icon":icon}
 
-    def __get_urls_len(self, urls:dict[str, dict[str, list[str]]]) -> int:
-        """URLをまとめた変数の中にある要素の数を数えます。"""
-        count = 0
-        if type(urls) is dict:
-            for v in urls.values():
-                count += self.__get_urls_len(v)
-        elif type(urls) is list:
-            for v in urls:
-                count += self.__get_urls_len(v)
-        elif type(urls) is str:
-            count += 1
-        return count
+    def __download_file(self, url:str, path:str, filetype:str="files", revalidate:bool=False) -> str|object|None:
+        """
+        URLのファイルを少しずつ読み込みながら保存します。
+
+        ファイル全体をメモリに載せないため、ファイルサイズに関わらず使用メモリは一定です。
+        受信中は`<path>.part`に書き込み、全て受信できた時点で`path`へリネームします。
+        書き込みはwriter（DiskWriter）に任せるため、書き込みスレッドがあれば受信はディスクを待ちません。
+        受信の途中で切断された場合は待機時間を置いてからRangeリクエストで続きを受信し直します。
+        それでも受信できなかった場合は`<path>.part`を残しておき、次回の実行で続きから受信します。
+
+        filetypeは所要時間などを集計するときの分類に使います。
+        revalidateがTrueのときは、保存済みのファイルについて前回のETagやLast-Modifiedで条件付きリクエストを送り、
+        変わっていなければ受信しません。
+
+        受信したバイト数はbandwidthの上限に収まるよう待ちながら受信し、budgetの上限に達したら
+        `<path>.part`を残して受信をやめます。
+
+        Return
+        -------
+        保存したファイルのSHA-256。変わっていなかった場合はNOT_MODIFIED、予算の上限で受信をやめた場合はDEFERRED、
+        保存に失敗した場合はNone。
+        """
+        for attempt in range(RETRY_LIMIT):
+            try:
+                return self.__receive_file(url, path, filetype, revalidate)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == RETRY_LIMIT - 1:
+                    self._log("通信が切断されました。"
+                              f"　URL: {url}"
+                              f"　例外: {e}")
+                    return None
+                delay = backoff_delay(attempt)
+                self._log("受信中に切断されたため、%.1f秒後に続きから受信し直します。(%d/%d回目)"
+                          % (delay, attempt+1, RETRY_LIMIT-1))
+                self.metrics.count("retries")
+                self.metrics.add_time("backoff", delay)
+                sleep(delay)
+
+    def __receive_file(self, url:str, path:str, filetype:str, revalidate:bool=False) -> str|object|None:
+        """
+        __download_fileの1回分の受信を行います。
+
+        受信中の切断はそのまま例外として送出します。
+        接続できなかった場合やタイムアウトした場合は_requestが既に再試行しているので、例外は送出せずにNoneを返します。
+        """
+        temppath = path + ".part"
+        metapath = temppath + ".json"
+        meta = self.__load_partial_meta(url, temppath, metapath)
+        offset = os.path.getsize(temppath) if meta else 0
+        restart = False
+        digest = hashlib.sha256()
+        headers = {"accept-encoding": "identity"} # Rangeのバイト位置がずれないよう圧縮させない
+        if offset:
+            headers["range"] = "bytes=%d-" % offset
+            validator = meta["etag"] if is_strong_etag(meta["etag"]) else meta["last_modified"]
+            if validator: headers["if-range"] = validator
+        elif revalidate:
+            headers.update(self._conditional_headers(url, path=path))
+        try:
+            with self.engine.host_slot(url):
+                try:
+                    r = self._request(url, headers=headers, stream=True)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                    # _requestで再試行し尽くしているので、ここでは再試行しない
+                    self._log("ファイルの取得に失敗しました。"
+                              f"　URL: {url}"
+                              f"　例外: {e}")
+                    return None
+                started = perf_counter()
+                with r:
+                    if r.status_code == 304 and not offset:
+                        return self.NOT_MODIFIED
+                    if not (r.status_code == 416 and offset and offset == meta["length"]):
+                        # 416で前回の時点で全て受信済みだった場合以外はここで受信する
+                        r.raise_for_status()
+                        if r.status_code == 206:
+                            if (content_range(r.headers.get("content-range")) != (offset, meta["length"])
+                                    or r.headers.get("etag", meta["etag"]) != meta["etag"]):
+                                # サーバー上のファイルが変わっているので最初からやり直す
+                                restart = True
+                                raise requests.HTTPError(response=r)
+                            self._log("前回の続きからダウンロードします。(%dバイト目から)" % offset)
+                            digest = hash_file(temppath)
+                            mode = "ab"
+                        else:
+                            length = r.headers.get("content-length")
+                            meta = {
+                                "url"          : url,
+                                "etag"         : r.headers.get("etag"),
+                                "last_modified": r.headers.get("last-modified"),
+                                "length"       : int(length) if length and length.isdigit() else None
+                            }
+                            save_json(meta, metapath, writer=self.writer)
+                            mode = "wb"
+                        chunk_size = self._option("chunk_size", CHUNK_SIZE)
+                        if self.bandwidth:
+                            # 大きな塊で受信してから長く止まらないよう、上限の0.1秒分ずつ受信する
+                            chunk_size = min(chunk_size, max(16*1024, int(min(limiter.rate for limiter in self.bandwidth) / 10)))
+                        received, disk, throttled, stopped = 0, 0.0, 0.0, False
+                        try:
+                            with self.writer.stream(temppath, mode=mode) as write:
+                                for chunk in r.iter_content(chunk_size=chunk_size):
+                                    written = perf_counter()
+                                    write(chunk) # 書き込みスレッドがあれば、キューに空きがある限りすぐに戻る
+                                    disk += perf_counter() - written
+                                    digest.update(chunk)
+                                    received += len(chunk)
+                                    throttled += self._throttle(len(chunk))
+                                    if self._over_budget():
+                                        stopped = True
+                                        break
+                                written = perf_counter() # 書き込みスレッドが書き終わるのを待つ時間もディスクの時間に含める
+                            disk += perf_counter() - written
+                        finally:
+                            network = perf_counter() - started - disk - throttled
+                            self.metrics.add_time("disk", disk)
+                            self.metrics.add_time("network", network)
+                            self.metrics.add_transfer(filetype, received, network)
+                        if stopped:
+                            return self.DEFERRED # `.part`を残しておき、次回の実行で続きから受信する
+                    else:
+                        digest = hash_file(temppath)
+        except requests.HTTPError as e:
+            for p in (temppath, metapath):
+                if os.path.isfile(p): os.remove(p)
+            if restart:
+                return self.__receive_file(url, path, filetype, revalidate)
+            self._log("ファイルの取得に失敗しました。"
+                      f"　ステータスコード: {e.response.status_code}")
+            return None
+        if meta["length"] is not None and os.path.getsize(temppath) != meta["length"]:
+            # 切断扱いにして続きから受信し直す
+            raise requests.exceptions.ChunkedEncodingError(
+                "受信済み: %d/%dバイト" % (os.path.getsize(temppath), meta["length"]))
+        self.writer.commit(temppath, path)
+        os.remove(metapath)
+        self.index.set_validator(url, meta["etag"], meta["last_modified"])
+        return digest.hexdigest()
+
+    def __store_blob(self, path:str, sha256:str) -> None:
+        """
+        ダウンロードしたファイルをSHA-256をファイル名にして保存し直し、元の場所にはリンクを作ります。
+
+        同じ内容のファイルが既にあれば、ダウンロードしたファイルは捨ててそちらへリンクします。
+        """
+        blob = blob_path(sha256)
+        self.writer.makedirs(os.path.dirname(blob))
+        if os.path.isfile(blob):
+            os.remove(path)
+        else:
+            self.writer.commit(path, blob)
+        link_file(blob, path)
+        self.writer.sync(path)
+
+    def __load_partial_meta(self, url:str, temppath:str, metapath:str) -> dict:
+        """
+        前回中断したダウンロードの情報を読み込みます。
+
+        続きから再開できない場合（途中のファイルが無い、URLが違うなど）は空の辞書を返します。
+        """
+        if not (os.path.isfile(temppath) and os.path.isfile(metapath)):
+            return {}
+        try:
+            with open(metapath, mode="rt", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if meta.get("url") != url:
+            return {}
+        if meta.get("length") is not None and os.path.getsize(temppath) > meta["length"]:
+            return {}
+        return meta
 
     def download_files_all(self) -> None:
         """最新の投稿一覧のデータを読み込み、全ての添付ファイルや画像等をダウンロードします。"""
-        postlist = self.get_postlist()
-        ids = [d["id"] for d in postlist]
-        for i, id in enumerate(ids):
-            self._log("投稿(%s)のダウンロードを開始(%d/%d件)" % (id, i+1, len(ids)))
-            self.download_files(postid=id)
+        self.__download_jobs([job for job in self.plan() if job.post_id is not None])
 
     def download_files(self, postid:str) -> None:
         """投稿データから添付ファイルや画像等をダウンロードします。"""
+        self.__download_jobs(self.__post_file_jobs(postid=postid))
+
+    def retry_failed_files(self) -> None:
+        """前回までの実行でダウンロードに失敗したファイルを、他のファイルより先にダウンロードし直します。"""
+        retries = self.index.retries(self.creator_id, "file")
+        if not retries: return
+        self._log("前回ダウンロードできなかったファイルを再試行します。(%d件)" % len(retries))
+        self.__download_jobs([FileJob(r["url"], r["path"], os.path.basename(r["path"]),
+                                      r["post_id"], r["filetype"]) for r in retries])
+
+    def schedule(self, jobs:list[FileJob]) -> list[FileJob]:
+        """
+        `--order`・`--skip-type`・`--ignore-free-posts`・`--ignore-adult-contents`に従って、
+        ファイルの一覧を並べ替え・絞り込みます。
+        """
+        scheduler = Scheduler(order=self._option("order", "posts") or "posts",
+                              skip_types=self._option("skip_type", None) or (),
+                              ignore_free=self._option("ignore_free_posts", False),
+                              ignore_adult=self._option("ignore_adult_contents", False),
+                              sizes=self.index.average_size)
+        return scheduler.schedule(jobs)
+
+    def queue_files(self, pipeline:Pipeline, postid:str, postdata:dict|None=None) -> None:
+        """
+        投稿に含まれるファイルの一覧を作り、ダウンロードをパイプラインに任せます。
+
+        Post.downloadのon_postに渡して使うことを想定しています。
+        パイプラインが終わった後にwriter.flush()を呼ぶまで、インデックスへの記録は終わっていないことがあります。
+        postdataを省略した場合（スキップした投稿）は、インデックスに記録したファイルの一覧を使うため、
+        投稿データが前回から変わっていなければ読み込みません。
+        """
+        self.__queue_jobs(pipeline, self.__post_file_jobs(postid=postid, postdata=postdata))
+
+    def queue_profile_files(self, pipeline:Pipeline, profiledata:dict) -> None:
+        """プロフィールに含まれるファイルのダウンロードをパイプラインに任せます。"""
+        self.__queue_jobs(pipeline, self.__profile_file_jobs(profiledata))
+
+    def __queue_jobs(self, pipeline:Pipeline, jobs:list[FileJob]) -> None:
+        """
+        ファイルの一覧を同じURLごとにまとめ、1つずつパイプラインに入れる。
+
+        パイプラインのスレッドからengine.mapを呼ぶと、engineのワーカーがput()で待っている間に
+        お互いを待ち続けてしまうため、ここでは必ずまとまりごとに直接パイプラインへ入れます。
+        """
+        jobs = [job for job in self.schedule(jobs) if job.path is not None]
+        for group in self.__group_jobs(jobs):
+            pipeline.put(self.__download_group, group, len(jobs))
+
+    def __post_file_jobs(self, postid:str, postdata:dict|None=None) -> list[FileJob]:
+        """
+        投稿データからダウンロードするファイルの一覧を作ります。
+
+        画像 → カバー画像 → サムネイル画像 → ファイル → 埋め込みの順に並びます。
+        postdataを省略した場合、最新の投稿データから作った一覧がインデックスにあればそれを使い、
+        無ければ保存済みの最新の投稿データを読み込みます。作った一覧はインデックスに記録します。
+        投稿データを読み込めなかった場合は空の一覧を返し、次回の実行で投稿データを取得し直します。
+        """
+        filename = self.index.latest_snapshot(self.creator_id, postid)
+        if postdata is None:
+            rows = self.index.post_jobs(self.creator_id, postid, filename) if filename is not None else None
+            if rows is not None: return [FileJob(**row) for row in rows]
+            path = self.__postdata_path(postid)
+            postdata, filename = load_json_or_none(path), os.path.basename(path)
+            if postdata is None:
+                self.__discard_snapshot(postid, path)
+                return []
+        jobs = self.__jobs_from_urls(extract_post_urls(postdata))
+        if filename is not None:
+            self.index.set_post_jobs(self.creator_id, postid, filename, [job._asdict() for job in jobs])
+        return jobs
+
+    def __jobs_from_urls(self, t:dict) -> list[FileJob]:
+        """extract_post_urlsの結果からファイルの一覧を作る。"""
         def __get_filetype_name(filetype:str) -> str:
             """filetypeから日本語の名前を返す"""
             if   filetype == "images":
@@ -366,94 +2422,474 @@ class File(Session):
                 return "サムネイル画像"
             elif filetype == "files":
                 return "ファイル"
+            elif filetype == "embeds":
+                return "埋め込み"
             else:
                 return "不明なファイル"
 
-        def save(urls:list[str], postid:str, filetype:str) -> None:
-            """画像をダウンロードして保存する"""
-            if not urls: return
-            dir = os.path.join(BASE_LOCAL_DIR, self.creator_id, postid, filetype)
-            os.makedirs(dir, exist_ok=True)
-            for url in urls:
-                if (os.path.isfile(os.path.join(dir, os.path.basename(url)))
-                        and not self.args.force_update):
-                    self._log("%sのダウンロードをスキップ" % __get_filetype_name(filetype))
-                    continue
-                self._log("%sをダウンロード中..." % __get_filetype_name(filetype))
-                try:
-                    r = self.session.get(url, timeout=(6.0, 12.0))
-                except requests.exceptions.Timeout:
-                    self._log("接続がタイムアウトしました。"
-                               "　URL: " + url)
-                    sleep(WAIT_TIME)
-                    continue
-                except ConnectionError as e:
-                    self._log("通信が切断されました。"
-                               f"　URL: {url}"
-                               f"　例外: {e}")
-                    sleep(WAIT_TIME)
-                    continue
-                
-                try:
-                    r.raise_for_status()
-                except requests.RequestException as e:
-                    self._log("ファイルの取得に失敗しました。"
-                              f"　ステータスコード: {str(r.status_code)}")
-                with open(os.path.join(dir, os.path.basename(url)), mode="wb") as f:
-                    f.write(r.content)
-                sleep(WAIT_TIME)
-
-        postdata = self.get_postdata(postid=postid)
-        t = self.__extract_file_url(data=postdata)
-        if self.__get_urls_len(t) == 0: return
-        os.makedirs(os.path.join(BASE_LOCAL_DIR, self.creator_id, postid), exist_ok=True)
-        save(t["image"], postid=t["id"], filetype="images")
-        save(t["cover"], postid=t["id"], filetype="cover")
-        save(t["thumb"], postid=t["id"], filetype="thumbnails")
-        save(t["file"], postid=t["id"], filetype="files")
-    
+        post = dict(published=t["published"], fee_required=t["fee_required"], adult=t["adult"])
+        jobs = []
+        for key, filetype in (("image", "images"), ("cover", "cover"),
+                              ("thumb", "thumbnails"), ("file", "files")):
+            dir = os.path.join(BASE_LOCAL_DIR, self.creator_id, t["id"], filetype)
+            jobs += [FileJob(url, os.path.join(dir, os.path.basename(url)),
+                             __get_filetype_name(filetype), t["id"], filetype, t["size"].get(url), **post)
+                     for url in t[key]]
+        jobs += [FileJob(url, None, __get_filetype_name("embeds"), t["id"], "embeds", **post)
+                 for url in t["embed"]]
+        return jobs
+
+    def __download_jobs(self, jobs:list[FileJob]) -> None:
+        """
+        ファイルの一覧を元に、既に保存済みのものを除いて並行してダウンロードします。
+
+        同じURLのファイルは1度だけダウンロードし、2つ目以降は通信せずに複製します。
+        `--blob-store`のときは複製の代わりにリンクを作り、
+        以前の実行で同じURLから保存したファイルがあればそれも使います。
+        外部サービスの埋め込み（保存先の無いもの）と、scheduleで対象外になったファイルは飛ばします。
+        """
+        jobs = [job for job in self.schedule(jobs) if job.path is not None]
+        self.engine.map(lambda group: self.__download_group(group, len(jobs)), self.__group_jobs(jobs))
+        self.writer.flush()
+
+    def __group_jobs(self, jobs:list[FileJob]) -> list[list[tuple[int, FileJob]]]:
+        """ファイルの一覧を、通し番号をつけた上で同じURLごとにまとめる。"""
+        groups: dict[str, list[tuple[int, FileJob]]] = {}
+        for i, job in enumerate(jobs):
+            groups.setdefault(job.url, []).append((i, job))
+        return list(groups.values())
+
+    def __download_group(self, group:list[tuple[int, FileJob]], total:int) -> None:
+        """同じURLのファイルをまとめて保存する。ダウンロードするのは最初の1つだけ。"""
+        force = self._option("force_update", False)
+        blob_store = self._option("blob_store", False)
+        saved = None # このURLから保存済みのファイルのパス
+        sha256 = self.index.url_sha256(group[0][1].url) if blob_store and not force else None
+        if sha256 is not None and os.path.isfile(blob_path(sha256)):
+            saved = blob_path(sha256)
+        for i, job in group:
+            # プロフィールの画像は同じURLのまま変わることがあるので、毎回条件付きリクエストで確認する
+            # 保存済みかどうかはインデックスで判断し、ファイルの有無は確認が必要なときだけ調べる
+            revalidate = ((force or (job.post_id is None and self.index.validator(job.url) is not None))
+                          and os.path.isfile(job.path))
+            if self.index.has_file(job.path) and not (force or revalidate):
+                self.metrics.count("files_skipped")
+                self._log("%sのダウンロードをスキップ(%d/%d件)" % (job.name, i+1, total))
+                saved = saved or job.path
+                continue
+            self.writer.makedirs(os.path.dirname(job.path))
+            if saved is not None:
+                self.metrics.count("files_copied")
+                self._log("%sは保存済みのファイルと同じため、通信せずに保存(%d/%d件)" % (job.name, i+1, total))
+                if blob_store:
+                    link_file(saved, job.path)
+                    self.writer.sync(job.path)
+                else:
+                    shutil.copyfile(saved, job.path + ".part")
+                    self.writer.commit(job.path + ".part", job.path)
+            elif self._over_budget():
+                self.metrics.count("files_deferred")
+                self.__add_retries(group, "予算の上限に達したため中断")
+                return
+            else:
+                self._log("%sを%s中...(%d/%d件)" % (job.name, "確認" if revalidate else "ダウンロード", i+1, total))
+                sha256 = self.__download_file(job.url, job.path, job.filetype, revalidate=revalidate)
+                if sha256 is self.NOT_MODIFIED:
+                    self.metrics.count("files_not_modified")
+                    self._log("%sは前回から変更されていません。(%d/%d件)" % (job.name, i+1, total))
+                    sha256 = self.index.url_sha256(job.url)
+                    saved = job.path
+                elif sha256 is self.DEFERRED:
+                    self.metrics.count("files_deferred")
+                    self.__add_retries(group, "予算の上限に達したため中断")
+                    return
+                elif sha256 is None:
+                    self.metrics.count("files_failed")
+                    self.__add_retries(group, "ファイルの取得に失敗")
+                    return
+                else:
+                    self.metrics.count("files_downloaded")
+                    if blob_store:
+                        self.__store_blob(job.path, sha256)
+                        saved = blob_path(sha256)
+                    else:
+                        saved = job.path
+            # ファイルがディスクへ確実に書かれてからインデックスに記録する
+            self.writer.after_sync(lambda job=job, sha256=sha256: self.__record_file(job, sha256))
+
+    def __add_retries(self, group:list[tuple[int, FileJob]], error:str) -> None:
+        """同じURLのファイルの内、まだ保存していないものを次回の実行で最初にダウンロードするよう記録する。"""
+        for _, job in group:
+            if self.index.has_file(job.path) and not self._option("force_update", False): continue
+            self.index.add_retry("file", job.path, self.creator_id, url=job.url, path=job.path,
+                                 post_id=job.post_id, filetype=job.filetype, error=error)
+
+    def __record_file(self, job:FileJob, sha256:str|None) -> None:
+        """保存し終えたファイルをインデックスに記録する。"""
+        self.index.add_file(job.path, self.creator_id, job.post_id, job.filetype, url=job.url, sha256=sha256)
+        self.index.remove_retry("file", job.path)
 
     def download_files_on_profile(self, profiledata:dict) -> None:
         """プロフィールに含まれるファイルをダウンロードします。"""
-        def save(urls:list[str], filetype:str, count:int) -> int:
-            """画像をダウンロードして保存する"""
-            if not urls: return count
-            dir = os.path.join(BASE_LOCAL_PROFILE_DIR, self.creator_id, filetype)
-            os.makedirs(dir, exist_ok=True)
-            for url in urls:
-                count += 1
-                if (os.path.isfile(os.path.join(dir, os.path.basename(url)))
-                        and not self.args.force_update):
-                    self._log("プロフィール画像のダウンロードをスキップ(%d/%d件)" % (count, max_count))
-                    continue
-                self._log("プロフィール画像をダウンロード中...(%d/%d件)" % (count, max_count))
-                try:
-                    r = self.session.get(url, timeout=(6.0, 12.0))
-                except requests.exceptions.Timeout:
-                    self._log("接続がタイムアウトしました。"
-                              f"　URL: {url}" )
-                    sleep(WAIT_TIME)
-                    continue
-                except ConnectionError as e:
-                    self._log("通信が切断されました。"
-                              f"　URL: {url}"
-                              f"　例外: {e}")
-                    sleep(WAIT_TIME)
-                    continue
-                try:
-                    r.raise_for_status()
-                except requests.RequestException as e:
-                    self._log("ファイルの取得に失敗しました。")
-                    self._log("　ステータスコード: " + str(r.status_code))
-                with open(os.path.join(dir, os.path.basename(url)), mode="wb") as f:
-                    f.write(r.content)
-                sleep(WAIT_TIME)
-            return count
-        count = 0
+        self.__download_jobs(self.__profile_file_jobs(profiledata))
+
+    def __profile_file_jobs(self, profiledata:dict) -> list[FileJob]:
+        """プロフィールデータからダウンロードするファイルの一覧を作ります。"""
         urls = self.__extract_profile_url(data=profiledata)
-        max_count = self.__get_urls_len(urls)
-        os.makedirs(os.path.join(BASE_LOCAL_PROFILE_DIR, self.creator_id), exist_ok=True)
-        count = save(urls["image"], filetype="images", count=count)
-        count = save(urls["cover"], filetype="cover", count=count)
-        count = save(urls["thumb"], filetype="thumbnails", count=count)
-        count = save(urls["icon"], filetype="icon", count=count)
+        jobs = []
+        for key, filetype in (("image", "images"), ("cover", "cover"),
+                              ("thumb", "thumbnails"), ("icon", "icon")):
+            dir = os.path.join(BASE_LOCAL_PROFILE_DIR, self.creator_id, filetype)
+            jobs += [FileJob(url, os.path.join(dir, os.path.basename(url)), "プロフィール画像", None, filetype)
+                     for url in urls[key]]
+        return jobs
+
+class SyncResult(NamedTuple):
+    """Orchestrator.runやsync_creatorが返す、クリエイター1人分の同期の結果"""
+    creator_id: str
+    error: str|None # 途中で失敗した場合はその内容。成功した場合はNone
+    seconds: float  # ファイルのダウンロードが全て終わるまでにかかった時間
+    posts_downloaded: int
+    posts_skipped: int
+    posts_failed: int
+    files_downloaded: int
+    files_skipped: int
+    files_not_modified: int
+    files_failed: int
+    bytes: int      # 受信したファイルの合計バイト数
+    posts_deferred: int = 0 # 予算の上限に達したため次回に回した件数
+    files_deferred: int = 0
+
+    @property
+    def ok(self) -> bool:
+        """最後まで同期できたかどうか。"""
+        return self.error is None
+
+    @classmethod
+    def from_metrics(cls, creator_id:str, metrics:Metrics, seconds:float, error:str|None=None) -> "SyncResult":
+        """クリエイター1人分のMetricsから結果を作る。"""
+        events = metrics.events
+        if error is None and events.get("postlist_failed"):
+            error = "投稿データ一覧を取得できませんでした"
+        return cls(creator_id, error, seconds,
+                   events.get("posts_downloaded", 0), events.get("posts_skipped", 0), events.get("posts_failed", 0),
+                   events.get("files_downloaded", 0),
+                   events.get("files_skipped", 0) + events.get("files_copied", 0),
+                   events.get("files_not_modified", 0), events.get("files_failed", 0),
+                   sum(int(nbytes) for nbytes, _ in metrics.transfers.values()),
+                   events.get("posts_deferred", 0), events.get("files_deferred", 0))
+
+    def describe(self) -> str:
+        """ログに出すための説明を返す。"""
+        text = ("%s: 投稿データ%d件・ファイル%d件（%.1fMB）をダウンロードしました。"
+                "（スキップ: 投稿データ%d件・ファイル%d件、変更無し%d件、失敗: 投稿データ%d件・ファイル%d件、%.1f秒）"
+                % (self.creator_id, self.posts_downloaded, self.files_downloaded, self.bytes / 1024**2,
+                   self.posts_skipped, self.files_skipped, self.files_not_modified,
+                   self.posts_failed, self.files_failed, self.seconds))
+        if self.posts_deferred or self.files_deferred:
+            text += ("\n予算の上限に達したため、投稿データ%d件・ファイル%d件は次回の実行で取得します。"
+                     % (self.posts_deferred, self.files_deferred))
+        if self.error is not None:
+            text += "\n途中でエラーが発生しました。: %s" % self.error
+        return text
+
+class Orchestrator:
+    """
+    複数のクリエイターをまとめてダウンロードするクラスです。
+
+    parallel人のクリエイターを同時に処理します。HTTPセッション（接続）、ワーカープール、
+    インデックス、リクエストの頻度の制限は全てのクリエイターで共有するため、
+    同時に処理する人数を増やしてもサーバーへのリクエストの頻度は変わりません。
+    """
+    def __init__(self, args:argparse.Namespace={}, FANBOXSESSID:str="", log_to_stdout:bool=False,
+                 parallel:int=1, workers:int=WORKERS, host_limit:int=HOST_CONCURRENCY,
+                 two_phase:bool=False, limiter:RateLimiter|None=None, index:Index|None=None,
+                 metrics:Metrics|None=None, writer:DiskWriter|None=None, limit_rate:float|None=None,
+                 limit_rate_per_creator:float|None=None, max_bytes:int|None=None, max_seconds:float|None=None):
+        """
+        Params
+        -------
+        parallel:
+            同時に処理するクリエイターの数。
+        workers:
+            全体で同時に行う通信の最大数。
+        host_limit:
+            1つのホストに対して同時に行う通信の最大数。
+        two_phase:
+            Trueなら、クリエイターごとに全ての投稿データを保存し終えてからファイルをダウンロードします。
+            Falseなら、投稿データを取得するそばからファイルのダウンロードを始めます。
+        writer:
+            ファイルを書き込むオブジェクト。省略した場合は書き込みスレッドをWRITER_THREADS個使い、fsyncも行います。
+        limit_rate:
+            全体で1秒あたりに受信してよいバイト数。Noneなら制限しません。
+        limit_rate_per_creator:
+            クリエイター1人あたりで1秒あたりに受信してよいバイト数。Noneなら制限しません。
+        max_bytes:
+            run()1回で受信してよいバイト数。超えたら続きは次回のrun()に回します。
+        max_seconds:
+            run()1回にかけてよい秒数。超えたら続きは次回のrun()に回します。
+        """
+        self.args = args
+        self.log_to_stdout = log_to_stdout
+        self.parallel = max(1, parallel)
+        self.limiter = limiter if limiter is not None else RATE_LIMITER
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.last_metrics: Metrics|None = None # 最後のrun()1回分の集計。metricsには全てのrun()の合計が入る
+        self.engine = DownloadEngine(workers=workers, host_limit=host_limit)
+        self.index = index if index is not None else Index()
+        self.writer = writer if writer is not None else DiskWriter()
+        self.bandwidth = BandwidthLimiter(limit_rate) if limit_rate else None # 全てのクリエイターで共有する
+        self.limit_rate_per_creator = limit_rate_per_creator
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.two_phase = two_phase
+        self.pipeline_workers = max(1, workers) # run()のたびに作るパイプラインのスレッド数
+        # ワーカープールとパイプラインの両方から同時に通信するので、その分の接続を用意しておく
+        pool_size = self.engine.workers + (0 if two_phase else self.pipeline_workers)
+        self.session = create_http_session(pool_size=pool_size)
+        if FANBOXSESSID:
+            self.session.cookies.set("FANBOXSESSID", FANBOXSESSID, domain='.fanbox.cc')
+
+    @classmethod
+    def from_options(cls, args:argparse.Namespace, FANBOXSESSID:str="", log_to_stdout:bool=False) -> "Orchestrator":
+        """
+        main.pyと同じ名前のオプション（workers、host_limit、parallel_creators、two_phase、writer_threads、no_fsync、
+        limit_rate、limit_rate_per_creator、max_bytes、max_duration）から作ります。
+        """
+        def option(name:str, default:Any) -> Any:
+            value = getattr(args, name, None)
+            return default if value is None else value
+        return cls(args=args, FANBOXSESSID=FANBOXSESSID, log_to_stdout=log_to_stdout,
+                   parallel=option("parallel_creators", 1), workers=option("workers", WORKERS),
+                   host_limit=option("host_limit", HOST_CONCURRENCY), two_phase=option("two_phase", False),
+                   writer=DiskWriter(threads=option("writer_threads", WRITER_THREADS),
+                                     durable=not option("no_fsync", False)),
+                   limit_rate=option("limit_rate", None), limit_rate_per_creator=option("limit_rate_per_creator", None),
+                   max_bytes=option("max_bytes", None), max_seconds=option("max_duration", None))
+
+    def __session_kwargs(self, creator_id:str, metrics:Metrics|None=None, budget:Budget|None=None) -> dict:
+        bandwidth = [self.bandwidth] if self.bandwidth is not None else []
+        if self.limit_rate_per_creator: bandwidth.append(BandwidthLimiter(self.limit_rate_per_creator))
+        return dict(creator_id=creator_id, args=self.args, log_to_stdout=self.log_to_stdout,
+                    limiter=self.limiter, engine=self.engine, index=self.index, session=self.session,
+                    metrics=metrics if metrics is not None else self.metrics, writer=self.writer,
+                    bandwidth=bandwidth, budget=budget if budget is not None else Budget())
+
+    def download_creator(self, creator_id:str, page_limit:int|None=None, pipeline:Pipeline|None=None,
+                         metrics:Metrics|None=None, budget:Budget|None=None) -> None:
+        """
+        1人のクリエイターの投稿データとファイルをダウンロードします。
+
+        pipelineを渡すと、投稿データを取得するそばからファイルのダウンロードをパイプラインに流します。
+        その場合、この関数が返った時点ではファイルのダウンロードは終わっていません。
+        metricsを渡すと、このクリエイターの集計はそちらに記録します。
+        budgetを渡すと、受信量と実行時間はそちらで数えます。省略した場合は制限しません。
+        """
+        if budget is not None and budget.exceeded() is not None:
+            self._log("%sのダウンロードは予算の上限に達したため次回の実行に回します" % creator_id)
+            return
+        self._log("%sのダウンロードを開始します" % creator_id)
+        kwargs = self.__session_kwargs(creator_id, metrics, budget)
+        post = Post(**kwargs)
+        if pipeline is not None:
+            file = File(**kwargs)
+            file.retry_failed_files()
+            post.download(page_limit=page_limit,
+                          on_profile=lambda data: file.queue_profile_files(pipeline, data),
+                          on_post=lambda id, data: file.queue_files(pipeline, id, data))
+            return
+        post.download(page_limit=page_limit)
+        if page_limit == 0: return
+        File(**kwargs).download()
+
+    def plan(self, creator_ids:Iterable[str]) -> dict[str, dict]:
+        """
+        保存済みの投稿データだけを使って、各クリエイターのファイルの一覧と残りのダウンロード量を求めます。
+
+        通信は一切行いません（`--dry-run`）。結果はクリエイターIDごとのFile.summarize_planの値です。
+        """
+        summaries = {}
+        for creator_id in creator_ids:
+            file = File(**self.__session_kwargs(creator_id))
+            try:
+                summary = file.summarize_plan(file.schedule(file.plan()))
+            except FileNotFoundError:
+                self._log("%sの投稿データ一覧が保存されていません。" % creator_id)
+                continue
+            self._log(
+                "%s: ファイル%d件（未保存%d件、リクエスト%d回）、埋め込み%d件\n"
+                "約%.1fMB（うちサイズが分かっているもの%.1fMB）、所要時間の目安は約%d分%02d秒です。"
+                % (creator_id, summary["files"], summary["pending"], summary["requests"], summary["embeds"],
+                   summary["estimated_bytes"] / 1024**2, summary["known_bytes"] / 1024**2,
+                   *divmod(int(summary["eta_seconds"]), 60)))
+            summaries[creator_id] = summary
+        return summaries
+
+    def verify(self, creator_ids:Iterable[str], full:bool=False) -> dict[str, dict]:
+        """
+        各クリエイターの保存済みのファイルが壊れていないかを確認します。通信は行いません。
+
+        壊れていたファイルは次回の実行でダウンロードし直されます。結果はクリエイターIDごとのFile.verifyの値です。
+        """
+        results = {}
+        for creator_id in creator_ids:
+            result = File(**self.__session_kwargs(creator_id)).verify(full=full)
+            self._log("%s: %d件確認し、%d件が壊れていました。（前回から変わっていない%d件は確認していません）"
+                      % (creator_id, result["checked"], len(result["corrupt"]), result["skipped"]))
+            results[creator_id] = result
+        return results
+
+    def run(self, creator_ids:Iterable[str], page_limit:int|None=None) -> dict[str, SyncResult]:
+        """
+        全てのクリエイターをダウンロードし、ファイルのダウンロードが全て終わるまで待ちます。
+
+        途中で失敗したクリエイターがいても、他のクリエイターのダウンロードは続けます。
+        max_bytesかmax_secondsの上限に達した場合は、そこまでで切り上げて続きを次回に回します。
+        何度でも呼び出せるため、同じOrchestratorでHTTPセッションやインデックスを使い回せます。
+
+        Return
+        -------
+        クリエイターIDごとのSyncResult。
+        """
+        creator_ids = list(dict.fromkeys(creator_ids))
+        pipeline = None if self.two_phase else Pipeline(workers=self.pipeline_workers)
+        run_metrics = Metrics()
+        metrics = {cid: Metrics() for cid in creator_ids}
+        budget = Budget(max_bytes=self.max_bytes, max_seconds=self.max_seconds)
+        errors: dict[str, str] = {}
+        started = monotonic()
+
+        def download(creator_id:str) -> None:
+            try:
+                self.download_creator(creator_id, page_limit, pipeline=pipeline, metrics=metrics[creator_id],
+                                      budget=budget)
+            except Exception as e:
+                errors[creator_id] = "%s: %s" % (type(e).__name__, e)
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            list(executor.map(download, creator_ids))
+        try:
+            if pipeline is not None: pipeline.join()
+            self.writer.flush()
+        except Exception as e:
+            # パイプラインではどのクリエイターのファイルで失敗したか分からないので、全員に記録する
+            for creator_id in creator_ids:
+                errors.setdefault(creator_id, "%s: %s" % (type(e).__name__, e))
+        seconds = monotonic() - started
+        results = {}
+        for creator_id in creator_ids:
+            run_metrics.merge(metrics[creator_id])
+            results[creator_id] = SyncResult.from_metrics(creator_id, metrics[creator_id], seconds,
+                                                          errors.get(creator_id))
+        self.metrics.merge(run_metrics)
+        self.last_metrics = run_metrics
+        return results
+
+    def _log(self, value:str) -> None:
+        """log_to_stdoutがTrueのときだけ、タイムスタンプをつけてログを出力する。"""
+        if self.log_to_stdout:
+            print_with_timestamp(value)
+
+    def close(self) -> None:
+        """書き込み待ちのファイルを反映してから、ワーカープールやインデックス、HTTPセッションを閉じる。"""
+        try:
+            self.writer.flush()
+        finally:
+            self.engine.shutdown()
+            self.index.close()
+            self.session.close()
+
+async def sync_creator(creator_id:str, orchestrator:Orchestrator|None=None, page_limit:int|None=None,
+                       FANBOXSESSID:str="", **options:Any) -> SyncResult:
+    """
+    クリエイター1人分の投稿データとファイルを同期し、結果を返します。ライブラリとして使うための入り口です。
+
+    ```python
+    result = await fanbox.sync_creator("creator_id", incremental=True)
+    ```
+
+    通信は別のスレッドで行うため、イベントループは止まりません。
+    orchestratorを渡すと、そのHTTPセッションやインデックスを使い回します。
+    省略した場合はその場で作り、終わったら閉じます。
+    optionsにはmain.pyのオプションと同じ名前（incremental、workersなど）を指定できます。
+    """
+    results = await sync_creators([creator_id], orchestrator=orchestrator, page_limit=page_limit,
+                                  FANBOXSESSID=FANBOXSESSID, **options)
+    return results[creator_id]
+
+async def sync_creators(creator_ids:Iterable[str], orchestrator:Orchestrator|None=None, page_limit:int|None=None,
+                        FANBOXSESSID:str="", **options:Any) -> dict[str, SyncResult]:
+    """複数のクリエイターをまとめて同期し、クリエイターIDごとの結果を返します。引数はsync_creatorと同じです。"""
+    if orchestrator is not None:
+        return await _run_in_thread(orchestrator, list(creator_ids), page_limit)
+    orchestrator = Orchestrator.from_options(argparse.Namespace(**options), FANBOXSESSID)
+    try:
+        return await _run_in_thread(orchestrator, list(creator_ids), page_limit)
+    finally:
+        orchestrator.close()
+
+async def watch(creators:Iterable[str]|Callable[[], Iterable[str]], interval:float=WATCH_INTERVAL,
+                jitter:float=WATCH_JITTER, orchestrator:Orchestrator|None=None, page_limit:int|None=None,
+                on_result:Callable[[SyncResult], None]|None=None,
+                on_cycle:Callable[[dict[str, SyncResult]], None]|None=None, FANBOXSESSID:str="", **options:Any) -> None:
+    """
+    購読しているクリエイターを定期的に同期し続けます（デーモンモード）。止めるにはタスクをキャンセルしてください。
+
+    HTTPセッション、インデックス、ワーカープールを作ったまま使い回すため、
+    毎回起動し直すよりも少ない手間で同期できます。`incremental=True`と一緒に使うのがおすすめです。
+    各クリエイターの次の同期は、intervalの前後jitterの割合だけランダムにずらして、
+    同期が一度に集中しないようにします。
+
+    Params
+    -------
+    creators:
+        購読しているクリエイターのID。関数を渡すと同期のたびに呼び出して読み直します。
+    on_result:
+        クリエイター1人の同期が終わるたびに、そのSyncResultを渡して呼び出されます。
+    on_cycle:
+        1回の同期（その時点で同期する時刻になっていた全員分）が終わるたびに、
+        クリエイターIDごとのSyncResultを渡して呼び出されます。その回の集計はorchestrator.last_metricsにあります。
+    """
+    own = orchestrator is None
+    if own: orchestrator = Orchestrator.from_options(argparse.Namespace(**options), FANBOXSESSID)
+    due: dict[str, float] = {} # クリエイターID → 次に同期する時刻
+    try:
+        while True:
+            creator_ids = list(creators() if callable(creators) else creators)
+            now = monotonic()
+            due = {cid: due.get(cid, now) for cid in creator_ids}
+            ready = [cid for cid in creator_ids if due[cid] <= now]
+            if ready:
+                results = await _run_in_thread(orchestrator, ready, page_limit)
+                for cid, result in results.items():
+                    due[cid] = monotonic() + interval * random.uniform(1 - jitter, 1 + jitter)
+                    if on_result is not None: on_result(result)
+                if on_cycle is not None: on_cycle(results)
+            wait = min(due.values(), default=monotonic() + interval) - monotonic()
+            await asyncio.sleep(max(0.0, wait))
+    finally:
+        if own: orchestrator.close()
+
+async def _run_in_thread(orchestrator:Orchestrator, creator_ids:list[str], page_limit:int|None) -> dict[str, SyncResult]:
+    """
+    orchestrator.runを別のスレッドで実行する。
+
+    キャンセルされてもスレッドは途中で止められないので、終わるのを待ってからキャンセルを伝える。
+    """
+    running = asyncio.ensure_future(asyncio.to_thread(orchestrator.run, creator_ids, page_limit))
+    try:
+        return await asyncio.shield(running)
+    except asyncio.CancelledError:
+        orchestrator._log("実行中の同期が終わるのを待っています...")
+        await asyncio.wait([running])
+        raise
+
+def read_creator_file(path:str) -> list[str]:
+    """
+    クリエイターIDを1行に1つずつ書いたファイルを読み込みます。
+
+    空行と`#`から始まる行は無視します。
+    """
+    with open(path, mode="rt", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith("#")]
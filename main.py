@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 from ast import arg
+import os
 import sys
+import asyncio
 import argparse
 
 import fanbox
@@ -13,35 +15,109 @@ module_description='''
 #やけにオプション引数が多い（TODO代わり）
 parser = argparse.ArgumentParser(description=module_description, formatter_class=argparse.RawDescriptionHelpFormatter)
 parser.add_argument("-s", "--session-id", type=str, help="FANBOXSESSID（FANBOXのセッションID）を設定します。有料プランの投稿をダウンロードするには必須です。")
-parser.add_argument("-f", "--force-update", action="store_true", help="以前ダウンロードしたコンテンツも上書きして再ダウンロードします。")
-parser.add_argument("-P", "--update-posts", action="store_true", help="ダウンロードしたことのある投稿データを再ダウンロードします。前回のファイルを上書きせずに別のファイルとして保存されます。")
+parser.add_argument("-f", "--force-update", action="store_true", help="以前ダウンロードしたファイルもサーバー上で変更されていないか確認し、変更されていたものだけ再ダウンロードします。確認には前回のETagやLast-Modified（無ければファイルの更新日時）を使うため、変更の無いファイルは受信しません。")
+parser.add_argument("-P", "--update-posts", action="store_true", help="ダウンロードしたことのある投稿データを再ダウンロードします。前回のファイルを上書きせずに別のファイルとして保存されます。内容が変わっていない場合は保存しません。")
+parser.add_argument("-i", "--incremental", action="store_true", help="前回から追加・更新された投稿だけを取得します。保存済みの投稿に行き着いた時点で投稿データ一覧の取得をやめ、更新日時が変わった投稿だけ投稿データを再ダウンロードします。")
 # parser.add_argument("-b", "--before-id", type=int, help="指定した投稿ID以前（その投稿も含む）の投稿をダウンロードします。")
+parser.add_argument("--chunk-size", type=int, help="ファイルのダウンロード時に一度に読み込むバイト数。省略した場合は1MiBです。")
+parser.add_argument("--blob-store", action="store_true", help="ファイルの実体を内容のSHA-256ごとに./blobs/へ1つだけ保存し、投稿ごとのディレクトリにはリンクを作ります。同じURLのファイルは再ダウンロードしません。")
+parser.add_argument("--json-format", choices=fanbox.JSON_FORMATS, default="json", help="投稿データ一覧や投稿データを保存する形式。jsonは字下げ付き、ndjsonは投稿データ一覧を1行に1件ずつ改行無しで、gzipはndjsonをさらに圧縮して保存します。どの形式で保存したファイルも読み込めます。（デフォルト: %(default)s）")
+parser.add_argument("--two-phase", action="store_true", help="全ての投稿データを保存し終えてから、保存した投稿データを読み直してファイルをダウンロードします。省略した場合は投稿データを取得するそばからファイルのダウンロードを始めます。")
+parser.add_argument("-w", "--workers", type=int, default=fanbox.WORKERS, help="同時に行う通信の最大数。リクエストの頻度は変わりません。（デフォルト: %(default)s）")
+parser.add_argument("--host-limit", type=int, default=fanbox.HOST_CONCURRENCY, help="1つのホストに対して同時に行う通信の最大数。（デフォルト: %(default)s）")
+parser.add_argument("--writer-threads", type=int, default=fanbox.WRITER_THREADS, help="受信したファイルをディスクに書き込むスレッドの数。0にすると受信したスレッドでそのまま書き込みます。（デフォルト: %(default)s）")
+parser.add_argument("--no-fsync", action="store_true", help="保存したファイルをfsyncしません。速くなりますが、停電などで止まった場合にインデックスに記録済みのファイルが壊れていることがあります。")
+parser.add_argument("--limit-rate", type=fanbox.parse_size, metavar="BYTES", help="全体で1秒あたりに受信するバイト数の上限。500Kや2Mのように単位を付けられます。省略した場合は制限しません。")
+parser.add_argument("--limit-rate-per-creator", type=fanbox.parse_size, metavar="BYTES", help="投稿者1人あたりで1秒あたりに受信するバイト数の上限。--limit-rateと一緒に指定した場合は両方を守ります。")
+parser.add_argument("--max-bytes", type=fanbox.parse_size, metavar="BYTES", help="1回の実行で受信するバイト数の上限。達した時点で切り上げ、残りは次回の実行で続きから取得します。1Gのように単位を付けられます。")
+parser.add_argument("--max-duration", type=float, metavar="SECONDS", help="1回の実行にかける時間の上限（秒）。達した時点で切り上げ、残りは次回の実行で続きから取得します。--watchのときは同期1回ごとの上限です。")
+parser.add_argument("-c", "--creator-file", type=str, help="投稿者のIDを1行に1つずつ書いたファイル。コマンドラインで指定した投稿者に追加されます。")
+parser.add_argument("-j", "--parallel-creators", type=int, default=1, help="同時にダウンロードする投稿者の数。接続とリクエストの頻度の制限は全ての投稿者で共有されます。（デフォルト: %(default)s）")
 parser.add_argument("-l", "--page-limit", type=int, help="1投稿者あたりの取得ページ数。省略した場合は可能な限り取得します。")
-# parser.add_argument("--ignore-free-posts", action="store_true", help="無料の投稿に含まれる画像はダウンロードしません。")
-# parser.add_argument("--ignore-adult-contents", action="store_true", help="成人向けの投稿に含まれる画像はダウンロードしません。")
-parser.add_argument("creator_id", nargs="+", type=str, help="投稿者のID")
-
-if len(sys.argv) <= 1:
-    parser.print_help()
-    exit()
-args = parser.parse_args()
-
-if args.session_id is None:
-    sessid = ""
-else:
-    sessid = args.session_id
-if args.page_limit is None:
-    limit = None
-else:
-    limit = args.page_limit if args.page_limit >= 0 else 0
-
-for cid in args.creator_id:
-    fanbox.print_with_timestamp("%sのダウンロードを開始します" % cid)
-    fb = fanbox.Post(creator_id=cid, args=args, FANBOXSESSID=sessid, log_to_stdout=True)
-    fb.download(page_limit=limit)
-    sessid = fb.sessid
-    if limit is int:
-        if limit == 0: continue
-    fb = fanbox.File(creator_id=cid, args=args, FANBOXSESSID=sessid, log_to_stdout=True)
-    fb.download()
-    sessid = fb.sessid
+parser.add_argument("--ignore-free-posts", action="store_true", help="無料の投稿に含まれる画像やファイルはダウンロードしません。")
+parser.add_argument("--ignore-adult-contents", action="store_true", help="成人向けの投稿に含まれる画像やファイルはダウンロードしません。")
+parser.add_argument("--skip-type", action="append", choices=["images", "cover", "thumbnails", "files", "icon"], help="指定した種類のファイルはダウンロードしません。複数回指定できます。thumbnailsは画像を縮小したものです。")
+parser.add_argument("--order", choices=fanbox.Scheduler.ORDERS, default="posts", help="ファイルをダウンロードする順番。postsは投稿データ一覧の順、newest・oldestは投稿の公開日時の順、smallestはサイズの小さい順です。--two-phaseを指定しない場合は、投稿ごとのファイルの中だけで並べ替えます。（デフォルト: %(default)s）")
+parser.add_argument("--metrics-file", type=str, help="実行の最後に、APIの応答時間や通信量などの集計結果をこのファイルに書き出します。--watchのときは同期が1回終わるたびに書き出します。")
+parser.add_argument("--metrics-format", choices=["jsonl", "prometheus"], default="jsonl", help="集計結果の形式。jsonlは追記、prometheusはnode_exporterのtextfile形式で置き換えます。（デフォルト: %(default)s）")
+parser.add_argument("--watch", type=float, metavar="SECONDS", help="終了せずに、指定した秒数ごとに投稿者を同期し続けます（--incrementalが自動で有効になります）。-cで指定したファイルは同期のたびに読み直します。Ctrl+Cで終了します。")
+parser.add_argument("--watch-jitter", type=float, default=fanbox.WATCH_JITTER, help="--watchの間隔をランダムにずらす割合。0.1なら間隔の±10%%です。（デフォルト: %(default)s）")
+parser.add_argument("--dry-run", action="store_true", help="通信せずに、保存済みの投稿データからダウンロードするファイルの一覧を作り、残りのダウンロード量と所要時間の目安を表示して終了します。一覧は./posts/<投稿者のID>_manifest.ndjsonに保存されます。")
+parser.add_argument("--verify", action="store_true", help="通信せずに、保存済みのファイルが壊れていないか（サイズ、中身の種類、画像が最後まで保存されているか、SHA-256）を確認して終了します。壊れていたファイルは削除され、次回の実行で最初にダウンロードし直されます。前回確認した時から変わっていないファイルは、--force-updateを付けない限り確認しません。投稿者のIDを省略した場合は保存済みの全ての投稿者が対象です。")
+parser.add_argument("--reindex", action="store_true", help="保存済みのファイルからインデックスを作り直して終了します。投稿者のIDを省略した場合は保存済みの全ての投稿者が対象です。")
+parser.add_argument("creator_id", nargs="*", type=str, help="投稿者のID")
+
+def main() -> None:
+    if len(sys.argv) <= 1:
+        parser.print_help()
+        return
+    args = parser.parse_args()
+
+    if args.reindex:
+        index = fanbox.Index()
+        for cid in args.creator_id or fanbox.listdir(fanbox.BASE_LOCAL_DIR):
+            if not os.path.isdir(os.path.join(fanbox.BASE_LOCAL_DIR, cid)): continue
+            fanbox.print_with_timestamp("%sのインデックスを作り直しています..." % cid)
+            index.reindex(cid)
+        index.close()
+        return
+    if args.verify:
+        creator_ids = args.creator_id or [cid for cid in fanbox.listdir(fanbox.BASE_LOCAL_DIR)
+                                          if os.path.isdir(os.path.join(fanbox.BASE_LOCAL_DIR, cid))]
+        orchestrator = fanbox.Orchestrator(args=args, log_to_stdout=True, two_phase=True)
+        orchestrator.verify(creator_ids, full=args.force_update)
+        orchestrator.close()
+        return
+    creator_ids = list(args.creator_id)
+    if args.creator_file is not None:
+        args.creator_id += fanbox.read_creator_file(args.creator_file)
+    if not args.creator_id:
+        parser.error("投稿者のIDを指定してください。")
+    if args.dry_run:
+        orchestrator = fanbox.Orchestrator(args=args, log_to_stdout=True, two_phase=True)
+        orchestrator.plan(args.creator_id)
+        orchestrator.close()
+        return
+
+    if args.session_id is None:
+        sessid = ""
+    else:
+        sessid = args.session_id
+    if args.page_limit is None:
+        limit = None
+    else:
+        limit = args.page_limit if args.page_limit >= 0 else 0
+
+    orchestrator = fanbox.Orchestrator.from_options(args, FANBOXSESSID=sessid, log_to_stdout=True)
+    try:
+        if args.watch is not None:
+            args.incremental = True
+            def subscribed() -> list[str]:
+                if args.creator_file is None: return creator_ids
+                return creator_ids + fanbox.read_creator_file(args.creator_file)
+            def write_metrics(results:dict) -> None:
+                # 同期のたびに書き出す。jsonlはその回の分を追記し、prometheusは起動してからの合計で置き換える
+                if args.metrics_file is None: return
+                metrics = orchestrator.metrics if args.metrics_format == "prometheus" else orchestrator.last_metrics
+                metrics.write(args.metrics_file, format=args.metrics_format)
+            try:
+                asyncio.run(fanbox.watch(subscribed, interval=args.watch, jitter=args.watch_jitter,
+                                         orchestrator=orchestrator, page_limit=limit,
+                                         on_result=lambda result: fanbox.print_with_timestamp(result.describe()),
+                                         on_cycle=write_metrics))
+            except KeyboardInterrupt:
+                fanbox.print_with_timestamp("終了します。")
+            return
+        results = orchestrator.run(args.creator_id, page_limit=limit)
+        for result in results.values():
+            fanbox.print_with_timestamp(result.describe())
+    finally:
+        if args.metrics_file is not None and args.watch is None:
+            orchestrator.metrics.write(args.metrics_file, format=args.metrics_format)
+        orchestrator.close()
+    if not all(result.ok for result in results.values()):
+        sys.exit(1)
+
+# ファイルの一覧を作るときに子プロセスがこのファイルを読み込むため、直接実行されたときだけ動かす
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""`--blob-store`で、同じ内容や同じURLのファイルを1つだけ保存してリンクするテストです。"""
+import asyncio
+import collections
+import os
+import tempfile
+import unittest
+
+import benchmark
+import fanbox
+
+
+class SharedFilesServer(benchmark.MockFanboxServer):
+    """
+    画像の中身が投稿によらず同じになるモック。
+
+    same_urlがTrueのときは、全ての投稿が最初の投稿の画像のURLをそのまま使います。
+    """
+    def __init__(self, same_url:bool=False, **kwargs):
+        super().__init__(**kwargs)
+        self.same_url = same_url
+        self.file_gets: collections.Counter = collections.Counter()
+
+    def post(self, creator:str, i:int) -> dict:
+        post = super().post(creator, i)
+        if self.same_url:
+            post["body"]["images"] = super().post(creator, 0)["body"]["images"]
+        return post
+
+    def _send_file(self, h, path:str) -> None:
+        with self._lock:
+            self.file_gets[path] += 1
+        name = os.path.basename(path)
+        super()._send_file(h, path if name.startswith("cover") else "files/shared/" + name)
+
+
+class BlobStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        self.addCleanup(setattr, fanbox, "BASE_URL", fanbox.BASE_URL)
+        self.addCleanup(setattr, fanbox, "RATE_LIMITER", fanbox.RATE_LIMITER)
+        fanbox.RATE_LIMITER = fanbox.RateLimiter(rate=1000, burst=100)
+
+    def start(self, **kwargs) -> SharedFilesServer:
+        server = SharedFilesServer(creators=1, posts=3, per_page=5, images=2, image_size=3000, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        fanbox.BASE_URL = server.base_url
+        return server
+
+    def sync(self) -> fanbox.SyncResult:
+        # 同じ内容のファイルを同時に保存しないよう、1つずつ処理する
+        result = asyncio.run(fanbox.sync_creator("creator0", blob_store=True, workers=1))
+        self.assertTrue(result.ok, result.error)
+        return result
+
+    def image(self, server:SharedFilesServer, i:int, j:int) -> str:
+        return os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", server.post_id("creator0", i), "images",
+                            "image_%d.jpeg" % j)
+
+    def blobs(self) -> list[str]:
+        return [f for d in fanbox.listdir(fanbox.BASE_LOCAL_BLOB_DIR)
+                for f in fanbox.listdir(os.path.join(fanbox.BASE_LOCAL_BLOB_DIR, d))]
+
+    def test_same_content_is_stored_once(self):
+        server = self.start()
+        self.sync()
+        for j in range(2):
+            with self.subTest(image=j):
+                paths = [self.image(server, i, j) for i in range(3)]
+                with open(paths[0], mode="rb") as f:
+                    blob = fanbox.blob_path(fanbox.hashlib.sha256(f.read()).hexdigest())
+                for path in paths:
+                    self.assertTrue(os.path.samefile(path, blob))
+        # 画像2枚とサムネイル2枚が1つずつ、カバー画像は投稿ごとに違うので3つ、プロフィールの画像が2つ
+        self.assertEqual(len(self.blobs()), 4 + 3 + 2)
+
+    def test_known_url_is_not_downloaded_again(self):
+        server = self.start(same_url=True)
+        self.sync()
+        self.assertEqual(sorted(path for path in server.file_gets if "/image_" in path),
+                         ["files/creator0/%s/image_%d.jpeg" % (server.post_id("creator0", 0), j) for j in range(2)])
+
+        # 後から追加された投稿に保存済みのURLがあれば、通信せずにリンクする
+        server.posts = 4
+        server.file_gets.clear()
+        self.sync()
+        self.assertEqual([path for path in server.file_gets if "/image_" in path], [])
+        for j in range(2):
+            self.assertTrue(os.path.samefile(self.image(server, 3, j), self.image(server, 0, j)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+"""受信速度の制限と、1回の実行で受信する量や時間の上限（予算）のテストです。"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import fanbox
+
+
+class LimitTest(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(fanbox.parse_size("500"), 500)
+        self.assertEqual(fanbox.parse_size("500K"), 500 * 1024)
+        self.assertEqual(fanbox.parse_size("2.5m"), int(2.5 * 1024**2))
+        self.assertEqual(fanbox.parse_size("1GiB"), 1024**3)
+        with self.assertRaises(ValueError):
+            fanbox.parse_size("fast")
+
+    def test_bandwidth_limiter(self):
+        with mock.patch.object(fanbox, "monotonic", return_value=100.0) as now:
+            limiter = fanbox.BandwidthLimiter(rate=1000)
+            self.assertEqual(limiter.reserve(1000), 0.0) # 1秒分は待たずに受信できる
+            self.assertAlmostEqual(limiter.reserve(500), 0.5)
+            now.return_value = 101.0
+            self.assertAlmostEqual(limiter.reserve(500), 0.0)
+
+    def test_budget(self):
+        budget = fanbox.Budget(max_bytes=1000)
+        budget.add(999)
+        self.assertIsNone(budget.exceeded())
+        budget.add(1)
+        self.assertIsNotNone(budget.exceeded())
+        self.assertIsNotNone(fanbox.Budget(max_seconds=0).exceeded())
+        self.assertIsNone(fanbox.Budget().exceeded())
+
+
+class RangeRecordingServer(benchmark.MockFanboxServer):
+    """ファイルへのリクエストを(パス, Range)で記録するモック。"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.file_requests: list[tuple[str, str|None]] = []
+
+    def _send_file(self, h, path:str) -> None:
+        with self._lock:
+            self.file_requests.append((path, h.headers.get("range")))
+        super()._send_file(h, path)
+
+
+class BudgetSyncTest(unittest.TestCase):
+    FILE_SIZE = 100_000
+
+    def setUp(self):
+        self.server = RangeRecordingServer(creators=1, posts=4, per_page=5, images=0, image_size=1000, files=1,
+                                           file_size=self.FILE_SIZE)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+
+    def sync(self, **kwargs) -> fanbox.SyncResult:
+        # 上限に達したところで止まるよう、小さな単位で1つずつ受信する
+        result = asyncio.run(fanbox.sync_creator("creator0", chunk_size=8 * 1024, **kwargs))
+        self.assertTrue(result.ok, result.error)
+        return result
+
+    def files(self) -> list[str]:
+        return [os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", self.server.post_id("creator0", i), "files",
+                             "file_0.zip") for i in range(4)]
+
+    def assert_complete(self) -> None:
+        index = fanbox.Index()
+        self.addCleanup(index.close)
+        for path in self.files():
+            self.assertEqual(os.path.getsize(path), self.FILE_SIZE)
+            self.assertFalse(os.path.exists(path + ".part"))
+            self.assertTrue(index.has_file(path))
+        self.assertEqual(index.retries("creator0", "post") + index.retries("creator0", "file"), [])
+
+    def test_deferred_files_resume_with_range(self):
+        first = self.sync(max_bytes=150_000)
+        self.assertGreater(first.files_deferred, 0)
+        self.assertLess(first.bytes, 150_000 + 8 * 1024 * 2)
+        self.assertTrue(any(os.path.exists(path + ".part") for path in self.files()))
+
+        self.server.file_requests.clear()
+        second = self.sync()
+        self.assert_complete()
+        # ファイルとカバー画像が4つずつ、プロフィールの画像が2つ
+        self.assertEqual(first.files_downloaded + second.files_downloaded, 4 * 2 + 2)
+        # 途中まで受信したファイルは続きから受信し、同じファイルを最初から受信し直すことは無い
+        resumed = [path for path, range_ in self.server.file_requests if range_ is not None]
+        self.assertGreater(len(resumed), 0)
+        full = [path for path, range_ in self.server.file_requests if range_ is None]
+        self.assertEqual(len(full), len(set(full)))
+        self.assertFalse(set(resumed) & set(full))
+        self.assertEqual(first.bytes + second.bytes, 4 * self.FILE_SIZE + (4 + 2) * self.server.image_size)
+
+    def test_deferred_posts_are_fetched_next_time(self):
+        # 投稿データ一覧を取得したところで上限に達するので、投稿データは全て次回に回す
+        # （プロフィールの画像は同時にダウンロードされて受信量が揺れるので、対象から外す）
+        first = self.sync(max_bytes=1000, skip_type=["icon", "cover"])
+        self.assertEqual((first.posts_downloaded, first.posts_deferred, first.files_downloaded), (0, 4, 0))
+        second = self.sync(incremental=True, skip_type=["icon", "cover"])
+        self.assertEqual(second.posts_downloaded, 4)
+        self.assertEqual(second.files_downloaded, 4)
+        self.assert_complete()
+        # 次回に回した投稿は再試行で取得した後、投稿データ一覧でも出てくるが、ファイルは1回だけダウンロードする
+        full = [path for path, range_ in self.server.file_requests if range_ is None]
+        self.assertEqual(sorted(full), sorted(set(full)))
+
+    def test_no_time_left(self):
+        # 時間の上限が0秒なら何も取得せず、全て次回に回す
+        first = self.sync(max_duration=0)
+        self.assertEqual((first.posts_downloaded, first.files_downloaded, first.bytes), (0, 0, 0))
+        self.assertEqual(self.server.file_requests, [])
+        self.sync()
+        self.assert_complete()
+
+    def test_limit_rate(self):
+        # 全体の速さの上限を守るだけ時間がかかる（最初の1秒分はすぐに受信できる）
+        started = fanbox.monotonic()
+        result = self.sync(limit_rate=200_000)
+        self.assertGreaterEqual(result.bytes, 4 * self.FILE_SIZE)
+        self.assertGreater(fanbox.monotonic() - started, (result.bytes - 200_000) / 200_000 * 0.9)
+        self.assert_complete()
+
+
+if __name__ == "__main__":
+    unittest.main()
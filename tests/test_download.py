@@ -0,0 +1,137 @@
+"""File.__download_fileの、Rangeリクエストを使った続きからのダウンロードのテストです。"""
+import argparse
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import requests
+
+import benchmark
+import fanbox
+
+
+class TruncatedWriter:
+    """limitバイトを書き込んだところで、それ以降を捨てるwfileの代わり。"""
+    def __init__(self, wfile, limit:int):
+        self.wfile = wfile
+        self.remaining = limit
+
+    def write(self, data:bytes) -> int:
+        if self.remaining > 0:
+            self.wfile.write(data[:self.remaining])
+        self.remaining -= len(data)
+        return len(data)
+
+    def __getattr__(self, name:str):
+        return getattr(self.wfile, name)
+
+
+class RangeServer(benchmark.MockFanboxServer):
+    """ファイルへのリクエストを記録し、受信の途中での切断やIf-Rangeを無視するサーバーを真似られるモック。"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.file_requests: list[tuple[str, str|None, str|None]] = [] # (パス, Range, If-Range)
+        self.cut_once: dict[str, int] = {} # パス → 最初の1回だけ、このバイト数を送ったところで切断する
+        self.ignore_if_range = False
+
+    def _send_file(self, h, path:str) -> None:
+        self.file_requests.append((path, h.headers.get("range"), h.headers.get("if-range")))
+        if self.ignore_if_range:
+            del h.headers["if-range"]
+        if path in self.cut_once:
+            h.wfile = TruncatedWriter(h.wfile, self.cut_once.pop(path))
+            h.close_connection = True
+        super()._send_file(h, path)
+
+
+class RangeDownloadTest(unittest.TestCase):
+    SIZE = 200_000
+
+    def setUp(self):
+        self.server = RangeServer(creators=1, posts=1, images=0, files=1, file_size=self.SIZE)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url), ("BACKOFF_BASE", 0.01)):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+        self.index = fanbox.Index()
+        self.addCleanup(self.index.close)
+        # 切断されるまでに受信した分が書き込まれるよう、小さな単位で受信する
+        self.kwargs = dict(creator_id="creator0", args=argparse.Namespace(chunk_size=16*1024), index=self.index,
+                           limiter=fanbox.RateLimiter(rate=1000, burst=100))
+        fanbox.Post(**self.kwargs).download()
+
+        post_id = self.server.post_id("creator0", 0)
+        self.remote = "files/creator0/%s/file_0.zip" % post_id
+        self.url = self.server.base_url + self.remote
+        self.path = os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", post_id, "files", "file_0.zip")
+        r = requests.get(self.url)
+        self.content, self.etag = r.content, r.headers["etag"]
+        self.server.file_requests.clear()
+
+    def write_partial(self, content:bytes, etag:str) -> None:
+        """前回の実行が途中で止まったときと同じ`.part`と`.part.json`を作る。"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + ".part", mode="wb") as f:
+            f.write(content)
+        with open(self.path + ".part.json", mode="wt", encoding="utf-8") as f:
+            json.dump({"url": self.url, "etag": etag, "last_modified": None, "length": self.SIZE}, f)
+
+    def download(self) -> list[tuple[str|None, str|None]]:
+        """ファイルをダウンロードし、このファイルへのリクエストの(Range, If-Range)を返す。"""
+        fanbox.File(**self.kwargs).download()
+        self.assertFalse(os.path.exists(self.path + ".part"))
+        self.assertFalse(os.path.exists(self.path + ".part.json"))
+        with open(self.path, mode="rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertTrue(self.index.has_file(self.path))
+        return [(r, i) for path, r, i in self.server.file_requests if path == self.remote]
+
+    def test_resume_after_disconnect(self):
+        self.server.cut_once[self.remote] = self.SIZE // 2
+        first, second = self.download()
+        self.assertEqual(first, (None, None))
+        offset = int(second[0][len("bytes="):-1])
+        self.assertGreater(offset, 0)
+        self.assertEqual(second, ("bytes=%d-" % offset, self.etag))
+
+    def test_resume_from_previous_run(self):
+        self.write_partial(self.content[:1000], self.etag)
+        self.assertEqual(self.download(), [("bytes=1000-", self.etag)])
+
+    def test_restart_when_etag_changed(self):
+        # If-Rangeが合わないので、サーバーは200で全体を返す
+        self.write_partial(b"x" * 1000, '"old"')
+        self.assertEqual(self.download(), [("bytes=1000-", '"old"')])
+
+    def test_restart_when_206_has_other_etag(self):
+        # If-Rangeを無視するサーバーは206を返すが、ETagが違うので最初から受信し直す
+        self.server.ignore_if_range = True
+        self.write_partial(b"x" * 1000, '"old"')
+        self.assertEqual(self.download(), [("bytes=1000-", '"old"'), (None, None)])
+
+    def test_already_complete(self):
+        # 前回全て受信した直後に止まっていた場合は、416が返ってきたら受信済みのものを使う
+        self.write_partial(self.content, self.etag)
+        self.assertEqual(self.download(), [("bytes=%d-" % self.SIZE, self.etag)])
+
+    def test_connection_error_is_not_retried_twice(self):
+        # 接続できないときの再試行は_requestだけで行い、受信の再試行のループでは繰り返さない
+        with mock.patch.object(requests.Session, "get", autospec=True,
+                               side_effect=requests.exceptions.ConnectionError("refused")) as get:
+            fanbox.File(**self.kwargs).download()
+        calls = [c for c in get.call_args_list if c.args[1] == self.url]
+        self.assertEqual(len(calls), fanbox.RETRY_LIMIT + 1)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIn(self.url, [r["url"] for r in self.index.retries("creator0", "file")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""`--incremental`で、保存済みの投稿まで来たところで取得をやめるテストです。"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import benchmark
+import fanbox
+
+
+class UpdatableServer(benchmark.MockFanboxServer):
+    """投稿の更新日時を変えられるモック。"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.updated: dict[int, str] = {} # 何番目の投稿か → 更新日時
+
+    def post(self, creator:str, i:int) -> dict:
+        post = super().post(creator, i)
+        if i in self.updated: post["updatedDatetime"] = self.updated[i]
+        return post
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.server = UpdatableServer(creators=1, posts=20, per_page=5, images=0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+        result = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertEqual(result.posts_downloaded, 20)
+        self.server.counts.clear()
+
+    def sync(self) -> fanbox.SyncResult:
+        result = asyncio.run(fanbox.sync_creator("creator0", incremental=True))
+        self.assertTrue(result.ok, result.error)
+        return result
+
+    def saved_postlist(self) -> list[str]:
+        index = fanbox.Index()
+        self.addCleanup(index.close)
+        return [item["id"] for item in fanbox.Post("creator0", index=index).iter_postlist()]
+
+    def test_nothing_new(self):
+        result = self.sync()
+        self.assertEqual(self.server.counts["post.listCreator"], 1)
+        self.assertEqual(self.server.counts["post.info"], 0)
+        self.assertEqual(result.posts_skipped, 20)
+
+    def test_stops_at_first_known_post(self):
+        # 新しい投稿が6件あると、最初のページは全て新しい投稿なので2ページ目まで取得する
+        self.server.posts = 26
+        result = self.sync()
+        self.assertEqual(self.server.counts["post.listCreator"], 2)
+        self.assertEqual(self.server.counts["post.info"], 6)
+        self.assertEqual(result.posts_downloaded, 6)
+        # 取得しなかった古いページの投稿も、前回の投稿データ一覧から引き継いで保存する
+        self.assertEqual(self.saved_postlist(), [self.server.post_id("creator0", i) for i in range(25, -1, -1)])
+
+    def test_updated_post_is_fetched_again(self):
+        self.server.updated[18] = "2022-02-01T00:00:00+09:00"
+        result = self.sync()
+        self.assertEqual(self.server.counts["post.listCreator"], 1)
+        self.assertEqual(self.server.counts["post.info"], 1)
+        self.assertEqual(result.posts_downloaded, 1)
+        self.assertEqual(result.posts_skipped, 19)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+"""投稿データなどを保存するjsonの読み書きのテストです。"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import fanbox
+
+
+class IterJsonItemsTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+
+    def write(self, name:str, text:str) -> str:
+        path = os.path.join(self.workdir.name, name)
+        with open(path, mode="wt", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def test_small_chunks(self):
+        # どこで区切って読み込んでも、要素の途中で区切られた数値や文字列を正しく読み込む
+        data = [1.5, -2.5e10, 0, 123456, "a,b]c", {"id": "1", "list": [1, 2]}, [], True, None, "日本語"]
+        for indent in (None, 2):
+            path = self.write("list.json", fanbox.json.dumps(data, ensure_ascii=False, indent=indent))
+            for chunk_size in (1, 2, 3, 5, 7, 64):
+                with self.subTest(indent=indent, chunk_size=chunk_size):
+                    self.assertEqual(list(fanbox.iter_json_items(path, chunk_size=chunk_size)), data)
+
+    def test_number_split_at_chunk_boundary(self):
+        path = self.write("number.json", "[1.5]")
+        for chunk_size in (1, 3):
+            self.assertEqual(list(fanbox.iter_json_items(path, chunk_size=chunk_size)), [1.5])
+
+    def test_not_a_list(self):
+        path = self.write("object.json", '{"a": 1}')
+        with self.assertRaises(ValueError):
+            list(fanbox.iter_json_items(path))
+
+
+class JsonFormatTest(unittest.TestCase):
+    POSTLIST = [{"id": str(i), "title": "投稿%d" % i, "feeRequired": i * 100} for i in range(5)]
+    POST = {"body": {"id": "1", "title": "投稿", "images": [{"id": "a"}]}}
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+
+    def test_round_trip(self):
+        for format in fanbox.JSON_FORMATS:
+            for data in (self.POSTLIST, self.POST, []):
+                with self.subTest(format=format, data=type(data).__name__):
+                    name = fanbox.json_filename("20220101000000.json", data, format)
+                    path = os.path.join(self.workdir.name, format, name)
+                    fanbox.save_json(data, path, compact=format != "json")
+                    self.assertFalse(os.path.exists(path + ".part"))
+                    self.assertEqual(fanbox.load_json(path), data)
+                    if isinstance(data, list):
+                        self.assertEqual(list(fanbox.iter_json_items(path, chunk_size=7)), data)
+
+    def test_file_names(self):
+        self.assertEqual(fanbox.json_filename("a.json", self.POSTLIST, "json"), "a.json")
+        self.assertEqual(fanbox.json_filename("a.json", self.POSTLIST, "ndjson"), "a.ndjson")
+        self.assertEqual(fanbox.json_filename("a.json", self.POST, "ndjson"), "a.json")
+        self.assertEqual(fanbox.json_filename("a.json", self.POSTLIST, "gzip"), "a.ndjson.gz")
+        self.assertEqual(fanbox.json_filename("a.json", self.POST, "gzip"), "a.json.gz")
+
+    def test_ndjson_has_one_item_per_line(self):
+        path = os.path.join(self.workdir.name, "list.ndjson.gz")
+        fanbox.save_json(self.POSTLIST, path)
+        with gzip.open(path, mode="rt", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertEqual([fanbox.loads_json(line) for line in lines], self.POSTLIST)
+
+
+class JsonFormatSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.server = benchmark.MockFanboxServer(creators=1, posts=12, per_page=5, images=0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+        # 同じ秒に保存しても後から保存したものが最新になるよう、時刻を1秒ずつ進める
+        patcher = mock.patch.object(fanbox, "time_now", side_effect=itertools.count(20220101000000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_formats_can_be_mixed(self):
+        # gzipで保存した後にjsonへ戻しても、保存済みのデータを読み込んで続きから同期できる
+        first = asyncio.run(fanbox.sync_creator("creator0", json_format="gzip"))
+        self.assertEqual(first.posts_downloaded, 12)
+        names = fanbox.listdir(fanbox.BASE_LOCAL_DIR)
+        self.assertTrue(any(name.startswith("creator0_") and name.endswith(".ndjson.gz") for name in names))
+        self.server.posts = 13
+        second = asyncio.run(fanbox.sync_creator("creator0", json_format="json", incremental=True))
+        self.assertTrue(second.ok, second.error)
+        self.assertEqual((second.posts_downloaded, second.posts_skipped), (1, 12))
+        index = fanbox.Index()
+        self.addCleanup(index.close)
+        post = fanbox.Post("creator0", args=argparse.Namespace(), index=index)
+        self.assertEqual([item["id"] for item in post.iter_postlist()],
+                         [self.server.post_id("creator0", i) for i in range(12, -1, -1)])
+        self.assertEqual(post.get_postlist(), list(post.iter_postlist()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+"""ログの出力のテストです。"""
+import contextlib
+import threading
+import time
+import unittest
+
+import fanbox
+
+
+class SlowStdout:
+    """書き込むたびに他のスレッドへ切り替わる標準出力の代わり。"""
+    def __init__(self):
+        self.parts: list[str] = []
+
+    def write(self, text:str) -> int:
+        self.parts.append(text)
+        time.sleep(0)
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+
+class PrintWithTimestampTest(unittest.TestCase):
+    def test_lines_from_threads_do_not_mix(self):
+        out = SlowStdout()
+        def log(i:int) -> None:
+            for j in range(100):
+                fanbox.print_with_timestamp("スレッド%d: %d件目\n2行目" % (i, j))
+        with contextlib.redirect_stdout(out):
+            threads = [threading.Thread(target=log, args=(i,)) for i in range(8)]
+            for t in threads: t.start()
+            for t in threads: t.join()
+        lines = "".join(out.parts).split("\n")
+        self.assertEqual(lines.pop(), "")
+        self.assertEqual(len(lines), 8 * 100 * 2)
+        for first, second in zip(lines[::2], lines[1::2]):
+            self.assertRegex(first, r"^\[\d{4}/\d\d/\d\d \d\d:\d\d:\d\d\] スレッド\d: \d+件目$")
+            self.assertEqual(second, " " * 22 + "2行目")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""ファイルをダウンロードする順番と、種類や投稿の条件での絞り込みのテストです。"""
+import asyncio
+import os
+import tempfile
+import unittest
+
+import benchmark
+import fanbox
+
+
+def job(name:str, filetype:str="images", published:str|None=None, size:int|None=None,
+        fee_required:int|None=None, adult:bool|None=None) -> fanbox.FileJob:
+    return fanbox.FileJob("https://example.com/" + name, name, name, "1", filetype, size, published,
+                          fee_required, adult)
+
+
+class SchedulerTest(unittest.TestCase):
+    JOBS = [
+        job("b", published="2022-02-01", size=300),
+        job("icon", filetype="icon"), # プロフィールの画像は投稿の情報が無い
+        job("a", published="2022-01-01", filetype="thumbnails"),
+        job("c", published="2022-03-01", filetype="files", size=100),
+    ]
+
+    def names(self, jobs:list[fanbox.FileJob]) -> list[str]:
+        return [job.name for job in jobs]
+
+    def test_orders(self):
+        self.assertEqual(self.names(fanbox.Scheduler().schedule(self.JOBS)), ["b", "icon", "a", "c"])
+        self.assertEqual(self.names(fanbox.Scheduler(order="newest").schedule(self.JOBS)), ["c", "b", "a", "icon"])
+        self.assertEqual(self.names(fanbox.Scheduler(order="oldest").schedule(self.JOBS)), ["a", "b", "c", "icon"])
+
+    def test_smallest_estimates_unknown_sizes(self):
+        sizes = {"thumbnails": 50, "icon": None}
+        scheduler = fanbox.Scheduler(order="smallest", sizes=sizes.get)
+        # サイズの分からないサムネイル画像は平均から見積もり、見積もれないものは最後に回す
+        self.assertEqual(self.names(scheduler.schedule(self.JOBS)), ["a", "c", "b", "icon"])
+
+    def test_schedule_does_not_change_the_list(self):
+        jobs = list(self.JOBS)
+        fanbox.Scheduler(order="newest", skip_types=["icon"]).schedule(jobs)
+        self.assertEqual(jobs, self.JOBS)
+
+    def test_filters(self):
+        jobs = [job("free", fee_required=0), job("paid", fee_required=500),
+                job("adult", fee_required=500, adult=True), job("thumb", filetype="thumbnails", fee_required=500),
+                job("icon", filetype="icon")]
+        self.assertEqual(self.names(fanbox.Scheduler(ignore_free=True).schedule(jobs)),
+                         ["paid", "adult", "thumb", "icon"])
+        self.assertEqual(self.names(fanbox.Scheduler(ignore_adult=True).schedule(jobs)),
+                         ["free", "paid", "thumb", "icon"])
+        self.assertEqual(self.names(fanbox.Scheduler(skip_types=["thumbnails", "icon"]).schedule(jobs)),
+                         ["free", "paid", "adult"])
+
+    def test_unknown_order(self):
+        with self.assertRaises(ValueError):
+            fanbox.Scheduler(order="largest")
+
+
+class FilterSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.server = benchmark.MockFanboxServer(creators=1, posts=10, per_page=5, images=1, image_size=1000)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+
+    def saved(self) -> set[tuple[int, str]]:
+        """保存した投稿のファイルを、(何番目の投稿か, 種類)で返す。"""
+        saved = set()
+        for i in range(self.server.posts):
+            postdir = os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", self.server.post_id("creator0", i))
+            saved |= {(i, filetype) for filetype in fanbox.listdir(postdir)
+                      if filetype != "post" and fanbox.listdir(os.path.join(postdir, filetype))}
+        return saved
+
+    def test_filtered_files_are_never_requested(self):
+        # モックでは奇数番目の投稿が無料、5の倍数番目の投稿が成人向け
+        for two_phase in (False, True):
+            with self.subTest(two_phase=two_phase):
+                os.chdir(tempfile.mkdtemp(dir=self.workdir.name))
+                result = asyncio.run(fanbox.sync_creator("creator0", two_phase=two_phase, ignore_free_posts=True,
+                                                         ignore_adult_contents=True, skip_type=["thumbnails"]))
+                self.assertTrue(result.ok, result.error)
+                paid = [i for i in range(10) if i % 2 == 0 and i % 5 != 0]
+                self.assertEqual(self.saved(), {(i, t) for i in paid for t in ("images", "cover")})
+                self.assertEqual(self.server.counts["files"], 2 * len(paid) + 2) # プロフィールの画像2つ
+                self.server.counts.clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
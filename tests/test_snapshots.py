@@ -0,0 +1,84 @@
+"""投稿データ・投稿データ一覧・プロフィールを、内容が変わったときだけ保存するテストです。"""
+import argparse
+import asyncio
+import itertools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import fanbox
+
+
+class RetitledServer(benchmark.MockFanboxServer):
+    """投稿のタイトルを変えられるモック。"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.titles: dict[int, str] = {}
+
+    def post(self, creator:str, i:int) -> dict:
+        post = super().post(creator, i)
+        if i in self.titles: post["title"] = self.titles[i]
+        return post
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.server = RetitledServer(creators=1, posts=3, per_page=5, images=0)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+        # 同じ秒に保存しても別のファイル名になるよう、時刻を1秒ずつ進める
+        patcher = mock.patch.object(fanbox, "time_now", side_effect=itertools.count(20220101000000))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.orchestrator = fanbox.Orchestrator(args=argparse.Namespace(update_posts=True))
+        self.addCleanup(self.orchestrator.close)
+
+    def sync(self) -> fanbox.Metrics:
+        result = asyncio.run(fanbox.sync_creator("creator0", orchestrator=self.orchestrator))
+        self.assertTrue(result.ok, result.error)
+        return self.orchestrator.last_metrics
+
+    def snapshots(self, i:int) -> list[str]:
+        return fanbox.listdir(os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", self.server.post_id("creator0", i), "post"))
+
+    def postlists(self) -> list[str]:
+        return [f for f in fanbox.listdir(fanbox.BASE_LOCAL_DIR) if f.startswith("creator0_")
+                and not f.endswith("manifest.ndjson")]
+
+    def test_unchanged_data_is_not_written_again(self):
+        first = self.sync()
+        self.assertEqual(first.events["snapshots_written"], 5) # プロフィール、投稿データ一覧、投稿データ3件
+        second = self.sync()
+        self.assertNotIn("snapshots_written", second.events)
+        self.assertEqual(second.events["snapshots_unchanged"], 5)
+        self.assertEqual([len(self.snapshots(i)) for i in range(3)], [1, 1, 1])
+        self.assertEqual(len(self.postlists()), 1)
+        self.assertEqual(len(fanbox.listdir(fanbox.BASE_LOCAL_PROFILE_DIR)), 1 + 1) # プロフィールと画像のディレクトリ
+
+    def test_changed_post_is_written_as_new_snapshot(self):
+        self.sync()
+        self.server.titles[1] = "retitled"
+        metrics = self.sync()
+        # 投稿データ一覧にもタイトルが含まれるので、投稿データ一覧と投稿データ1件が保存し直される
+        self.assertEqual(metrics.events["snapshots_written"], 2)
+        self.assertEqual([len(self.snapshots(i)) for i in range(3)], [1, 2, 1])
+        self.assertEqual(len(self.postlists()), 2)
+        latest = max(self.snapshots(1))
+        data = fanbox.load_json(os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", self.server.post_id("creator0", 1),
+                                             "post", latest))
+        self.assertEqual(data["body"]["title"], "retitled")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+"""sync_creatorなどライブラリとして使うときの入り口のテストです。"""
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+import urllib.parse
+from unittest import mock
+
+import benchmark
+import fanbox
+
+
+class RecordingServer(benchmark.MockFanboxServer):
+    """ファイルへのRangeなしのリクエストを記録し、指定した投稿のpost.infoを失敗させられるモック。"""
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.full_gets: list[str] = []
+        self.broken_posts: set[str] = set()
+
+    def _handle(self, h):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(h.path).query))
+        if query.get("postId") in self.broken_posts:
+            return self._send_json(h, {"error": "internal server error"}, status=500)
+        super()._handle(h)
+
+    def _send_file(self, h, path:str) -> None:
+        if h.headers.get("range") is None:
+            with self._lock:
+                self.full_gets.append(path)
+        super()._send_file(h, path)
+
+
+class SyncCreatorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = benchmark.MockFanboxServer(creators=1, posts=3, per_page=5, images=1, image_size=2000)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+
+    def test_sync_twice(self):
+        # main.pyを通さないので、optionsに無いオプション（update_postsなど）があっても動かなければならない
+        first = asyncio.run(fanbox.sync_creator("creator0"))
+        second = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertTrue(first.ok, first.error)
+        self.assertEqual(first.posts_downloaded, 3)
+        self.assertEqual(first.files_downloaded, 11)
+        self.assertTrue(second.ok, second.error)
+        self.assertEqual(second.posts_downloaded, 0)
+        self.assertEqual(second.posts_skipped, 3)
+        self.assertEqual(second.files_downloaded, 0)
+
+    def test_second_sync_does_not_reread_post_data(self):
+        asyncio.run(fanbox.sync_creator("creator0"))
+        with mock.patch.object(fanbox, "load_json", wraps=fanbox.load_json) as load_json:
+            result = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.files_skipped, 9) # プロフィールの画像は変更が無いかを確認するので含まない
+        posts = [c.args[0] for c in load_json.call_args_list if os.sep + "post" + os.sep in c.args[0]]
+        self.assertEqual(posts, [])
+
+    def test_two_phase_plan_uses_cached_jobs(self):
+        first = asyncio.run(fanbox.sync_creator("creator0", two_phase=True))
+        self.assertEqual(first.files_downloaded, 11)
+        with mock.patch.object(fanbox, "load_json", wraps=fanbox.load_json) as load_json:
+            second = asyncio.run(fanbox.sync_creator("creator0", two_phase=True))
+        self.assertTrue(second.ok, second.error)
+        self.assertEqual(second.files_downloaded, 0)
+        posts = [c.args[0] for c in load_json.call_args_list if os.sep + "post" + os.sep in c.args[0]]
+        self.assertEqual(posts, [])
+
+        # インデックスの一覧を使っても、投稿データから作り直しても同じ一覧になる
+        index = fanbox.Index()
+        self.addCleanup(index.close)
+        file = fanbox.File("creator0", index=index)
+        cached = file.plan()
+        with index._lock, index._conn:
+            index._conn.execute("DELETE FROM post_jobs")
+        self.assertEqual(file.plan(), cached)
+
+    def test_sync_twice_with_default_args(self):
+        orchestrator = fanbox.Orchestrator(args={})
+        self.addCleanup(orchestrator.close)
+        for _ in range(2):
+            result = asyncio.run(fanbox.sync_creator("creator0", orchestrator=orchestrator))
+            self.assertTrue(result.ok, result.error)
+
+    def test_retried_post_is_queued_once(self):
+        server = RecordingServer(creators=1, posts=3, per_page=5, images=2, image_size=2000)
+        server.start()
+        self.addCleanup(server.stop)
+        fanbox.BASE_URL = server.base_url
+        post_id = server.post_id("creator0", 1)
+        server.broken_posts.add(post_id)
+        with mock.patch.object(fanbox, "BACKOFF_BASE", 0.001):
+            first = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertEqual(first.posts_failed, 1)
+
+        # 再試行で取得した投稿は、投稿データ一覧ではスキップした投稿として出てくるが、ファイルは1回だけダウンロードする
+        server.broken_posts.clear()
+        server.full_gets.clear()
+        second = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertTrue(second.ok, second.error)
+        self.assertEqual(second.posts_downloaded, 1)
+        self.assertEqual(second.files_downloaded, 5) # 画像2枚、サムネイル2枚、カバー画像
+        self.assertEqual(sorted(server.full_gets), sorted(set(server.full_gets)))
+
+    def test_unreadable_snapshot_is_fetched_again(self):
+        # fsyncの前に止まり、インデックスには記録されたが中身が空になった投稿データ
+        asyncio.run(fanbox.sync_creator("creator0"))
+        post_id = self.server.post_id("creator0", 1)
+        index = fanbox.Index()
+        self.addCleanup(index.close)
+        filename = index.latest_snapshot("creator0", post_id)
+        path = os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", post_id, "post", filename)
+        open(path, mode="wb").close()
+        with index._lock, index._conn:
+            index._conn.execute("DELETE FROM post_jobs")
+
+        for incremental in (True, False):
+            result = asyncio.run(fanbox.sync_creator("creator0", incremental=incremental))
+            self.assertTrue(result.ok, result.error)
+        self.assertEqual(result.posts_downloaded, 1)
+        filename = index.latest_snapshot("creator0", post_id)
+        data = fanbox.load_json(os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", post_id, "post", filename))
+        self.assertEqual(data["body"]["id"], post_id)
+
+    def test_library_does_not_print(self):
+        # log_to_stdoutを指定しなければ、予算の上限に達した場合も含めて標準出力には何も書かない
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            deferred = asyncio.run(fanbox.sync_creator("creator0", max_bytes=5000))
+            asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertGreater(deferred.posts_deferred + deferred.files_deferred, 0)
+        self.assertEqual(out.getvalue(), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
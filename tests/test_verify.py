@@ -0,0 +1,105 @@
+"""`--verify`で壊れたファイルを見つけ、次回の実行でダウンロードし直すテストです。"""
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import fanbox
+
+
+class VerifyFileTest(unittest.TestCase):
+    JPEG = b"\xff\xd8\xff\xe0" + b"x" * 100 + b"\xff\xd9"
+
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        # モックの画像は本物の画像ではないので、Pillowがあっても末尾だけで確認する
+        patcher = mock.patch.object(fanbox, "Image", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name:str, content:bytes) -> str:
+        path = os.path.join(self.workdir.name, name)
+        with open(path, mode="wb") as f:
+            f.write(content)
+        return path
+
+    def test_good_file(self):
+        path = self.write("a.jpeg", self.JPEG)
+        sha256 = fanbox.hash_file(path).hexdigest()
+        self.assertEqual(fanbox.verify_file(path, size=len(self.JPEG), sha256=sha256), (sha256, None))
+
+    def test_problems(self):
+        cases = {
+            "empty.jpeg"    : (b"", {}),
+            "short.jpeg"    : (self.JPEG, {"size": len(self.JPEG) + 1}),
+            "changed.jpeg"  : (self.JPEG, {"sha256": "0" * 64}),
+            "error.jpeg"    : (b"<!DOCTYPE html><html></html>", {}),
+            "text.zip"      : (b"not a zip file", {}),
+            "truncated.jpeg": (self.JPEG[:-2], {}),
+        }
+        for name, (content, kwargs) in cases.items():
+            with self.subTest(name=name):
+                sha256, problem = fanbox.verify_file(self.write(name, content), **kwargs)
+                self.assertIsNotNone(problem)
+                self.assertEqual(sha256, fanbox.hashlib.sha256(content).hexdigest())
+        self.assertEqual(fanbox.verify_file(os.path.join(self.workdir.name, "missing.jpeg")),
+                         (None, "ファイルがありません"))
+
+    def test_unknown_extension_is_only_checked_for_size(self):
+        self.assertIsNone(fanbox.verify_file(self.write("a.bin", b"anything"))[1])
+
+
+class VerifySyncTest(unittest.TestCase):
+    def setUp(self):
+        self.server = benchmark.MockFanboxServer(creators=1, posts=3, per_page=5, images=1, image_size=2000,
+                                                 files=1, file_size=3000)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        cwd = os.getcwd()
+        os.chdir(self.workdir.name)
+        self.addCleanup(os.chdir, cwd)
+        for name, value in (("BASE_URL", self.server.base_url), ("Image", None),
+                            ("RATE_LIMITER", fanbox.RateLimiter(rate=1000, burst=100))):
+            self.addCleanup(setattr, fanbox, name, getattr(fanbox, name))
+            setattr(fanbox, name, value)
+        result = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertTrue(result.ok, result.error)
+        self.orchestrator = fanbox.Orchestrator(two_phase=True)
+        self.addCleanup(self.orchestrator.close)
+
+    def path(self, i:int, filetype:str, name:str) -> str:
+        return os.path.join(fanbox.BASE_LOCAL_DIR, "creator0", self.server.post_id("creator0", i), filetype, name)
+
+    def test_corrupt_files_are_downloaded_again(self):
+        truncated, error_page = self.path(0, "images", "image_0.jpeg"), self.path(2, "files", "file_0.zip")
+        with open(truncated, mode="r+b") as f:
+            f.truncate(1000)
+        with open(error_page, mode="wb") as f:
+            f.write(b"<html>503 Service Unavailable</html>")
+
+        result = self.orchestrator.verify(["creator0"])["creator0"]
+        self.assertEqual(set(result["corrupt"]), {fanbox.Index.key(truncated), fanbox.Index.key(error_page)})
+        self.assertEqual(result["checked"], 3 * 4 + 2) # 画像、サムネイル画像、カバー画像、ファイルとプロフィールの画像
+        self.assertFalse(os.path.exists(truncated) or os.path.exists(error_page))
+        retries = self.orchestrator.index.retries("creator0", "file")
+        self.assertEqual({r["key"] for r in retries}, set(result["corrupt"]))
+
+        # 確認済みで変わっていないファイルは、次の確認では読み込まない
+        again = self.orchestrator.verify(["creator0"])["creator0"]
+        self.assertEqual((again["checked"], again["skipped"], again["corrupt"]), (0, 3 * 4, {}))
+
+        synced = asyncio.run(fanbox.sync_creator("creator0"))
+        self.assertTrue(synced.ok, synced.error)
+        self.assertEqual(synced.files_downloaded, 2)
+        self.assertEqual(self.orchestrator.index.retries("creator0", "file"), [])
+        for path in (truncated, error_page):
+            self.assertIsNone(fanbox.verify_file(path)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""DiskWriterの書き込みとfsyncの順番のテストです。"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fanbox
+
+
+class DiskWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.events: list[tuple[str, str]] = []
+        fsync_path, replace = fanbox.fsync_path, os.replace
+        def record_fsync(path:str) -> None:
+            self.events.append(("fsync", path))
+            fsync_path(path)
+        def record_replace(src:str, dst:str) -> None:
+            self.events.append(("replace", dst))
+            replace(src, dst)
+        for patcher in (mock.patch.object(fanbox, "fsync_path", record_fsync),
+                        mock.patch.object(fanbox.os, "replace", record_replace)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def path(self, name:str) -> str:
+        return os.path.join(self.workdir.name, name)
+
+    def test_commit_with_wait_syncs_before_rename(self):
+        # 書き込みスレッドがあっても、wait=Trueならfsyncを済ませてから置き換える
+        writer = fanbox.DiskWriter(threads=1)
+        fanbox.save_json({"a": 1}, self.path("data.json"), writer=writer, wait=True)
+        self.assertEqual(self.events[:2], [("fsync", self.path("data.json.part")), ("replace", self.path("data.json"))])
+        self.assertEqual(fanbox.load_json(self.path("data.json")), {"a": 1})
+
+    def write(self, writer:fanbox.DiskWriter, name:str, chunks:list[bytes]) -> str:
+        """stream()で一時ファイルに書き込み、commit()する。"""
+        with writer.stream(self.path(name + ".part")) as write:
+            for chunk in chunks:
+                write(chunk)
+        writer.commit(self.path(name + ".part"), self.path(name))
+        return self.path(name)
+
+    def test_after_sync_runs_after_fsync(self):
+        writer = fanbox.DiskWriter(threads=2)
+        chunks = [bytes([i]) * 1000 for i in range(50)]
+        paths = [self.write(writer, "file%d" % i, chunks) for i in range(3)]
+        writer.after_sync(lambda: self.events.append(("recorded", "")))
+        last = self.write(writer, "last", chunks)
+        writer.flush()
+        for path in paths + [last]:
+            with open(path, mode="rb") as f:
+                self.assertEqual(f.read(), b"".join(chunks))
+        recorded = self.events.index(("recorded", ""))
+        # 登録する前にcommit()したファイルは全てfsyncしてから呼ぶ
+        for path in paths:
+            self.assertLess(self.events.index(("fsync", path)), recorded)
+        self.assertIn(("fsync", last), self.events)
+        # 置き換えてからfsyncする（fsyncをまとめて行うため）
+        self.assertLess(self.events.index(("replace", paths[0])), self.events.index(("fsync", paths[0])))
+
+    def test_failed_fsync_is_not_recorded(self):
+        fsync_path = fanbox.fsync_path
+        def fail(path:str) -> None:
+            if path.endswith("bad"): raise OSError("I/O error")
+            fsync_path(path)
+        recorded = []
+        with mock.patch.object(fanbox, "fsync_path", fail):
+            writer = fanbox.DiskWriter(threads=1)
+            self.write(writer, "bad", [b"data"])
+            writer.after_sync(lambda: recorded.append("bad"))
+            with self.assertRaises(OSError):
+                writer.flush()
+            self.assertEqual(recorded, [])
+            # 失敗は一度送出したら消え、その後の書き込みは記録される
+            self.write(writer, "good", [b"data"])
+            writer.after_sync(lambda: recorded.append("good"))
+            writer.flush()
+        self.assertEqual(recorded, ["good"])
+
+    def test_write_error_is_raised_from_stream(self):
+        writer = fanbox.DiskWriter(threads=1)
+        with self.assertRaises(OSError):
+            with writer.stream(self.path(os.path.join("missing", "file.part"))) as write:
+                write(b"data")
+
+    def test_without_threads(self):
+        for durable in (True, False):
+            with self.subTest(durable=durable):
+                self.events.clear()
+                writer = fanbox.DiskWriter(threads=0, durable=durable)
+                path = self.write(writer, "file-%s" % durable, [b"a", b"b"])
+                recorded = []
+                writer.after_sync(lambda: recorded.append(path))
+                # 書き込みスレッドが無ければ、その場でfsyncしてから置き換え、after_sync()もすぐに呼ぶ
+                self.assertEqual(recorded, [path])
+                expected = [("fsync", path + ".part"), ("replace", path)] if durable else [("replace", path)]
+                self.assertEqual(self.events[:len(expected)], expected)
+                if not durable: self.assertNotIn("fsync", [event for event, _ in self.events])
+
+
+if __name__ == "__main__":
+    unittest.main()